@@ -23,9 +23,14 @@ SOFTWARE.
 """
 
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from S3Backup import config_loader
+from S3Backup import metrics
+from S3Backup import notify
+from S3Backup.resource_pool import ResourcePool
 from time import strftime, gmtime
-import boto3
 
 logger = logging.getLogger(name='S3BackupTool')
 
@@ -43,25 +48,118 @@ class S3BackupTool:
 
         logger.info('Loaded configuration')
 
-    def run_plans(self):
-        if len(self.PLANS) == 0:
+    def run_plans(self, plans=None):
+        """
+            Run the plans given (by default, all of them), returning once they have all finished
+        """
+        if plans is None:
+            plans = self.PLANS
+
+        if len(plans) == 0:
             logger.warn('No plans to execute')
             return
 
-        counter = 1
-        for plan in self.PLANS:
-            logger.info('Executing plan %d of %d', counter, len(self.PLANS))
+        max_concurrent_plans = max(1, int(self.CONFIGURATION['MAX_CONCURRENT_PLANS']))
+        max_cpu = self.CONFIGURATION['MAX_CPU']
+        max_io = self.CONFIGURATION['MAX_IO']
+
+        # Weights are measured in plan slots unless the CPU and I/O budgets are set, so by default a plan with a
+        # CpuWeight of 2 uses two of the concurrent slots while it compresses. Plans writing to the same output
+        # prefix would clash locally and in S3.
+        resource_pool = ResourcePool(max(1, int(max_cpu)) if max_cpu is not None else max_concurrent_plans,
+                                     max(1, int(max_io)) if max_io is not None else max_concurrent_plans,
+                                     max_concurrent_plans)
+        prefix_locks = dict((plan.output_file_prefix, threading.Lock()) for plan in plans)
+
+        logger.info('Running %d plans, up to %d at a time', len(plans), max_concurrent_plans)
+
+        started = time.time()
+
+        # A thread for every plan, as most only wait for their prefix and their share of the pool. Waiting on a
+        # limited number of threads would hold up plans which could run now behind those which can't.
+        with ThreadPoolExecutor(max_workers=len(plans)) as executor:
+            futures = []
+
+            for counter, plan in enumerate(plans, 1):
+                futures.append(executor.submit(self.__run_plan,
+                                               plan,
+                                               counter,
+                                               len(plans),
+                                               resource_pool,
+                                               prefix_locks[plan.output_file_prefix]))
+
+            for future in futures:
+                future.result()
+
+        self.__write_metrics(started, plans)
+
+        if self.CONFIGURATION['NOTIFIER'].digest:
+            self.__send_digest(started, plans)
+
+        # Notifications go out in the background while the plans run, but must be sent before the process exits
+        self.CONFIGURATION['NOTIFIER'].flush()
 
+        logger.info('Finished running backup plans')
+
+    def __write_metrics(self, started, plans):
+        plan_metrics = [plan.metrics for plan in plans if plan.metrics is not None]
+
+        if self.CONFIGURATION['METRICS_FILE'] is not None:
             try:
-                updated, output_file = plan.run()
-                self.__send_success_email(plan, updated, output_file)
+                metrics.write_report(self.CONFIGURATION['METRICS_FILE'], started, plan_metrics)
+                logger.info('Wrote run report to %s', self.CONFIGURATION['METRICS_FILE'])
             except Exception as e:
-                logger.error('Failed to run plan: %s', e)
-                self.__send_failure_email(plan, e)
+                logger.error('Failed to write run report to %s: %s', self.CONFIGURATION['METRICS_FILE'], e)
 
-            counter += 1
+        if self.CONFIGURATION['PROMETHEUS_FILE'] is not None:
+            try:
+                metrics.write_prometheus(self.CONFIGURATION['PROMETHEUS_FILE'], plan_metrics)
+                logger.info('Wrote Prometheus metrics to %s', self.CONFIGURATION['PROMETHEUS_FILE'])
+            except Exception as e:
+                logger.error('Failed to write Prometheus metrics to %s: %s', self.CONFIGURATION['PROMETHEUS_FILE'], e)
 
-        logger.info('Finished running backup plans')
+    def restore(self, plan_name, destination, patterns=None, key=None, threads=None):
+        """
+            Restore the entries of the latest backup of a plan (or the backup with the given key) matching the
+            patterns under the destination, returning the number of files and bytes restored
+        """
+        # Imported here, so running the module with python -m doesn't import it twice
+        from S3Backup import restore
+
+        plan = next((plan for plan in self.PLANS if plan.name == plan_name), None)
+        if plan is None:
+            raise Exception('No plan named %s' % plan_name)
+
+        restorer = restore.Restore(self.CONFIGURATION['TRANSFER_ENGINE'].client('s3', plan.transfer_settings),
+                                   self.CONFIGURATION['AWS_BUCKET'],
+                                   threads if threads is not None else restore.DEFAULT_THREADS,
+                                   plan.encryption)
+
+        return restorer.restore(key if key is not None else restorer.latest_backup(plan), destination, patterns)
+
+    def __run_plan(self, plan, counter, total, resource_pool, prefix_lock):
+        # The prefix is taken first, so a plan waiting for another with the same prefix holds none of the pool
+        with prefix_lock:
+            cpu_weight, io_weight = resource_pool.acquire(plan.cpu_weight, plan.io_weight)
+
+            try:
+                logger.info('Executing plan %d of %d: %s', counter, total, plan.name)
+
+                try:
+                    updated, output_file = plan.run()
+
+                    if not self.CONFIGURATION['NOTIFIER'].digest:
+                        self.__send_success_email(plan, updated, output_file)
+                except Exception as e:
+                    logger.error('Failed to run plan %d of %d (%s): %s', counter, total, plan.name, e)
+
+                    if not self.CONFIGURATION['NOTIFIER'].digest:
+                        self.__send_failure_email(plan, e)
+
+                logger.info('Finished plan %d of %d: %s', counter, total, plan.name)
+
+            finally:
+                resource_pool.release(cpu_weight, io_weight)
 
     def __send_success_email(self, plan, updated, output_file):
         subject = '[S3-Backup] [SUCCESS] - Plan: %s' % plan.name
@@ -75,7 +173,9 @@ class S3BackupTool:
         else:
             body += 'The backup set had not changed. No new backup uploaded'
 
-        self.__send_status_email(subject, body)
+        body += self.__metrics_summary(plan)
+
+        self.__send_status_email(subject, body, 'success', plan)
 
     def __send_failure_email(self, plan, exception):
         subject = '[S3-Backup] [FAILURE] - Plan: %s' % plan.name
@@ -86,47 +186,43 @@ class S3BackupTool:
 
         body += '\n\nDetailed failure information:\n\n%s' % exception
 
-        self.__send_status_email(subject, body)
+        body += self.__metrics_summary(plan)
 
-    def __send_status_email(self, subject, body):
-        if self.CONFIGURATION['EMAIL_FROM'] is None or self.CONFIGURATION['EMAIL_TO'] is None:
-            logger.debug('Email not provided, so status update not sent')
-            return
+        self.__send_status_email(subject, body, 'failure', plan)
 
-        ses_client = boto3.client(
-            'ses',
-            region_name=self.CONFIGURATION['AWS_REGION'],
-            aws_access_key_id=self.CONFIGURATION['AWS_KEY'],
-            aws_secret_access_key=self.CONFIGURATION['AWS_SECRET']
-        )
+    def __send_digest(self, started, plans):
+        plan_metrics = [plan.metrics for plan in plans if plan.metrics is not None]
+        failed = [result for result in plan_metrics if result.status != 'success']
 
-        try:
-            response = ses_client.send_email(
-                Source=self.CONFIGURATION['EMAIL_FROM'],
-                Destination={
-                    'ToAddresses': [self.CONFIGURATION['EMAIL_TO']]
-                },
-                Message={
-                    'Subject': {
-                        'Data': subject,
-                        'Charset': 'UTF-8'
-                    },
-                    'Body': {
-                        'Text': {
-                            'Data': body,
-                            'Charset': 'UTF-8'
-                        }
-                    }
-                })
-
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                logger.info('Successfully sent email to {0:s} with subject {1:s}'.format(self.CONFIGURATION['EMAIL_TO'],
-                                                                                         subject))
-            else:
-                logger.error('Failed to send email to {0:s} with subject {1:s}'.format(self.CONFIGURATION['EMAIL_TO'],
-                                                                                       subject))
+        subject = '[S3-Backup] [%s] - %d plans' % ('FAILURE' if len(failed) > 0 else 'SUCCESS', len(plan_metrics))
 
-        except Exception as e:
-            logger.error('Failed to send email to {0:s} with subject {1:s}'.format(self.CONFIGURATION['EMAIL_TO'],
-                                                                                   subject),
-                         e)
+        body = '%d backup plans were run at %s, taking %.1fs. %d succeeded and %d failed\n\n' % (
+            len(plan_metrics),
+            strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime(started)),
+            time.time() - started,
+            len(plan_metrics) - len(failed),
+            len(failed))
+
+        body += metrics.format_summary(plan_metrics)
+
+        for result in plan_metrics:
+            if result.updated:
+                body += '\n\nNew backup for %s: %s' % (result.plan_name, result.output_file)
+
+        for result in failed:
+            body += '\n\nDetailed failure information for %s:\n\n%s' % (result.plan_name, result.error)
+
+        self.CONFIGURATION['NOTIFIER'].send(notify.Notification(subject, body,
+                                                                 'failure' if len(failed) > 0 else 'success',
+                                                                 plan_metrics))
+
+    @staticmethod
+    def __metrics_summary(plan):
+        if plan.metrics is None:
+            return ''
+
+        return '\n\nRun summary:\n\n%s\n' % metrics.format_table(plan.metrics)
+
+    def __send_status_email(self, subject, body, status, plan):
+        self.CONFIGURATION['NOTIFIER'].send(notify.Notification(subject, body, status,
+                                                                 [plan.metrics] if plan.metrics is not None else []))
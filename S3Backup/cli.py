@@ -0,0 +1,242 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import logging
+import sys
+from S3Backup import S3BackupTool
+from S3Backup import config_loader
+from S3Backup import metrics
+
+# Modules with a command line of their own, which are handed the rest of the arguments as they are
+DELEGATED_COMMANDS = {
+    'restore': 'Restore files from a backup plan (see s3backup restore --help)',
+    'daemon': 'Run plans on their schedules (see s3backup daemon --help)'
+}
+
+# Checking a configuration or planning a run only reports problems, unless more is asked for
+QUIET_COMMANDS = ['validate', 'plan']
+
+logger = logging.getLogger(name='CLI')
+
+
+def _select(plans, names):
+    if not names:
+        return plans
+
+    known = set(plan.name for plan in plans)
+    unknown = [name for name in names if name not in known]
+
+    if len(unknown) > 0:
+        raise Exception('No plan named %s' % ', '.join(unknown))
+
+    return [plan for plan in plans if plan.name in names]
+
+
+def run(args):
+    tool = S3BackupTool(args.config)
+    plans = _select(tool.PLANS, args.plan)
+
+    tool.run_plans(plans)
+
+    failed = [plan.name for plan in plans if plan.metrics is None or plan.metrics.status != 'success']
+
+    if len(failed) > 0:
+        logger.error('%d of %d plans failed: %s', len(failed), len(plans), ', '.join(failed))
+        return 1
+
+    return 0
+
+
+def validate(args):
+    configuration, plans = config_loader.config_setup(args.config)
+
+    print('%s: %d plans OK' % (args.config, len(plans)))
+
+    return 0
+
+
+def plan(args):
+    configuration, plans = config_loader.config_setup(args.config)
+
+    for selected in _select(plans, args.plan):
+        print('Plan "%s"' % selected.name)
+        _describe(selected)
+
+        if args.dry_run:
+            _dry_run(selected, args.remote)
+
+        print('')
+
+    return 0
+
+
+def _describe(selected):
+    if selected.command is not None:
+        print('  Command: %s' % selected.command)
+
+    if selected.stream_command is not None:
+        print('  Stream command: %s' % selected.stream_command)
+
+    if selected.src is not None:
+        for src in selected.src if isinstance(selected.src, list) else [selected.src]:
+            print('  Source: %s' % src)
+
+    for exclude in selected.exclude:
+        print('  Exclude: %s' % exclude)
+
+    print('  Output: %s_<timestamp> (%s, %s)' % (selected.output_file_prefix, selected.compression['Format'],
+                                                  selected.storage_mode))
+
+    if selected.encryption is not None:
+        print('  Encryption: AES-GCM, master key %s (fingerprint %s)' % (selected.encryption.key_file,
+                                                                       selected.encryption.fingerprint.hex()))
+
+    if selected.schedule is not None:
+        print('  Schedule: %s, next at %s' % (selected.schedule.expression,
+                                              selected.schedule.next_run().strftime('%Y-%m-%d %H:%M')))
+
+    print('  Retention: %s' % ', '.join('%s %d' % (rule, value)
+                                       for rule, value in sorted(selected.retention.rules.items())))
+
+
+def _dry_run(selected, remote):
+    if selected.command is not None or selected.stream_command is not None:
+        print('  (the command is not run, so the files it would produce are not included)')
+
+    if selected.src is not None:
+        try:
+            files = selected.dry_run()
+        except Exception as e:
+            print('  Files: none found (%s)' % e)
+            files = []
+
+        for file_name, size in files:
+            print('  %10s  %s' % (metrics.format_size(size), file_name))
+
+        total = sum(size for file_name, size in files)
+        print('  Files: %d, %s before compression' % (len(files), metrics.format_size(total)))
+
+    if not remote:
+        print('  Backups to remove: not checked, use --remote to list the backups in S3')
+        return
+
+    expired = selected.expired_backups()
+
+    if len(expired) == 0:
+        print('  Backups to remove: none')
+
+    for timestamp, keys in expired.items():
+        for key in keys:
+            print('  Would remove: %s' % key)
+
+
+def prune(args):
+    configuration, plans = config_loader.config_setup(args.config)
+
+    for selected in _select(plans, args.plan):
+        if args.dry_run:
+            expired = selected.expired_backups()
+            keys = [key for timestamp in expired for key in expired[timestamp]]
+
+            print('Plan "%s": would remove %d backups' % (selected.name, len(expired)))
+            for key in keys:
+                print('  %s' % key)
+        else:
+            logger.info('Pruning plan "%s"', selected.name)
+            selected.prune()
+
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='s3backup', description='Perform scripted backups to Amazon S3')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Log everything, including debug messages')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Run the backup plans')
+    run_parser.add_argument('config', help='The configuration file of the plans')
+    run_parser.add_argument('--plan', action='append', metavar='NAME', help='Run only this plan (can be repeated)')
+    run_parser.set_defaults(handler=run)
+
+    validate_parser = commands.add_parser('validate', help='Check a configuration file, without touching S3')
+    validate_parser.add_argument('config', help='The configuration file of the plans')
+    validate_parser.set_defaults(handler=validate)
+
+    plan_parser = commands.add_parser('plan', help='Describe the plans, and what a run would do')
+    plan_parser.add_argument('config', help='The configuration file of the plans')
+    plan_parser.add_argument('--plan', action='append', metavar='NAME', help='Only this plan (can be repeated)')
+    plan_parser.add_argument('--dry-run', action='store_true',
+                             help='List the files a run would back up and their total size, from stat calls alone')
+    plan_parser.add_argument('--remote', action='store_true',
+                             help='With --dry-run, also list the backups in S3 the retention rules would remove')
+    plan_parser.set_defaults(handler=plan)
+
+    prune_parser = commands.add_parser('prune', help='Remove the backups the retention rules no longer keep')
+    prune_parser.add_argument('config', help='The configuration file of the plans')
+    prune_parser.add_argument('--plan', action='append', metavar='NAME', help='Only this plan (can be repeated)')
+    prune_parser.add_argument('--dry-run', action='store_true', help='List the backups which would be removed')
+    prune_parser.set_defaults(handler=prune)
+
+    for name, description in DELEGATED_COMMANDS.items():
+        commands.add_parser(name, help=description, add_help=False)
+
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # restore and daemon parse their own arguments. They are only imported when used, like boto3 (which is
+    # loaded once S3 is first used), so checking a configuration or planning a run starts quickly.
+    if len(argv) > 0 and argv[0] in DELEGATED_COMMANDS:
+        if argv[0] == 'restore':
+            from S3Backup import restore
+            return restore.main(argv[1:])
+
+        from S3Backup import daemon
+        return daemon.main(argv[1:])
+
+    args = _parser().parse_args(argv)
+
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.command in QUIET_COMMANDS:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+
+    logging.basicConfig(stream=sys.stderr, level=level, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    try:
+        return args.handler(args)
+    except Exception as e:
+        logger.error('%s', e)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
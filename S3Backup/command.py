@@ -0,0 +1,113 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+from collections import deque
+
+# Only the end of stderr is kept for error messages, however much the command writes
+STDERR_TAIL_SIZE = 8 * 1024
+
+COPY_SIZE = 1024 * 1024
+
+logger = logging.getLogger(name='Command')
+
+
+def command_path(command):
+    """
+        Commands which aren't absolute are relative to the directory of the script running the backup
+    """
+    if command[0] != '/':
+        return os.path.join(sys.path[0], command)
+
+    return command
+
+
+class CommandStream:
+    """
+        Runs a command in the shell, with its stdout read as a stream so it can be written into an archive as it
+        is produced rather than going to disk first. The pipe only holds a little of the output, so a command
+        writing faster than it can be archived (or uploaded) is held up until the archive catches up.
+
+        The end of stderr is kept, and given in the exception raised if the command fails.
+    """
+
+    def __init__(self, command, capture_stdout=True):
+        self.command = command
+        self.capture_stdout = capture_stdout
+        self.process = None
+        self.bytes_read = 0
+
+        self.__stderr = deque()
+        self.__stderr_size = 0
+        self.__stderr_thread = None
+
+    def __enter__(self):
+        logger.info('Executing %s', self.command)
+
+        self.process = subprocess.Popen(self.command,
+                                        shell=True,
+                                        stdout=subprocess.PIPE if self.capture_stdout else subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=True)
+
+        # stderr is drained alongside stdout, so a command writing a lot to it can't block on a full pipe
+        self.__stderr_thread = threading.Thread(target=self.__read_stderr, daemon=True)
+        self.__stderr_thread.start()
+
+        return self
+
+    def read(self, size=COPY_SIZE):
+        data = self.process.stdout.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def stderr(self):
+        return b''.join(self.__stderr)[-STDERR_TAIL_SIZE:].decode('utf-8', 'replace')
+
+    def __read_stderr(self):
+        for data in iter(lambda: self.process.stderr.read1(COPY_SIZE), b''):
+            self.__stderr.append(data)
+            self.__stderr_size += len(data)
+
+            while self.__stderr_size - len(self.__stderr[0]) >= STDERR_TAIL_SIZE:
+                self.__stderr_size -= len(self.__stderr.popleft())
+
+    def __kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, ProcessLookupError):
+            # Without process groups (on Windows), or when the command has already exited
+            self.process.kill()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Whatever reads the output failed, so there is no point letting the command finish. The shell's
+            # children are killed too, as they hold the pipes open until they exit.
+            self.__kill()
+
+        if self.process.stdout is not None:
+            self.process.stdout.close()
+
+        returncode = self.process.wait()
+        self.__stderr_thread.join()
+        self.process.stderr.close()
+
+        logger.info('Process returned code %d', returncode)
+
+        if exc_type is None and returncode != 0:
+            stderr = self.stderr().strip()
+            logger.error('Command failed with code %d: %s', returncode, stderr)
+
+            if stderr:
+                raise Exception('Failed with code %d. The command wrote to stderr:\n\n%s' % (returncode, stderr))
+
+            raise Exception('Failed with code %d' % returncode)
+
+        return False
+
+
+def run_command(command):
+    with CommandStream(command, capture_stdout=False):
+        pass
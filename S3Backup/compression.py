@@ -0,0 +1,159 @@
+import math
+import os
+from collections import Counter
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
+
+compression_values = ['Codec', 'Level', 'Format', 'AutoStore']
+
+ZIP_CODECS = {
+    'store': ZIP_STORED,
+    'deflate': ZIP_DEFLATED,
+    'bzip2': ZIP_BZIP2,
+    'lzma': ZIP_LZMA
+}
+
+# The levels each codec accepts. zipfile ignores the level of stored and lzma entries, so they take none.
+LEVELS = {
+    'deflate': (0, 9),
+    'bzip2': (1, 9),
+    'zstd': (-131072, 22)
+}
+
+FORMATS = {
+    'zip': '.zip',
+    'tar.zst': '.tar.zst'
+}
+
+# Files with these extensions are already compressed, so are stored as they are
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.wmv',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lz4', '.zst', '.7z', '.rar', '.jar', '.apk', '.whl',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub'
+}
+
+# Files with these extensions are always worth compressing, so aren't sampled
+COMPRESSED_EXTENSIONS = {
+    '.txt', '.log', '.csv', '.tsv', '.sql', '.json', '.xml', '.yaml', '.yml', '.ini', '.conf', '.md', '.rst',
+    '.html', '.htm', '.css', '.js', '.ts', '.py', '.php', '.rb', '.java', '.c', '.h', '.cpp', '.cs', '.go',
+    '.sh', '.bat', '.ps1', '.svg', '.bmp', '.tif', '.tiff', '.wav', '.tar', '.bak', '.dump'
+}
+
+SAMPLE_SIZE = 64 * 1024
+
+# Bits per byte, above which the sample is treated as already compressed (or encrypted)
+ENTROPY_THRESHOLD = 7.5
+
+
+def compression_settings(raw_settings, compression_workers=1):
+    """
+        The Compression settings for a plan. Without any, entries are stored (or deflated when compressing in
+        parallel), as they always were.
+    """
+    settings = {
+        'Codec': 'deflate' if compression_workers > 1 else 'store',
+        'Level': None,
+        'Format': 'zip',
+        'AutoStore': True
+    }
+
+    for key, value in (raw_settings or {}).items():
+        if key not in compression_values:
+            raise Exception('Unknown compression setting: %s' % key)
+        settings[key] = value
+
+    if settings['Format'] not in FORMATS:
+        raise Exception('Unknown output format: %s' % settings['Format'])
+
+    if settings['Format'] == 'tar.zst':
+        if 'Codec' in (raw_settings or {}) and settings['Codec'] != 'zstd':
+            raise Exception('The tar.zst format is always compressed with zstd, not %s' % settings['Codec'])
+        settings['Codec'] = 'zstd'
+    elif settings['Codec'] == 'zstd':
+        raise Exception('The zstd codec needs "Format": "tar.zst"')
+    elif settings['Codec'] not in ZIP_CODECS:
+        raise Exception('Unknown compression codec: %s' % settings['Codec'])
+
+    if settings['Level'] is not None:
+        try:
+            settings['Level'] = int(settings['Level'])
+        except ValueError:
+            raise Exception('Compression level must be a whole number: %s' % settings['Level'])
+
+        if settings['Codec'] not in LEVELS:
+            raise Exception('The %s codec does not take a compression level' % settings['Codec'])
+
+        lowest, highest = LEVELS[settings['Codec']]
+        if not lowest <= settings['Level'] <= highest:
+            raise Exception('Compression level %d is out of range for %s, which takes %d to %d' %
+                            (settings['Level'], settings['Codec'], lowest, highest))
+
+    settings['AutoStore'] = bool(settings['AutoStore'])
+
+    return settings
+
+
+def sample_entropy(file_name, size=SAMPLE_SIZE):
+    """
+        Shannon entropy, in bits per byte, of the start of the file
+    """
+    with open(file_name, 'rb') as source:
+        data = source.read(size)
+
+    if len(data) == 0:
+        return 0.0
+
+    total = float(len(data))
+    return -sum(count / total * math.log(count / total, 2) for count in Counter(data).values())
+
+
+def worth_compressing(file_name):
+    """
+        Known media and archive formats are not, known text formats are, and anything else is decided by sampling
+        the entropy of its first block
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+
+    if extension in STORED_EXTENSIONS:
+        return False
+
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+
+    try:
+        # There is nothing to gain from compressing an empty file, only header overhead
+        if os.path.getsize(file_name) == 0:
+            return False
+
+        return sample_entropy(file_name) < ENTROPY_THRESHOLD
+    except OSError:
+        # Let the archive report the problem when it tries to read the file
+        return True
+
+
+def open_zstd_writer(output, level=None, threads=1):
+    """
+        A file object compressing everything written to it into output as a single zstd frame
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('The zstandard package must be installed to use the tar.zst output format')
+
+    compressor = zstandard.ZstdCompressor(level=level if level is not None else 3,
+                                          threads=threads if threads > 1 else 0)
+
+    return compressor.stream_writer(output, closefd=False)
+
+
+def open_zstd_reader(source):
+    """
+        A file object decompressing the zstd frames read from source
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('The zstandard package must be installed to restore tar.zst backups')
+
+    return zstandard.ZstdDecompressor().stream_reader(source, closefd=False)
@@ -24,12 +24,19 @@ SOFTWARE.
 
 import json
 import logging
+import os
+from S3Backup import entry_cache
+from S3Backup import notify
+from S3Backup import state_store
+from S3Backup import transfer
 from S3Backup.plan import Plan
 
 logger = logging.getLogger(name='config_loader')
 
 required_root_values = ['AWS_KEY', 'AWS_SECRET', 'AWS_BUCKET', 'AWS_REGION', 'HASH_CHECK_FILE', 'Plans']
-optional_root_values = ['EMAIL_FROM', 'EMAIL_TO']
+optional_root_values = ['AWS_ENDPOINT_URL', 'EMAIL_FROM', 'EMAIL_TO', 'ENTRY_CACHE_DIR', 'ENTRY_CACHE_SIZE_MB',
+                        'MANIFEST_DIR', 'MAX_CONCURRENT_PLANS', 'MAX_CPU', 'MAX_IO', 'METRICS_FILE', 'NOTIFICATIONS',
+                        'PROMETHEUS_FILE', 'STATE_BACKEND', 'STATE_FILE', 'TRANSFER']
 
 
 def config_setup(config_file):
@@ -40,9 +47,22 @@ def config_setup(config_file):
         'AWS_SECRET': '',
         'AWS_BUCKET': '',
         'AWS_REGION': '',
+        'AWS_ENDPOINT_URL': None,
         'HASH_CHECK_FILE': '',
         'EMAIL_FROM': None,
-        'EMAIL_TO': None
+        'EMAIL_TO': None,
+        'ENTRY_CACHE_DIR': None,
+        'ENTRY_CACHE_SIZE_MB': 1024,
+        'MANIFEST_DIR': None,
+        'MAX_CONCURRENT_PLANS': 1,
+        'MAX_CPU': None,
+        'MAX_IO': None,
+        'METRICS_FILE': None,
+        'NOTIFICATIONS': None,
+        'PROMETHEUS_FILE': None,
+        'STATE_BACKEND': 'text',
+        'STATE_FILE': None,
+        'TRANSFER': None
     }
 
     plans = []
@@ -67,7 +87,34 @@ def config_setup(config_file):
     if failed:
         raise Exception('Missing keys from data. See log for details.')
 
+    configuration['STATE'] = open_state_store(configuration)
+    configuration['TRANSFER_ENGINE'] = transfer.TransferEngine(configuration)
+    configuration['NOTIFIER'] = notify.open_notifier(configuration)
+
+    if configuration['ENTRY_CACHE_DIR'] is not None:
+        configuration['ENTRY_CACHE'] = entry_cache.open_cache(configuration['ENTRY_CACHE_DIR'],
+                                                              int(configuration['ENTRY_CACHE_SIZE_MB']) * 1024 * 1024)
+    else:
+        configuration['ENTRY_CACHE'] = None
+
     for raw_plan in data['Plans']:
         plans.append(Plan(raw_plan, configuration))
 
     return configuration, plans
+
+
+def open_state_store(configuration):
+    state_file = configuration['STATE_FILE']
+
+    if configuration['STATE_BACKEND'] == 'text':
+        # The plain text store is the original hash file
+        if state_file is None:
+            state_file = configuration['HASH_CHECK_FILE']
+
+        return state_store.open_store('text', state_file)
+
+    if state_file is None:
+        state_file = os.path.splitext(configuration['HASH_CHECK_FILE'])[0] + '.sqlite'
+
+    # Existing hashes are carried over the first time a new store is opened
+    return state_store.open_store(configuration['STATE_BACKEND'], state_file, configuration['HASH_CHECK_FILE'])
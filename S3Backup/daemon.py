@@ -0,0 +1,242 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+from datetime import datetime
+from S3Backup import S3BackupTool
+from S3Backup import schedule
+from S3Backup import watcher
+
+# Plans without a Schedule of their own run at the top of every hour
+DEFAULT_SCHEDULE = '@hourly'
+
+# How often the config file and the watched sources are checked while waiting for the next run
+POLL_SECONDS = 5
+
+# A new transfer engine (and so new S3 clients and connections) is only needed if one of these changes
+ENGINE_SETTINGS = ['AWS_KEY', 'AWS_SECRET', 'AWS_REGION', 'AWS_ENDPOINT_URL', 'AWS_BUCKET', 'TRANSFER']
+
+logger = logging.getLogger(name='Daemon')
+
+
+class Daemon:
+    """
+        Keeps running, running each plan on its own cron style schedule. The S3 clients (and their connections)
+        are kept between runs, and the config file is loaded again whenever it changes or on SIGHUP.
+
+        The directories of each plan's sources are watched with inotify between runs, so a plan whose sources
+        haven't changed since it last ran successfully is skipped without reading them, and a plan whose
+        sources have changed only lists the directories which changed. A skipped plan's old backups are still
+        pruned. Plans running a Command or StreamCommand always run, as what they produce can't be watched.
+    """
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.tool = None
+
+        self.__config_mtime = None
+        self.__schedules = {}
+        self.__caches = {}
+        self.__reload = False
+        self.__stop = threading.Event()
+
+    def load(self):
+        """
+            Load the config file, keeping the running one if it can't be loaded
+        """
+        self.__reload = False
+        self.__config_mtime = self.__mtime()
+
+        try:
+            tool = S3BackupTool(self.config_file)
+
+            with open(self.config_file) as json_data_file:
+                raw_plans = dict((raw_plan['Name'], raw_plan) for raw_plan in json.load(json_data_file)['Plans'])
+
+            schedules = self.__next_runs(tool.PLANS)
+        except Exception as e:
+            if self.tool is None:
+                raise
+
+            logger.error('Keeping the running configuration, as %s could not be loaded: %s', self.config_file, e)
+            return
+
+        if self.tool is not None and all(self.tool.CONFIGURATION[setting] == tool.CONFIGURATION[setting]
+                                         for setting in ENGINE_SETTINGS):
+            tool.CONFIGURATION['TRANSFER_ENGINE'] = self.tool.CONFIGURATION['TRANSFER_ENGINE']
+
+        caches = {}
+
+        for plan in tool.PLANS:
+            if plan.src is not None:
+                # A plan whose settings have changed at all has to run again, so starts with a new cache
+                settings = json.dumps(raw_plans[plan.name], sort_keys=True)
+
+                previous = self.__caches.pop(plan.name, None)
+                if previous is not None and previous[0] == settings:
+                    caches[plan.name] = previous
+                else:
+                    if previous is not None:
+                        previous[1].close()
+                    caches[plan.name] = (settings, watcher.DirectoryCache())
+
+                plan.directory_cache = caches[plan.name][1]
+
+        for settings, cache in self.__caches.values():
+            cache.close()
+
+        self.tool = tool
+        self.__schedules = schedules
+        self.__caches = caches
+
+        for plan in tool.PLANS:
+            logger.info('Plan "%s" runs on schedule %s, next at %s', plan.name, schedules[plan.name][0].expression,
+                        schedules[plan.name][1].strftime('%Y-%m-%d %H:%M'))
+
+    def run(self, run_now=False):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.__request_reload())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        self.load()
+
+        if run_now:
+            self.run_due(self.tool.PLANS)
+
+        while not self.__stop.is_set():
+            if self.__reload or self.__mtime() != self.__config_mtime:
+                logger.info('Reloading %s', self.config_file)
+                self.load()
+
+            now = datetime.now()
+            due = []
+
+            for plan in self.tool.PLANS:
+                plan_schedule, next_run = self.__schedules[plan.name]
+
+                if next_run <= now:
+                    due.append(plan)
+                    self.__schedules[plan.name] = (plan_schedule, plan_schedule.next_run(now))
+
+            if len(due) > 0:
+                self.run_due(due)
+                continue
+
+            # Draining the events as they come keeps the kernel's queue from overflowing on busy trees
+            for settings, cache in self.__caches.values():
+                cache.poll()
+
+            next_run = min([next_run for plan_schedule, next_run in self.__schedules.values()], default=None)
+            wait = POLL_SECONDS if next_run is None else (next_run - datetime.now()).total_seconds()
+
+            self.__stop.wait(min(POLL_SECONDS, max(0, wait)))
+
+        for settings, cache in self.__caches.values():
+            cache.close()
+
+        logger.info('Stopped')
+
+    def run_due(self, plans):
+        to_run = []
+        skipped = []
+
+        for plan in plans:
+            if plan.directory_cache is not None and plan.command is None and plan.stream_command is None and \
+                    not plan.directory_cache.changed():
+                logger.info('Skipping plan "%s", its sources have not changed since it last ran', plan.name)
+                skipped.append(plan)
+                continue
+
+            if plan.directory_cache is not None:
+                plan.directory_cache.begin_run()
+
+            to_run.append(plan)
+
+        try:
+            if len(to_run) > 0:
+                self.tool.run_plans(to_run)
+        finally:
+            for plan in to_run:
+                if plan.directory_cache is not None:
+                    plan.directory_cache.end_run(plan.metrics is not None and plan.metrics.status == 'success')
+
+            # Backups still expire (and uploads go stale) while a plan's sources don't change. Pruning after the
+            # other plans have run keeps it clear of a plan backing up to the same prefix
+            for plan in skipped:
+                try:
+                    plan.prune()
+                except Exception as e:
+                    logger.error('Failed to prune plan "%s": %s', plan.name, e)
+
+    def __next_runs(self, plans):
+        now = datetime.now()
+        schedules = {}
+
+        for plan in plans:
+            plan_schedule = plan.schedule if plan.schedule is not None else schedule.CronSchedule(DEFAULT_SCHEDULE)
+
+            # A plan keeps its next run through a reload, unless its schedule was changed
+            previous = self.__schedules.get(plan.name)
+            if previous is not None and previous[0].expression == plan_schedule.expression:
+                schedules[plan.name] = previous
+            else:
+                schedules[plan.name] = (plan_schedule, plan_schedule.next_run(now))
+
+        return schedules
+
+    def stop(self):
+        self.__stop.set()
+
+    def __request_reload(self):
+        self.__reload = True
+
+    def __mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run backup plans on their schedules')
+    parser.add_argument('config', help='The configuration file of the plans')
+    parser.add_argument('--now', action='store_true', help='Run every plan once on starting, then on schedule')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    Daemon(args.config).run(args.now)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import threading
+
+encryption_values = ['KeyFile', 'SegmentSizeKB']
+
+# Encrypted archives keep the name they would have, with this added
+ENCRYPTED_SUFFIX = '.enc'
+
+MAGIC = b'S3BENC\x00\x01'
+
+# Magic, segment size, master key fingerprint, nonce of the wrapped data key, the wrapped data key (and its
+# tag), then the nonce prefix of the segments
+HEADER = struct.Struct('<8sI8s12s48s7s')
+
+KEY_SIZE = 32
+TAG_SIZE = 16
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+
+# The nonce of each segment is the prefix, the segment's number and whether it is the last one, so segments
+# can't be reordered, dropped or cut off the end without decryption failing
+SEGMENT_NONCE = struct.Struct('>7sIB')
+
+
+def _aesgcm(key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise Exception('The cryptography package must be installed to use Encryption')
+
+    return AESGCM(key)
+
+
+def is_encrypted(key):
+    return key.endswith(ENCRYPTED_SUFFIX)
+
+
+def plain_key(key):
+    """
+        The key without the encrypted suffix, which tells how the archive inside is read
+    """
+    return key[:-len(ENCRYPTED_SUFFIX)] if is_encrypted(key) else key
+
+
+def read_key_file(key_file):
+    """
+        A master key is 32 random bytes, stored base64 encoded (head -c 32 /dev/urandom | base64)
+    """
+    with open(key_file, 'rb') as key_data:
+        content = key_data.read().strip()
+
+    try:
+        key = base64.b64decode(content, validate=True)
+    except ValueError:
+        key = None
+
+    if key is None or len(key) != KEY_SIZE:
+        raise Exception('%s does not hold a base64 encoded %d byte key' % (key_file, KEY_SIZE))
+
+    return key
+
+
+def plain_size(size, segment_size):
+    body = size - HEADER.size
+    segments, remainder = divmod(body, segment_size + TAG_SIZE)
+
+    if remainder > 0:
+        if remainder < TAG_SIZE:
+            raise Exception('Encrypted data is truncated')
+        segments += 1
+
+    if segments == 0:
+        raise Exception('Encrypted data is truncated')
+
+    return body - segments * TAG_SIZE
+
+
+class Encryption:
+    """
+        A plan's Encryption settings. Each archive is encrypted with AES-GCM under a data key of its own, which
+        is stored in the archive's header wrapped (encrypted) by the master key read from KeyFile.
+
+        Archives are encrypted in segments of SegmentSizeKB (default 64), each with its own tag, so any range of
+        an archive can be decrypted (and authenticated) by fetching just the segments holding it.
+    """
+
+    def __init__(self, raw_settings):
+        settings = {
+            'KeyFile': None,
+            'SegmentSizeKB': DEFAULT_SEGMENT_SIZE // 1024
+        }
+
+        for key, value in raw_settings.items():
+            if key not in encryption_values:
+                raise Exception('Unknown encryption setting: %s' % key)
+            settings[key] = value
+
+        if settings['KeyFile'] is None:
+            raise Exception('Encryption needs a KeyFile holding the master key')
+
+        self.key_file = settings['KeyFile']
+        self.segment_size = int(settings['SegmentSizeKB']) * 1024
+
+        if self.segment_size <= 0:
+            raise Exception('SegmentSizeKB must be positive')
+
+        self.master_key = read_key_file(self.key_file)
+        self.fingerprint = hashlib.sha256(b'S3Backup key fingerprint\0' + self.master_key).digest()[:8]
+
+        # The hashes used to spot unchanged backups are keyed too, so nothing stored in S3 alongside an
+        # archive says anything about what is in it
+        self.hash_key = hmac.new(self.master_key, b'S3Backup hash key', hashlib.sha256).digest()
+
+    def new_header(self):
+        """
+            A new data key and the header holding it, wrapped by the master key
+        """
+        data_key = os.urandom(KEY_SIZE)
+        wrap_nonce = os.urandom(12)
+        wrapped = _aesgcm(self.master_key).encrypt(wrap_nonce, data_key, MAGIC + self.fingerprint)
+
+        header = HEADER.pack(MAGIC, self.segment_size, self.fingerprint, wrap_nonce, wrapped, os.urandom(7))
+
+        return data_key, header
+
+    def open_header(self, header):
+        """
+            The data key and segment size of an archive, from its header
+        """
+        if len(header) < HEADER.size:
+            raise Exception('Encrypted data is truncated')
+
+        magic, segment_size, fingerprint, wrap_nonce, wrapped, nonce_prefix = HEADER.unpack(header[:HEADER.size])
+
+        if magic != MAGIC:
+            raise Exception('Data is not encrypted by S3Backup, or by a newer version')
+
+        if fingerprint != self.fingerprint:
+            raise Exception('Data is encrypted with a different master key (fingerprint %s, %s has %s)' %
+                            (fingerprint.hex(), self.key_file, self.fingerprint.hex()))
+
+        try:
+            data_key = _aesgcm(self.master_key).decrypt(wrap_nonce, wrapped, MAGIC + fingerprint)
+        except Exception:
+            raise Exception('The data key could not be unwrapped, the header is corrupt')
+
+        return data_key, segment_size, nonce_prefix
+
+
+def _nonce(nonce_prefix, number, last):
+    return SEGMENT_NONCE.pack(nonce_prefix, number, 1 if last else 0)
+
+
+class EncryptingWriter:
+    """
+        Encrypts everything written through it in segments, as it is written. The last segment is only known
+        once everything has been written, so finish() must be called to write it.
+    """
+
+    def __init__(self, fileobj, encryption):
+        self.fileobj = fileobj
+
+        data_key, self.__header = encryption.new_header()
+        self.__cipher = _aesgcm(data_key)
+        self.__segment_size = encryption.segment_size
+        self.__nonce_prefix = self.__header[-7:]
+        self.__buffer = bytearray()
+        self.__segments = 0
+
+        fileobj.write(self.__header)
+
+    def write(self, data):
+        self.__buffer += data
+
+        # A full segment is held back until more is written, as it could be the last
+        while len(self.__buffer) > self.__segment_size:
+            self.__write_segment(bytes(self.__buffer[:self.__segment_size]), False)
+            del self.__buffer[:self.__segment_size]
+
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def finish(self):
+        self.__write_segment(bytes(self.__buffer), True)
+        self.__buffer = bytearray()
+
+    def __write_segment(self, data, last):
+        self.fileobj.write(self.__cipher.encrypt(_nonce(self.__nonce_prefix, self.__segments, last), data,
+                                                 self.__header))
+        self.__segments += 1
+
+
+class DecryptingSource:
+    """
+        A range source (see restore) over an encrypted one, fetching and decrypting only the segments holding
+        each range read
+    """
+
+    def __init__(self, source, encryption):
+        self.source = source
+        self.key = source.key
+
+        self.__header = source.read(0, HEADER.size)
+        data_key, self.__segment_size, self.__nonce_prefix = encryption.open_header(self.__header)
+        self.__cipher = _aesgcm(data_key)
+        self.__size = None
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        with self.__lock:
+            if self.__size is None:
+                self.__size = plain_size(self.source.size, self.__segment_size)
+
+        return self.__size
+
+    def tail(self, length):
+        return self.read(max(0, self.size - length), self.size)
+
+    def read(self, start, end):
+        end = min(end, self.size)
+
+        if end <= start:
+            return b''
+
+        stored_segment = self.__segment_size + TAG_SIZE
+        last_segment = max(0, (self.size - 1) // self.__segment_size)
+
+        first = start // self.__segment_size
+        last = (end - 1) // self.__segment_size
+
+        data = self.source.read(HEADER.size + first * stored_segment,
+                                min(HEADER.size + (last + 1) * stored_segment, self.source.size))
+        plain = []
+
+        for number in range(first, last + 1):
+            offset = (number - first) * stored_segment
+
+            try:
+                plain.append(self.__cipher.decrypt(_nonce(self.__nonce_prefix, number, number == last_segment),
+                                                   data[offset:offset + stored_segment],
+                                                   self.__header))
+            except Exception:
+                raise Exception('Segment %d of %s failed to decrypt, it has been corrupted or tampered with' %
+                                (number, self.key))
+
+        skip = start - first * self.__segment_size
+
+        return b''.join(plain)[skip:skip + end - start]
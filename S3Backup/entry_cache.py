@@ -0,0 +1,333 @@
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from tempfile import mkstemp
+from zipfile import ZipInfo, ZIP64_LIMIT, LargeZipFile
+
+# Each cached entry starts with the compression type, CRC and uncompressed size of the data which follows
+HEADER = struct.Struct('<4sHIQ')
+MAGIC = b'S3BE'
+
+# No single entry may take up more than this fraction of the cache, or one file could flush everything else
+MAX_ENTRY_FRACTION = 4
+
+READ_SIZE = 1024 * 1024
+
+logger = logging.getLogger(name='EntryCache')
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(directory, max_size):
+    """
+        Get the entry cache for a directory, so every plan (and thread) using it shares one cache and one limit
+    """
+    directory = os.path.abspath(os.path.normpath(directory))
+
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = EntryCache(directory, max_size)
+
+        # The limit of a configuration loaded again takes over
+        _caches[directory].resize(max_size)
+
+        return _caches[directory]
+
+
+class CachedEntry:
+    """
+        An entry found in the cache, held open so it can still be read if it is evicted before it is copied
+    """
+
+    def __init__(self, entry_file, compress_type, crc, file_size, compress_size):
+        self.entry_file = entry_file
+        self.compress_type = compress_type
+        self.crc = crc
+        self.file_size = file_size
+        self.compress_size = compress_size
+
+    def close(self):
+        self.entry_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EntryCache:
+    """
+        Compressed zip entries kept on the local disk between runs (and shared between plans), so files which
+        haven't changed are copied into new archives as they are rather than being compressed again. Entries
+        are keyed by the path, size, modification time and inode of the file, and by how it was compressed.
+
+        The least recently used entries are removed once the cache grows past max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__load()
+
+    def __load(self):
+        entries = []
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.entry') and entry.is_file():
+                info = entry.stat()
+                entries.append((info.st_mtime_ns, entry.name, info.st_size))
+
+        # Files are touched when used, so the modification time orders them from least to most recently used
+        for mtime_ns, name, size in sorted(entries):
+            self.__entries[name] = size
+            self.__size += size
+
+        logger.debug('Entry cache %s holds %d entries (%d bytes)', self.directory, len(self.__entries), self.__size)
+
+    def key(self, file_name, variant):
+        """
+            The key for the file compressed in the given way, or None if the file can't be cached
+        """
+        try:
+            info = os.stat(file_name)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(info.st_mode) or info.st_size > self.max_size // MAX_ENTRY_FRACTION:
+            return None
+
+        identity = '\0'.join([os.path.abspath(file_name), str(info.st_size), str(info.st_mtime_ns),
+                              str(info.st_ino), variant])
+
+        return hashlib.sha256(identity.encode('utf-8', 'surrogateescape')).hexdigest() + '.entry'
+
+    def has(self, key):
+        """
+            Whether the cache has the entry, without opening it. It can still be evicted before get() is called.
+        """
+        return os.path.isfile(os.path.join(self.directory, key))
+
+    def get(self, key):
+        """
+            The cached entry, open for reading (so it has to be closed), or None
+        """
+        path = os.path.join(self.directory, key)
+
+        try:
+            entry_file = open(path, 'rb')
+        except OSError:
+            with self.__lock:
+                self.__forget(key)
+            return None
+
+        try:
+            magic, compress_type, crc, file_size = HEADER.unpack(entry_file.read(HEADER.size))
+            compress_size = os.fstat(entry_file.fileno()).st_size - HEADER.size
+        except (OSError, struct.error):
+            entry_file.close()
+            with self.__lock:
+                self.__forget(key)
+            return None
+
+        if magic != MAGIC:
+            entry_file.close()
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since it was opened, which doesn't stop it being read
+            pass
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+            else:
+                # Added by another process sharing the directory
+                self.__entries[key] = compress_size + HEADER.size
+                self.__size += compress_size + HEADER.size
+
+        return CachedEntry(entry_file, compress_type, crc, file_size, compress_size)
+
+    def resize(self, max_size):
+        with self.__lock:
+            self.max_size = max_size
+            self.__evict()
+
+    def open_entry(self, key, compress_type):
+        return EntryWriter(self, key, compress_type)
+
+    def add(self, key, temp_path):
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, os.path.join(self.directory, key))
+
+        with self.__lock:
+            self.__forget(key)
+            self.__entries[key] = size
+            self.__size += size
+            self.__evict()
+
+    def __evict(self):
+        while self.__size > self.max_size and len(self.__entries) > 1:
+            evicted, evicted_size = self.__entries.popitem(last=False)
+            self.__size -= evicted_size
+
+            try:
+                os.remove(os.path.join(self.directory, evicted))
+            except OSError:
+                pass
+
+    def __forget(self, key):
+        size = self.__entries.pop(key, None)
+        if size is not None:
+            self.__size -= size
+
+
+class EntryWriter:
+    """
+        Collects the compressed data of an entry as it is written, adding it to the cache once it is complete
+    """
+
+    def __init__(self, cache, key, compress_type):
+        self.cache = cache
+        self.key = key
+        self.compress_type = compress_type
+
+        fh, self.temp_path = mkstemp(dir=cache.directory, suffix='.tmp')
+        self.__file = os.fdopen(fh, 'w+b')
+        self.__file.write(HEADER.pack(MAGIC, compress_type, 0, 0))
+
+    def write(self, data):
+        self.__file.write(data)
+
+    def commit(self, crc, file_size, zip_file, file_name):
+        """
+            Copy the finished entry into the archive straight from the temporary file, so it can't be evicted
+            first, then add it to the cache
+        """
+        try:
+            self.__file.seek(0)
+            self.__file.write(HEADER.pack(MAGIC, self.compress_type, crc, file_size))
+            compress_size = self.__file.seek(0, os.SEEK_END) - HEADER.size
+
+            write_entry(zip_file, file_name, CachedEntry(self.__file, self.compress_type, crc, file_size,
+                                                         compress_size))
+        except Exception:
+            self.discard()
+            raise
+
+        self.__file.close()
+        self.cache.add(self.key, self.temp_path)
+
+    def discard(self):
+        self.__file.close()
+
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+def write_entry(zip_file, file_name, entry):
+    """
+        Copy a cached entry into the zip file as it is
+    """
+    entry.entry_file.seek(HEADER.size)
+
+    zinfo = ZipInfo.from_file(file_name)
+    zinfo.compress_type = entry.compress_type
+    zinfo.CRC = entry.crc
+    zinfo.file_size = entry.file_size
+    zinfo.compress_size = entry.compress_size
+
+    zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+
+    if zip64 and not zip_file._allowZip64:
+        raise LargeZipFile('Filesize would require ZIP64 extensions')
+
+    # _writecheck reads the header offset when ZIP64 is not allowed
+    zinfo.header_offset = zip_file.fp.tell()
+
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    shutil.copyfileobj(entry.entry_file, zip_file.fp, READ_SIZE)
+
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+
+
+class CachedZipWriter:
+    """
+        Adds files to an open ZipFile through the cache: copying a file's entry from the cache if it has one,
+        otherwise compressing it into the cache first and copying it from there. Either way the archive gets the
+        same bytes, so its hash doesn't depend on what happened to be in the cache.
+    """
+
+    def __init__(self, zip_file, cache, compress_type, level=None):
+        self.zip_file = zip_file
+        self.cache = cache
+        self.compress_type = compress_type
+        self.level = level
+        self.hits = 0
+        self.hit_bytes = 0
+
+    def write(self, file_name):
+        """
+            Returns False if the file can't be cached, so should be added to the archive as usual
+        """
+        key = self.cache.key(file_name, 'zip:%d:%s' % (self.compress_type, self.level))
+
+        if key is None:
+            return False
+
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            with entry:
+                write_entry(self.zip_file, file_name, entry)
+
+            logger.debug('Adding from cache: %s', file_name)
+            self.hits += 1
+            self.hit_bytes += entry.file_size
+            return True
+
+        logger.debug('Adding: %s', file_name)
+
+        writer = self.cache.open_entry(key, self.compress_type)
+
+        try:
+            compressor = zipfile._get_compressor(self.compress_type, self.level)
+            crc = 0
+            file_size = 0
+
+            with open(file_name, 'rb') as source:
+                for data in iter(lambda: source.read(READ_SIZE), b''):
+                    crc = zipfile.crc32(data, crc)
+                    file_size += len(data)
+                    writer.write(compressor.compress(data))
+
+            writer.write(compressor.flush())
+        except Exception:
+            writer.discard()
+            raise
+
+        writer.commit(crc, file_size, self.zip_file, file_name)
+
+        return True
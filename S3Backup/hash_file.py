@@ -1,67 +1,143 @@
 import hashlib
-import os
-from shutil import move
-from tempfile import mkstemp
+import hmac
+from S3Backup import state_store
 
 BLOCKSIZE = 65535
 
+DEFAULT_ALGORITHM = 'md5'
+ALGORITHMS = ['md5', 'sha1', 'sha256', 'blake2b', 'blake2s', 'blake3', 'xxh3']
+
 
 def find_hash(hash_file, plan_name):
     # Try to find the hash in the hash file
-    filename = os.path.normpath(hash_file)
-    if os.path.isfile(filename):
-        plan_hashes = open(filename, 'r').readlines()
-        for line in plan_hashes:
-            parts = line.strip().split('=')
-            if len(parts) == 2 and parts[0] == plan_name:
-                return parts[1]
-
-    return None
+    return state_store.open_store('text', hash_file).get_value(plan_name, state_store.HASH_KEY)
 
 
 def update_hash(hash_file, plan_name, hash_value):
-    # Do the update (create the file if it doesn't exist)
-    filename = os.path.normpath(hash_file)
+    # Do the update (the file is created if it doesn't exist)
+    state_store.open_store('text', hash_file).update(plan_name, {state_store.HASH_KEY: hash_value})
+
 
-    # If it doesn't exist, we shortcut this
-    if not os.path.isfile(hash_file):
-        with open(hash_file, 'w') as new_file:
-            new_file.write('%s=%s\n' % (plan_name, hash_value))
-        return
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    if algorithm == 'blake3':
+        try:
+            import blake3
+        except ImportError:
+            raise Exception('The blake3 package must be installed to use the blake3 hash algorithm')
+        return blake3.blake3()
 
-    # Otherwise, we need to rebuild the file
-    fh, abs_path = mkstemp()
-    is_written = False
+    if algorithm == 'xxh3':
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception('The xxhash package must be installed to use the xxh3 hash algorithm')
+        return xxhash.xxh3_128()
 
-    with open(abs_path, 'w') as new_file:
-        with open(filename, 'r') as old_file:
-            # Handle existing entries in the file
-            for line in old_file:
-                parts = line.strip().split('=')
-                if parts[0] == plan_name:
-                    is_written = True
-                    new_file.write('%s=%s\n' % (plan_name, hash_value))
-                else:
-                    new_file.write(line)
+    if algorithm not in ALGORITHMS:
+        raise Exception('Unknown hash algorithm: %s' % algorithm)
 
-            # If the hash wasn't already in the file
-            if not is_written:
-                new_file.write('%s=%s\n' % (plan_name, hash_value))
+    return hashlib.new(algorithm)
 
-    os.close(fh)
 
-    # Remove original file
-    os.remove(hash_file)
+def format_hash(algorithm, hexdigest):
+    # MD5 hashes are stored bare, as they always were, so existing hash files keep matching
+    if algorithm == 'md5':
+        return hexdigest
 
-    # Move new file
-    move(abs_path, hash_file)
+    return '%s:%s' % (algorithm, hexdigest)
 
 
-def calc_hash(filename):
-    hasher = hashlib.md5()
+def calc_hash(filename, algorithm=DEFAULT_ALGORITHM):
+    hasher = new_hasher(algorithm)
     with open(filename, 'rb') as afile:
         buf = afile.read(BLOCKSIZE)
         while len(buf) > 0:
             hasher.update(buf)
             buf = afile.read(BLOCKSIZE)
-    return hasher.hexdigest()
+    return format_hash(algorithm, hasher.hexdigest())
+
+
+class HashingWriter:
+    """
+        Passes everything written through to another file object, hashing it on the way so the output never
+        has to be read back. Optionally also calculates the ETag S3 will give the object when it is uploaded in
+        parts of etag_part_size bytes.
+
+        There is deliberately no seek(), so ZipFile writes straight through rather than going back to patch
+        headers (which would make the hash wrong).
+
+        With a hash_key, the hash is keyed (an HMAC of it is given), so it can't be used to guess the data. With
+        no algorithm, only the ETag is calculated.
+    """
+
+    def __init__(self, fileobj, algorithm=DEFAULT_ALGORITHM, etag_part_size=None, hash_key=None):
+        self.fileobj = fileobj
+        self.algorithm = algorithm
+        self.etag_part_size = etag_part_size
+        self.hash_key = hash_key
+
+        self.__hasher = new_hasher(algorithm) if algorithm is not None else None
+        self.__position = 0
+        self.__part_digests = []
+        self.__part_hasher = hashlib.md5()
+        self.__part_position = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+        if self.__hasher is not None:
+            self.__hasher.update(data)
+        self.__position += len(data)
+
+        if self.etag_part_size is not None:
+            self.__update_parts(memoryview(data))
+
+        return len(data)
+
+    def tell(self):
+        return self.__position
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hash_value(self):
+        if self.__hasher is None:
+            raise Exception('Hash was not calculated for this writer')
+
+        if self.hash_key is not None:
+            return format_hash('hmac-sha256', hmac.new(self.hash_key,
+                                                       format_hash(self.algorithm, self.__hasher.hexdigest()).encode(),
+                                                       hashlib.sha256).hexdigest())
+
+        return format_hash(self.algorithm, self.__hasher.hexdigest())
+
+    def etag(self, multipart=True):
+        """
+            The ETag S3 reports for the data: the MD5 for a single PUT, or the MD5 of the part MD5s followed by
+            the part count for a multipart upload
+        """
+        if self.etag_part_size is None:
+            raise Exception('ETag was not calculated for this writer')
+
+        digests = list(self.__part_digests)
+        if self.__part_position > 0 or len(digests) == 0:
+            digests.append(self.__part_hasher.digest())
+
+        if not multipart:
+            if len(digests) != 1:
+                raise Exception('A single part ETag was requested for %d parts' % len(digests))
+            return digests[0].hex()
+
+        return '%s-%d' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+    def __update_parts(self, data):
+        while len(data) > 0:
+            take = min(len(data), self.etag_part_size - self.__part_position)
+            self.__part_hasher.update(data[:take])
+            self.__part_position += take
+            data = data[take:]
+
+            if self.__part_position == self.etag_part_size:
+                self.__part_digests.append(self.__part_hasher.digest())
+                self.__part_hasher = hashlib.md5()
+                self.__part_position = 0
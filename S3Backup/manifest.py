@@ -0,0 +1,201 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+from tempfile import mkstemp
+from S3Backup import hash_file
+
+MANIFEST_VERSION = 2
+
+SIZE = 0
+MTIME_NS = 1
+INODE = 2
+CONTENT_HASH = 3
+
+# Files are sorted this many at a time in memory, then merged from disk, so memory doesn't grow with the plan
+SORT_RUN_SIZE = 100000
+
+
+def manifest_path(manifest_dir, plan_name, suffix='manifest.json'):
+    # Plan names are free text, so make them safe to use as a file name. Names which only differ in the characters
+    # replaced (such as "a b" and "a_b") are told apart by a hash of the name itself.
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', plan_name)
+    name_hash = hashlib.sha256(plan_name.encode('utf-8', 'surrogateescape')).hexdigest()[:8]
+    return os.path.join(os.path.normpath(manifest_dir), '%s-%s.%s' % (safe_name, name_hash, suffix))
+
+
+def _read_manifest(filename):
+    """
+        The entries of a manifest file in path order, as (path, [size, mtime_ns, inode, content hash]), or None
+        if there is no manifest this version can use
+    """
+    if not os.path.isfile(filename):
+        return None
+
+    manifest_file = open(filename, 'r')
+
+    try:
+        header = json.loads(manifest_file.readline())
+    except ValueError:
+        manifest_file.close()
+        return None
+
+    if header.get('version') == MANIFEST_VERSION:
+        return _read_entries(manifest_file)
+
+    manifest_file.close()
+
+    # Earlier versions kept the whole manifest in one JSON object
+    if header.get('version') == 1:
+        return iter(sorted(header['files'].items()))
+
+    return None
+
+
+def _read_entries(source):
+    with source:
+        for line in source:
+            entry = json.loads(line)
+            yield entry[0], entry[1:]
+
+
+def _write_run(entries, directory):
+    fh, run_file = mkstemp(dir=directory, suffix='.run')
+
+    with os.fdopen(fh, 'w') as output:
+        for file_name, entry in entries:
+            output.write(json.dumps([file_name] + entry) + '\n')
+
+    return run_file
+
+
+def _sorted_stats(fileset, directory):
+    """
+        Stat every file in the file set, giving them back in path order. Only SORT_RUN_SIZE entries are sorted in
+        memory at a time, and once there are more the sorted runs are written out and merged from disk.
+    """
+    runs = []
+    entries = []
+
+    try:
+        for file_name in fileset:
+            stat = os.stat(file_name)
+            entries.append((file_name, [stat.st_size, stat.st_mtime_ns, stat.st_ino, None]))
+
+            if len(entries) == SORT_RUN_SIZE:
+                runs.append(_write_run(sorted(entries, key=_path), directory))
+                entries = []
+
+        entries.sort(key=_path)
+
+        if len(runs) == 0:
+            for entry in entries:
+                yield entry
+            return
+
+        runs.append(_write_run(entries, directory))
+        entries = None
+
+        for entry in heapq.merge(*[_read_entries(open(run_file, 'r')) for run_file in runs], key=_path):
+            yield entry
+    finally:
+        for run_file in runs:
+            try:
+                os.remove(run_file)
+            except OSError:
+                pass
+
+
+def _path(entry):
+    return entry[0]
+
+
+def _is_unchanged(old_entry, entry):
+    if old_entry is None or old_entry[SIZE] != entry[SIZE]:
+        return False
+
+    if old_entry[MTIME_NS] == entry[MTIME_NS] and old_entry[INODE] == entry[INODE]:
+        return True
+
+    # The file was touched or replaced, but it may still hold the same content
+    return old_entry[CONTENT_HASH] is not None and old_entry[CONTENT_HASH] == entry[CONTENT_HASH]
+
+
+def build_manifest(fileset, filename, content_hash=False):
+    """
+        Stat every file in the file set, writing a new manifest to a temporary file next to the manifest at
+        filename, and return the temporary file and whether nothing has changed since that manifest was saved.
+
+        Manifests are kept in path order, so the new one is compared against the previous one as the two are
+        gone through side by side, and neither is ever held in memory. Content hashes are only calculated when
+        asked for, and are reused from the previous manifest when the size, mtime and inode of a file have not
+        changed.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    previous = _read_manifest(filename)
+    unchanged = previous is not None
+
+    if previous is None:
+        previous = iter(())
+
+    old = next(previous, None)
+    last_name = None
+
+    fh, new_file = mkstemp(dir=directory, suffix='.manifest')
+
+    try:
+        with os.fdopen(fh, 'w') as output:
+            output.write(json.dumps({'version': MANIFEST_VERSION}) + '\n')
+
+            for file_name, entry in _sorted_stats(fileset, directory):
+                # The same file can be found through more than one source
+                if file_name == last_name:
+                    continue
+                last_name = file_name
+
+                # Files before this one in the previous manifest have gone
+                while old is not None and old[0] < file_name:
+                    unchanged = False
+                    old = next(previous, None)
+
+                old_entry = None
+                if old is not None and old[0] == file_name:
+                    old_entry = old[1]
+                    old = next(previous, None)
+
+                if content_hash:
+                    if old_entry is not None and old_entry[:CONTENT_HASH] == entry[:CONTENT_HASH]:
+                        entry[CONTENT_HASH] = old_entry[CONTENT_HASH]
+                    elif not os.path.isdir(file_name):
+                        entry[CONTENT_HASH] = hash_file.calc_hash(file_name)
+
+                if unchanged and not _is_unchanged(old_entry, entry):
+                    unchanged = False
+
+                output.write(json.dumps([file_name] + entry) + '\n')
+
+        # Anything left in the previous manifest has gone too
+        if old is not None:
+            unchanged = False
+    except Exception:
+        os.remove(new_file)
+        raise
+    finally:
+        close = getattr(previous, 'close', None)
+        if close is not None:
+            close()
+
+    return new_file, unchanged
+
+
+def save_manifest(filename, new_file):
+    # Replace in one step, so there is never a moment without a manifest
+    os.replace(new_file, filename)
+
+
+def discard_manifest(new_file):
+    try:
+        os.remove(new_file)
+    except OSError:
+        pass
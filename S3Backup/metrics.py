@@ -0,0 +1,272 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+COUNTERS = ['files', 'bytes_read', 'bytes_compressed', 'bytes_uploaded']
+
+
+class PhaseMetrics:
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'running'
+        self.started = time.time()
+        self.duration = None
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        # Operation name: [count, seconds, errors]
+        self.requests = {}
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'status': self.status,
+            'started': round(self.started, 3),
+            'duration_seconds': round(self.duration, 3) if self.duration is not None else None,
+            'counters': dict(self.counters),
+            's3_requests': dict((operation, {'count': count, 'seconds': round(seconds, 3), 'errors': errors})
+                                for operation, (count, seconds, errors) in sorted(self.requests.items()))
+        }
+
+
+class PlanMetrics:
+    """
+        Timings and counters for one run of a plan, broken down by the phase of the run they happened in.
+        Counters and S3 requests can be recorded from any thread, and go to whichever phase is running.
+    """
+
+    def __init__(self, plan_name):
+        self.plan_name = plan_name
+        self.started = time.time()
+        self.finished = None
+        self.status = 'running'
+        self.updated = False
+        self.output_file = None
+        self.error = None
+        self.phases = []
+
+        self.__current = None
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        phase = PhaseMetrics(name)
+        started = time.monotonic()
+
+        with self.__lock:
+            self.phases.append(phase)
+            previous, self.__current = self.__current, phase
+
+        try:
+            yield phase
+            phase.status = 'ok'
+        except Exception:
+            phase.status = 'failed'
+            raise
+        finally:
+            phase.duration = time.monotonic() - started
+            with self.__lock:
+                self.__current = previous
+
+    def add(self, counter, amount=1):
+        with self.__lock:
+            if self.__current is not None:
+                self.__current.counters[counter] += amount
+
+    def add_request(self, operation, seconds, failed=False):
+        with self.__lock:
+            if self.__current is not None:
+                count, total, errors = self.__current.requests.get(operation, (0, 0.0, 0))
+                self.__current.requests[operation] = (count + 1, total + seconds, errors + (1 if failed else 0))
+
+    def count_files(self, sizes):
+        """
+            Count the files written to an archive, and the bytes in them, from the sizes it recorded for them
+        """
+        sizes = list(sizes)
+        self.add('files', len(sizes))
+        self.add('bytes_read', sum(sizes))
+
+    def finish(self, status, updated=False, output_file=None, error=None):
+        self.finished = time.time()
+        self.status = status
+        self.updated = updated
+        self.output_file = output_file
+        self.error = None if error is None else str(error)
+
+    @property
+    def duration(self):
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def totals(self):
+        totals = dict((counter, 0) for counter in COUNTERS)
+        totals.update({'s3_requests': 0, 's3_request_seconds': 0.0, 's3_request_errors': 0})
+
+        for phase in self.phases:
+            for counter in COUNTERS:
+                totals[counter] += phase.counters[counter]
+            for count, seconds, errors in phase.requests.values():
+                totals['s3_requests'] += count
+                totals['s3_request_seconds'] += seconds
+                totals['s3_request_errors'] += errors
+
+        totals['s3_request_seconds'] = round(totals['s3_request_seconds'], 3)
+        return totals
+
+    def to_dict(self):
+        return {
+            'plan': self.plan_name,
+            'status': self.status,
+            'updated': self.updated,
+            'output_file': self.output_file,
+            'error': self.error,
+            'started': round(self.started, 3),
+            'duration_seconds': round(self.duration, 3),
+            'phases': [phase.to_dict() for phase in self.phases],
+            'totals': self.totals()
+        }
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
+
+def format_table(plan_metrics):
+    """
+        A plain text table of the phases of a plan run, for status emails
+    """
+    rows = [('Phase', 'Time', 'Files', 'Read', 'Compressed', 'Uploaded', 'S3 requests')]
+
+    for phase in plan_metrics.phases:
+        requests = sum(count for count, seconds, errors in phase.requests.values())
+        request_seconds = sum(seconds for count, seconds, errors in phase.requests.values())
+
+        rows.append((phase.name + ('' if phase.status == 'ok' else ' (%s)' % phase.status),
+                     '%.1fs' % (phase.duration or 0),
+                     str(phase.counters['files']) if phase.counters['files'] else '',
+                     format_size(phase.counters['bytes_read']) if phase.counters['bytes_read'] else '',
+                     format_size(phase.counters['bytes_compressed']) if phase.counters['bytes_compressed'] else '',
+                     format_size(phase.counters['bytes_uploaded']) if phase.counters['bytes_uploaded'] else '',
+                     '%d (%.1fs)' % (requests, request_seconds) if requests else ''))
+
+    rows.append(('Total', '%.1fs' % plan_metrics.duration, '', '', '', '', ''))
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def format_summary(plan_metrics):
+    """
+        A plain text table of a run of several plans, one row each, for digest emails
+    """
+    rows = [('Plan', 'Status', 'Time', 'Files', 'Read', 'Uploaded')]
+
+    for metrics in plan_metrics:
+        totals = metrics.totals()
+
+        rows.append((metrics.plan_name,
+                     metrics.status + (' (new backup)' if metrics.updated else ''),
+                     '%.1fs' % metrics.duration,
+                     str(totals['files']) if totals['files'] else '',
+                     format_size(totals['bytes_read']) if totals['bytes_read'] else '',
+                     format_size(totals['bytes_uploaded']) if totals['bytes_uploaded'] else ''))
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def _write_atomically(filename, content):
+    fh, temp_path = mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+
+    with os.fdopen(fh, 'w') as output:
+        output.write(content)
+
+    # Collectors and readers never see a half written file
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, filename)
+
+
+def write_report(filename, started, plan_metrics):
+    report = {
+        'started': round(started, 3),
+        'finished': round(time.time(), 3),
+        'duration_seconds': round(time.time() - started, 3),
+        'plans': [metrics.to_dict() for metrics in plan_metrics]
+    }
+
+    _write_atomically(filename, json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(plan_metrics):
+    """
+        The metrics in the Prometheus text exposition format, for the node exporter's textfile collector
+    """
+    families = [
+        ('s3backup_plan_success', 'gauge', 'Whether the last run of the plan succeeded'),
+        ('s3backup_plan_updated', 'gauge', 'Whether the last run of the plan uploaded a new backup'),
+        ('s3backup_plan_last_run_timestamp_seconds', 'gauge', 'When the last run of the plan started'),
+        ('s3backup_plan_duration_seconds', 'gauge', 'How long the last run of the plan took'),
+        ('s3backup_phase_duration_seconds', 'gauge', 'How long each phase of the last run took'),
+        ('s3backup_phase_files', 'gauge', 'Files read in each phase of the last run'),
+        ('s3backup_phase_bytes', 'gauge', 'Bytes read, compressed and uploaded in each phase of the last run'),
+        ('s3backup_s3_requests', 'gauge', 'S3 requests made by the last run'),
+        ('s3backup_s3_request_seconds', 'gauge', 'Time spent on S3 requests by the last run'),
+        ('s3backup_s3_request_errors', 'gauge', 'Failed S3 requests made by the last run')
+    ]
+    samples = dict((name, []) for name, metric_type, help_text in families)
+
+    for metrics in plan_metrics:
+        plan = 'plan="%s"' % _label(metrics.plan_name)
+
+        samples['s3backup_plan_success'].append((plan, 1 if metrics.status == 'success' else 0))
+        samples['s3backup_plan_updated'].append((plan, 1 if metrics.updated else 0))
+        samples['s3backup_plan_last_run_timestamp_seconds'].append((plan, round(metrics.started, 3)))
+        samples['s3backup_plan_duration_seconds'].append((plan, round(metrics.duration, 3)))
+
+        requests = {}
+
+        for phase in metrics.phases:
+            labels = '%s,phase="%s"' % (plan, _label(phase.name))
+
+            samples['s3backup_phase_duration_seconds'].append((labels, round(phase.duration or 0, 3)))
+            samples['s3backup_phase_files'].append((labels, phase.counters['files']))
+            for kind in ['read', 'compressed', 'uploaded']:
+                samples['s3backup_phase_bytes'].append(('%s,kind="%s"' % (labels, kind),
+                                                        phase.counters['bytes_' + kind]))
+
+            for operation, (count, seconds, errors) in phase.requests.items():
+                total = requests.setdefault(operation, [0, 0.0, 0])
+                total[0] += count
+                total[1] += seconds
+                total[2] += errors
+
+        for operation, (count, seconds, errors) in sorted(requests.items()):
+            labels = '%s,operation="%s"' % (plan, _label(operation))
+            samples['s3backup_s3_requests'].append((labels, count))
+            samples['s3backup_s3_request_seconds'].append((labels, round(seconds, 3)))
+            samples['s3backup_s3_request_errors'].append((labels, errors))
+
+    lines = []
+    for name, metric_type, help_text in families:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples[name]:
+            lines.append('%s{%s} %s' % (name, labels, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename, plan_metrics):
+    _write_atomically(filename, format_prometheus(plan_metrics))
@@ -0,0 +1,249 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+notification_values = ['Digest', 'Webhook', 'WebhookTimeout', 'File', 'Retries', 'RetryDelay']
+
+default_notification_settings = {
+    'Digest': False,        # One summary per run of the plans, rather than one notification per plan
+    'Webhook': None,        # URL the notifications are POSTed to as JSON
+    'WebhookTimeout': 10,   # Seconds
+    'File': None,           # Notifications are appended to this file, one JSON object per line
+    'Retries': 3,
+    'RetryDelay': 2         # Seconds, doubling after each failed attempt
+}
+
+# The longest wait between attempts, however many retries are allowed
+MAX_RETRY_DELAY = 300
+
+logger = logging.getLogger(name='Notifier')
+
+
+def notification_settings(raw_settings):
+    settings = dict(default_notification_settings)
+
+    if raw_settings is not None:
+        for key, value in raw_settings.items():
+            if key not in notification_values:
+                raise Exception('Unknown notification setting: %s' % key)
+            settings[key] = value
+
+    return settings
+
+
+class Notification:
+
+    def __init__(self, subject, body, status, plan_metrics):
+        self.subject = subject
+        self.body = body
+        self.status = status
+        self.plan_metrics = plan_metrics
+
+    def to_dict(self):
+        return {
+            'subject': self.subject,
+            'body': self.body,
+            'status': self.status,
+            'sent': round(time.time(), 3),
+            'plans': [metrics.to_dict() for metrics in self.plan_metrics]
+        }
+
+
+class EmailSink:
+    """
+        Sends notifications through SES, on the shared client of whichever transfer engine the configuration
+        has when it sends (the daemon hands its engine on to a configuration loaded again)
+    """
+
+    def __init__(self, configuration):
+        self.CONFIGURATION = configuration
+
+    def __str__(self):
+        return 'email to %s' % self.CONFIGURATION['EMAIL_TO']
+
+    def send(self, notification):
+        response = self.CONFIGURATION['TRANSFER_ENGINE'].client('ses').send_email(
+            Source=self.CONFIGURATION['EMAIL_FROM'],
+            Destination={
+                'ToAddresses': [self.CONFIGURATION['EMAIL_TO']]
+            },
+            Message={
+                'Subject': {
+                    'Data': notification.subject,
+                    'Charset': 'UTF-8'
+                },
+                'Body': {
+                    'Text': {
+                        'Data': notification.body,
+                        'Charset': 'UTF-8'
+                    }
+                }
+            })
+
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            raise Exception('SES returned status %d' % response['ResponseMetadata']['HTTPStatusCode'])
+
+
+class WebhookSink:
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'webhook %s' % self.url
+
+    def send(self, notification):
+        # Only loaded when a webhook is set up, as it is slow to import
+        import urllib.request
+
+        request = urllib.request.Request(self.url,
+                                         data=json.dumps(notification.to_dict(), sort_keys=True).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'},
+                                         method='POST')
+
+        # Error statuses are raised by urlopen
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class FileSink:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __str__(self):
+        return 'file %s' % self.filename
+
+    def send(self, notification):
+        with open(self.filename, 'a') as output:
+            output.write(json.dumps(notification.to_dict(), sort_keys=True) + '\n')
+
+
+def open_notifier(configuration):
+    """
+        A notifier sending to every sink set up in the configuration
+    """
+    settings = notification_settings(configuration['NOTIFICATIONS'])
+    sinks = []
+
+    if configuration['EMAIL_FROM'] is not None and configuration['EMAIL_TO'] is not None:
+        sinks.append(EmailSink(configuration))
+
+    if settings['Webhook'] is not None:
+        sinks.append(WebhookSink(settings['Webhook'], settings['WebhookTimeout']))
+
+    if settings['File'] is not None:
+        sinks.append(FileSink(settings['File']))
+
+    return Notifier(sinks, settings)
+
+
+class Notifier:
+    """
+        Delivers notifications to each sink on a background thread, so a slow or throttled sink never holds up
+        the plans. A sink which fails is retried with a growing delay, without holding up the other sinks'
+        attempts. The thread only runs while there are notifications to deliver.
+    """
+
+    def __init__(self, sinks, settings=None):
+        self.sinks = sinks
+        self.settings = settings if settings is not None else notification_settings(None)
+
+        self.__pending = deque()
+        self.__worker = None
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+
+    @property
+    def digest(self):
+        return self.settings['Digest']
+
+    def send(self, notification):
+        if len(self.sinks) == 0:
+            logger.debug('No notifications set up, so "%s" not sent', notification.subject)
+            return
+
+        with self.__lock:
+            self.__pending.append(notification)
+
+            if self.__worker is None:
+                self.__worker = threading.Thread(target=self.__deliver_pending, name='Notifier', daemon=True)
+                self.__worker.start()
+
+    def flush(self, timeout=None):
+        """
+            Wait until every notification sent so far has been delivered (or given up on), returning whether
+            they all were within the timeout
+        """
+        with self.__idle:
+            return self.__idle.wait_for(lambda: self.__worker is None, timeout)
+
+    def __deliver_pending(self):
+        while True:
+            with self.__lock:
+                if len(self.__pending) == 0:
+                    self.__worker = None
+                    self.__idle.notify_all()
+                    return
+
+                notification = self.__pending.popleft()
+
+            try:
+                self.__deliver(notification)
+            except Exception as e:
+                logger.error('Failed to deliver "%s": %s', notification.subject, e)
+
+    def __deliver(self, notification):
+        waiting = list(self.sinks)
+        delay = self.settings['RetryDelay']
+
+        for attempt in range(int(self.settings['Retries']) + 1):
+            if attempt > 0:
+                time.sleep(min(delay, MAX_RETRY_DELAY))
+                delay *= 2
+
+            failed = []
+
+            for sink in waiting:
+                try:
+                    sink.send(notification)
+                    logger.info('Sent "%s" to %s', notification.subject, sink)
+                except Exception as e:
+                    logger.warning('Attempt %d to send "%s" to %s failed: %s', attempt + 1, notification.subject,
+                                   sink, e)
+                    failed.append(sink)
+
+            waiting = failed
+
+            if len(waiting) == 0:
+                return
+
+        for sink in waiting:
+            logger.error('Gave up sending "%s" to %s', notification.subject, sink)
@@ -0,0 +1,341 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT, LargeZipFile
+from S3Backup import entry_cache
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Data descriptor signature, and the general purpose flag saying one follows the entry data
+DD_SIGNATURE = 0x08074b50
+USE_DATA_DESCRIPTOR = 0x08
+
+logger = logging.getLogger(name='ParallelZipWriter')
+
+
+def crc32_combine(crc1, crc2, len2):
+    """
+        Combine the CRC32 of two blocks of data into the CRC32 of both blocks one after the other, without
+        needing the data itself. Port of crc32_combine() from zlib, which Python's zlib module does not expose.
+    """
+    if len2 == 0:
+        return crc1
+
+    # Operator for one zero bit
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+
+    # Operators for two and then four zero bits
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    # Apply len2 zero bytes to crc1
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+
+    return crc1 ^ crc2
+
+
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, matrix[n]) for n in range(32)]
+
+
+def _compress_chunk(file_name, offset, length, level, last):
+    """
+        Runs in a worker process. Each chunk is compressed as an independent raw deflate stream, finished with
+        a sync flush (or a final block for the last chunk) so the chunks can simply be concatenated.
+    """
+    with open(file_name, 'rb') as source:
+        source.seek(offset)
+        data = source.read(length)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    return compressed, zlib.crc32(data), len(data)
+
+
+class ParallelZipWriter:
+    """
+        Adds files to an open ZipFile, deflating them in a pool of worker processes. Large files are split into
+        chunks which are compressed independently, and everything is written back to the archive in order.
+
+        No more than memory_limit bytes of source data are being compressed (or waiting to be written) at once.
+        Files for which compress_check returns False are stored without compression.
+
+        Given an entry cache, files with an entry in it are copied from there without being compressed, and the
+        compressed chunks of other files go into the cache before being copied into the archive.
+    """
+
+    def __init__(self, zip_file, workers, memory_limit, chunk_size=CHUNK_SIZE, level=zlib.Z_DEFAULT_COMPRESSION,
+                 compress_check=None, cache=None):
+        self.zip_file = zip_file
+        self.workers = workers
+        self.chunk_size = max(1, min(chunk_size, memory_limit))
+        self.memory_limit = max(memory_limit, self.chunk_size)
+        self.level = level
+        self.compress_check = compress_check
+        self.cache = cache
+        self.hits = 0
+        self.hit_bytes = 0
+
+        self.__entry = None
+        self.__cache_writer = None
+
+    def write_files(self, fileset):
+        in_flight = deque()
+        in_flight_bytes = 0
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for task in self.__tasks(fileset):
+                file_name, offset, length, first, last, cached = task
+
+                while in_flight and in_flight_bytes + length > self.memory_limit:
+                    in_flight_bytes -= self.__write_next(in_flight)
+
+                if first is None:
+                    # Directories and stored files are not compressed, so there is nothing to farm out
+                    in_flight.append((task, None))
+                    continue
+
+                future = executor.submit(_compress_chunk, file_name, offset, length, self.level, last)
+                in_flight.append((task, future))
+                in_flight_bytes += length
+
+            while in_flight:
+                self.__write_next(in_flight)
+
+    def __tasks(self, fileset):
+        """
+            (file name, offset, length, first, last, cached) for each chunk to compress. Files which aren't
+            compressed have a single task with first None, as do files in the cache, with their key as cached.
+            Otherwise cached is the key to add the entry to the cache under.
+        """
+        for file_name in fileset:
+            if os.path.isdir(file_name) or (self.compress_check is not None and not self.compress_check(file_name)):
+                yield file_name, 0, 0, None, None, None
+                continue
+
+            if self.cache is not None:
+                # Chunks are flushed where they end, so the chunk size is part of how the file was compressed
+                key = self.cache.key(file_name, 'parallel:%d:%d' % (self.level, self.chunk_size))
+
+                # Only opened when it is written, so entries waiting their turn don't hold files open
+                if key is not None and self.cache.has(key):
+                    yield file_name, 0, 0, None, None, key
+                    continue
+            else:
+                key = None
+
+            for offset, length, last in self.__chunks(file_name):
+                yield file_name, offset, length, offset == 0, last, key
+
+    def __chunks(self, file_name):
+        size = os.path.getsize(file_name)
+        offset = 0
+
+        while True:
+            length = min(self.chunk_size, size - offset)
+            last = offset + length >= size
+            yield offset, length, last
+
+            if last:
+                break
+
+            offset += length
+
+    def __write_next(self, in_flight):
+        task, future = in_flight.popleft()
+        file_name, offset, length, first, last, cached = task
+
+        if first is None and cached is not None:
+            entry = self.cache.get(cached)
+
+            if entry is not None:
+                with entry:
+                    entry_cache.write_entry(self.zip_file, file_name, entry)
+
+                logger.debug('Adding from cache: %s', file_name)
+                self.hits += 1
+                self.hit_bytes += entry.file_size
+            else:
+                # Evicted since it was found, so compressed here in the same chunks to give the same bytes
+                self.__compress_into_cache(file_name, cached)
+            return length
+
+        if first is None:
+            logger.debug('Adding: %s', file_name)
+            self.zip_file.write(file_name, compress_type=ZIP_STORED)
+            return length
+
+        try:
+            compressed, crc, read_length = future.result()
+
+            if first:
+                logger.debug('Adding: %s', file_name)
+                if cached is not None:
+                    self.__cache_writer = self.cache.open_entry(cached, ZIP_DEFLATED)
+
+                self.__start_entry(file_name, compressed, crc, read_length, last)
+            else:
+                self.__continue_entry(compressed, crc, read_length)
+
+            if last:
+                self.__finish_entry()
+
+        except Exception as e:
+            if self.__cache_writer is not None:
+                self.__cache_writer.discard()
+                self.__cache_writer = None
+
+            logger.error('Error while adding file to the archive: %s - %s', file_name, e)
+            raise
+
+        return length
+
+    def __compress_into_cache(self, file_name, key):
+        logger.debug('Adding: %s', file_name)
+
+        writer = self.cache.open_entry(key, ZIP_DEFLATED)
+        crc = 0
+        file_size = 0
+
+        try:
+            for offset, length, last in self.__chunks(file_name):
+                compressed, chunk_crc, read_length = _compress_chunk(file_name, offset, length, self.level, last)
+                writer.write(compressed)
+                crc = crc32_combine(crc, chunk_crc, read_length)
+                file_size += read_length
+        except Exception:
+            writer.discard()
+            raise
+
+        writer.commit(crc, file_size, self.zip_file, file_name)
+
+    def __start_entry(self, file_name, compressed, crc, length, last):
+        if self.__cache_writer is not None:
+            # Written to the archive from the cache once complete, so the header never needs a data descriptor
+            self.__cache_writer.write(compressed)
+            self.__entry = (file_name, crc, length)
+            return
+
+        zinfo = ZipInfo.from_file(file_name)
+        zinfo.compress_type = ZIP_DEFLATED
+
+        if last:
+            # The whole file fitted in one chunk, so the header can be written complete
+            zinfo.CRC = crc
+            zinfo.compress_size = len(compressed)
+            zinfo.file_size = length
+            zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+        else:
+            # The CRC and sizes are only known once every chunk is in, so they follow in a data descriptor
+            zinfo.flag_bits |= USE_DATA_DESCRIPTOR
+            zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+
+        if zip64 and not self.zip_file._allowZip64:
+            raise LargeZipFile('Filesize would require ZIP64 extensions')
+
+        # _writecheck reads the header offset when ZIP64 is not allowed
+        zinfo.header_offset = self.zip_file.fp.tell()
+
+        self.zip_file._writecheck(zinfo)
+        self.zip_file._didModify = True
+
+        self.zip_file.fp.write(zinfo.FileHeader(zip64))
+        self.zip_file.fp.write(compressed)
+
+        zinfo.CRC = crc
+        zinfo.compress_size = len(compressed)
+        zinfo.file_size = length
+
+        self.__entry = (zinfo, zip64)
+
+    def __continue_entry(self, compressed, crc, length):
+        if self.__cache_writer is not None:
+            file_name, entry_crc, entry_length = self.__entry
+            self.__cache_writer.write(compressed)
+            self.__entry = (file_name, crc32_combine(entry_crc, crc, length), entry_length + length)
+            return
+
+        zinfo, zip64 = self.__entry
+
+        self.zip_file.fp.write(compressed)
+
+        zinfo.CRC = crc32_combine(zinfo.CRC, crc, length)
+        zinfo.compress_size += len(compressed)
+        zinfo.file_size += length
+
+    def __finish_entry(self):
+        if self.__cache_writer is not None:
+            file_name, crc, length = self.__entry
+
+            cache_writer, self.__cache_writer = self.__cache_writer, None
+            self.__entry = None
+
+            cache_writer.commit(crc, length, self.zip_file, file_name)
+            return
+
+        zinfo, zip64 = self.__entry
+
+        if zinfo.flag_bits & USE_DATA_DESCRIPTOR:
+            if not zip64 and (zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT):
+                raise RuntimeError('File %s grew past the ZIP64 limit while being compressed' % zinfo.filename)
+
+            fmt = '<LLQQ' if zip64 else '<LLLL'
+            self.zip_file.fp.write(struct.pack(fmt, DD_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+
+        self.zip_file.filelist.append(zinfo)
+        self.zip_file.NameToInfo[zinfo.filename] = zinfo
+        self.zip_file.start_dir = self.zip_file.fp.tell()
+
+        self.__entry = None
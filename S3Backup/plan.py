@@ -23,17 +23,55 @@ SOFTWARE.
 """
 import sys
 
-import boto3
-import glob2
+import itertools
 import logging
 import os
-import subprocess
-from zipfile import ZipFile
+import tarfile
+import zlib
+from zipfile import ZipFile, ZIP_STORED
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from S3Backup import command
+from S3Backup import compression
+from S3Backup import dedup
+from S3Backup import encryption
+from S3Backup import entry_cache
 from S3Backup import hash_file
+from S3Backup import manifest
+from S3Backup import metrics
+from S3Backup import retention
+from S3Backup import s3_util
+from S3Backup import schedule
+from S3Backup import state_store
+from S3Backup import transfer
+from S3Backup import volumes
+from S3Backup import walker
+from S3Backup.parallel_zip import ParallelZipWriter
+
+# boto3 raises the part size past this many parts, which changes the ETag of uploaded files
+MAX_UPLOAD_PARTS = 10000
+
+# Plan state recording an upload which has not completed yet
+PENDING_UPLOAD_KEY = 'pending_upload'
+
+# Plan state recording when the hash was last checked against the newest backup in S3
+REMOTE_CHECKED_KEY = 'remote_checked'
+
+# Plan state recording the hash of each volume of the last backup, when it was split into volumes
+VOLUME_HASHES_KEY = 'volume_hashes'
+
+CHANGE_DETECTION_MODES = ['local', 'remote']
 
 required_plan_values = ['Name', 'Src', 'OutputPrefix']
-optional_plan_values = ['Command', 'PreviousBackupsCount', 'Zip64']
+optional_plan_values = ['Command', 'StreamCommand', 'StreamCommandEntry', 'PreviousBackupsCount', 'Zip64', 'Streaming',
+                        'StreamPartSize', 'Manifest', 'ManifestContentHash', 'CpuWeight', 'IoWeight',
+                        'CompressionWorkers', 'CompressionMemoryLimit',
+                        'StorageMode', 'DedupChunkSize', 'HashAlgorithm', 'VerifyUpload',
+                        'Transfer', 'Retention', 'Exclude', 'IncludeHidden', 'WalkerThreads', 'Compression',
+                        'StaleUploadHours', 'ChangeDetection', 'ChangeDetectionCacheMinutes', 'Schedule',
+                        'VolumeSizeMB', 'VolumeMaxEntries', 'VolumeUploads', 'Encryption']
 
 logger = logging.getLogger(name='Plan')
 
@@ -44,6 +82,10 @@ class Plan:
         failed = False
 
         for required_value in required_plan_values:
+            # The output of a stream command can be all there is to back up
+            if required_value == 'Src' and 'StreamCommand' in raw_plan:
+                continue
+
             if required_value not in raw_plan:
                 failed = True
                 logger.error('Missing plan configuration value: %s', required_value)
@@ -51,23 +93,210 @@ class Plan:
         self.CONFIGURATION = configuration
 
         self.name = raw_plan['Name']
-        self.src = raw_plan['Src']
         self.command = None
 
+        if 'Src' in raw_plan:
+            self.src = raw_plan['Src']
+        else:
+            self.src = None
+
+        if 'StreamCommand' in raw_plan:
+            self.stream_command = raw_plan['StreamCommand']
+        else:
+            self.stream_command = None
+
+        if 'StreamCommandEntry' in raw_plan:
+            self.stream_command_entry = raw_plan['StreamCommandEntry']
+        else:
+            self.stream_command_entry = '%s.out' % self.name
+
+        if 'Exclude' in raw_plan:
+            self.exclude = raw_plan['Exclude'] if isinstance(raw_plan['Exclude'], list) else [raw_plan['Exclude']]
+        else:
+            self.exclude = []
+
+        if 'IncludeHidden' in raw_plan:
+            self.include_hidden = bool(raw_plan['IncludeHidden'])
+        else:
+            self.include_hidden = False
+
+        if 'WalkerThreads' in raw_plan:
+            self.walker_threads = max(1, int(raw_plan['WalkerThreads']))
+        else:
+            self.walker_threads = walker.DEFAULT_THREADS
+
         if 'PreviousBackupsCount' in raw_plan:
             self.previous_backups_count = int(raw_plan['PreviousBackupsCount'])
         else:
             self.previous_backups_count = 1
 
+        # The current backup is always kept on top of the previous ones, as pruning runs after it is uploaded
+        if 'Retention' in raw_plan:
+            self.retention = retention.RetentionPolicy(raw_plan['Retention'], self.previous_backups_count + 1)
+        else:
+            self.retention = retention.RetentionPolicy(None, self.previous_backups_count + 1)
+
         if 'Zip64' in raw_plan:
             self.zip64 = bool(raw_plan['Zip64'])
         else:
             self.zip64 = True
 
+        if 'Streaming' in raw_plan:
+            self.streaming = bool(raw_plan['Streaming'])
+        else:
+            self.streaming = False
+
+        # Transfer settings given for the plan override those from the root of the configuration
+        if 'Transfer' in raw_plan:
+            self.transfer_settings = transfer.transfer_settings(configuration['TRANSFER'], raw_plan['Transfer'])
+        else:
+            self.transfer_settings = transfer.transfer_settings(configuration['TRANSFER'])
+
+        if 'StreamPartSize' in raw_plan:
+            self.stream_part_size = int(raw_plan['StreamPartSize']) * 1024 * 1024
+        else:
+            self.stream_part_size = int(self.transfer_settings['PartSize']) * 1024 * 1024
+
+        if 'Manifest' in raw_plan:
+            self.manifest = bool(raw_plan['Manifest'])
+        else:
+            self.manifest = False
+
+        if 'ManifestContentHash' in raw_plan:
+            self.manifest_content_hash = bool(raw_plan['ManifestContentHash'])
+        else:
+            self.manifest_content_hash = False
+
+        if 'CpuWeight' in raw_plan:
+            self.cpu_weight = max(0, int(raw_plan['CpuWeight']))
+        else:
+            self.cpu_weight = 1
+
+        if 'IoWeight' in raw_plan:
+            self.io_weight = max(0, int(raw_plan['IoWeight']))
+        else:
+            self.io_weight = 1
+
+        if 'CompressionWorkers' in raw_plan:
+            self.compression_workers = max(1, int(raw_plan['CompressionWorkers']))
+        else:
+            self.compression_workers = 1
+
+        if 'CompressionMemoryLimit' in raw_plan:
+            self.compression_memory_limit = int(raw_plan['CompressionMemoryLimit']) * 1024 * 1024
+        else:
+            self.compression_memory_limit = 256 * 1024 * 1024
+
+        if 'Compression' in raw_plan:
+            self.compression = compression.compression_settings(raw_plan['Compression'], self.compression_workers)
+        else:
+            self.compression = compression.compression_settings(None, self.compression_workers)
+
+        if 'StorageMode' in raw_plan:
+            self.storage_mode = raw_plan['StorageMode']
+        else:
+            self.storage_mode = 'archive'
+
+        if self.storage_mode not in ['archive', 'dedup']:
+            failed = True
+            logger.error('Unknown storage mode for plan: %s', self.storage_mode)
+
+        # Tar headers and dedup chunk lists both need the size of a file before it is stored
+        if self.stream_command is not None and (self.storage_mode != 'archive' or
+                                                self.compression['Format'] != 'zip'):
+            failed = True
+            logger.error('StreamCommand can only be used by plans writing zip archives')
+
+        if 'VolumeSizeMB' in raw_plan:
+            self.volume_size = int(raw_plan['VolumeSizeMB']) * 1024 * 1024
+        else:
+            self.volume_size = None
+
+        if 'VolumeMaxEntries' in raw_plan:
+            self.volume_max_entries = max(1, int(raw_plan['VolumeMaxEntries']))
+        else:
+            self.volume_max_entries = None
+
+        if 'VolumeUploads' in raw_plan:
+            self.volume_uploads = max(1, int(raw_plan['VolumeUploads']))
+        else:
+            self.volume_uploads = volumes.DEFAULT_UPLOAD_THREADS
+
+        self.split_volumes = self.volume_size is not None or self.volume_max_entries is not None
+
+        # Volumes are uploaded as they are written, so there is nothing for streaming to add
+        if self.split_volumes and (self.storage_mode != 'archive' or self.streaming):
+            failed = True
+            logger.error('Volumes can only be used by plans writing archives, without Streaming')
+
+        if 'Encryption' in raw_plan:
+            try:
+                self.encryption = encryption.Encryption(raw_plan['Encryption'])
+            except Exception as e:
+                failed = True
+                self.encryption = None
+                logger.error('Invalid encryption for plan: %s', e)
+        else:
+            self.encryption = None
+
+        # Dedup chunks are stored (and shared between snapshots) one by one rather than as an archive
+        if self.encryption is not None and self.storage_mode != 'archive':
+            failed = True
+            logger.error('Encryption can only be used by plans writing archives')
+
+        if 'DedupChunkSize' in raw_plan:
+            self.dedup_chunk_size = int(raw_plan['DedupChunkSize']) * 1024
+        else:
+            self.dedup_chunk_size = 1024 * 1024
+
+        if 'HashAlgorithm' in raw_plan:
+            self.hash_algorithm = raw_plan['HashAlgorithm']
+        else:
+            self.hash_algorithm = hash_file.DEFAULT_ALGORITHM
+
+        if self.hash_algorithm not in hash_file.ALGORITHMS:
+            failed = True
+            logger.error('Unknown hash algorithm for plan: %s', self.hash_algorithm)
+
+        if 'VerifyUpload' in raw_plan:
+            self.verify_upload = bool(raw_plan['VerifyUpload'])
+        else:
+            self.verify_upload = False
+
+        if 'StaleUploadHours' in raw_plan:
+            self.stale_upload_hours = float(raw_plan['StaleUploadHours'])
+        else:
+            self.stale_upload_hours = 24
+
+        if 'ChangeDetection' in raw_plan:
+            self.change_detection = raw_plan['ChangeDetection']
+        else:
+            self.change_detection = 'local'
+
+        if self.change_detection not in CHANGE_DETECTION_MODES:
+            failed = True
+            logger.error('Unknown change detection mode for plan: %s', self.change_detection)
+
+        if 'ChangeDetectionCacheMinutes' in raw_plan:
+            self.change_detection_cache = float(raw_plan['ChangeDetectionCacheMinutes']) * 60
+        else:
+            self.change_detection_cache = 60 * 60
+
         self.output_file_prefix = raw_plan['OutputPrefix']
-        self.output_file = '%s_%s.zip' % (raw_plan['OutputPrefix'], time.strftime("%Y-%m-%d_%H-%M-%S"))
 
-        self.new_hash = None
+        if 'Schedule' in raw_plan:
+            try:
+                self.schedule = schedule.CronSchedule(raw_plan['Schedule'])
+            except Exception as e:
+                failed = True
+                logger.error('Invalid schedule for plan: %s', e)
+        else:
+            self.schedule = None
+
+        self.run_started = None
+        self.metrics = None
+        self.directory_cache = None
+        self.__reset()
 
         if 'Command' in raw_plan:
             self.command = raw_plan['Command']
@@ -75,6 +304,35 @@ class Plan:
         if failed:
             raise Exception('Missing keys from data. See log for details.')
 
+    def __reset(self):
+        """
+            Start the state of a run afresh, naming the backup after the current time, so a plan kept between
+            runs (as the daemon does) uploads a new backup each time
+        """
+        if self.storage_mode == 'dedup':
+            self.output_file = dedup.snapshot_key(self.output_file_prefix, time.strftime("%Y-%m-%d_%H-%M-%S"))
+        elif self.split_volumes:
+            # The backup is known by its index, which is uploaded once all of its volumes are
+            self.output_file = '%s_%s%s' % (self.output_file_prefix,
+                                            time.strftime("%Y-%m-%d_%H-%M-%S"),
+                                            volumes.INDEX_SUFFIX)
+        else:
+            self.output_file = '%s_%s%s' % (self.output_file_prefix,
+                                            time.strftime("%Y-%m-%d_%H-%M-%S"),
+                                            self.__extension())
+
+        self.new_hash = None
+        self.expected_etag = None
+        self.upload_size = None
+        self.new_manifest = None
+        self.dedup_store = None
+        self.staged_file = os.path.abspath(self.output_file)
+        self.keep_staged = False
+        self.resumed = False
+        self.previous_hash = None
+        self.previous_hash_found = False
+        self.volume_hashes = None
+
     def run(self):
         """
             The plan is run in the following order:
@@ -82,126 +340,642 @@ class Plan:
                 2) Zip source file(s) to destination file
                 3) Perform hash check to see if there are any changes (which would require an upload)
                 4) Upload destination file to S3 bucket
-                5) Update hash file with new hash
+                5) Update the plan state with the new hash
                 6) Check if any previous backups need removing
+
+            When streaming, steps 2 - 4 happen together: the zip is written straight into a multipart
+            upload while it is hashed, and the upload is aborted if the hash shows nothing changed.
+
+            In dedup storage mode steps 2 - 4 are replaced by chunking the source files, uploading only the
+            chunks not already in S3 and then uploading a snapshot index if it differs from the last one.
+
+            When split into volumes, steps 2 - 4 also happen together: each volume is uploaded while the next is
+            written, and the volumes are removed again if the hash of them all shows nothing changed.
+
+            When a manifest is kept, the source files are first compared against the sizes, modification
+            times and inodes recorded at the last upload, and steps 2 - 5 are skipped if nothing changed.
+
+            If the upload of the previous run was interrupted, steps 1 - 3 are skipped and the archive it left
+            behind is uploaded instead, sending only the parts which did not make it the first time.
+
+            Each step is timed as a phase of the run in self.metrics, along with the files and bytes it read,
+            compressed and uploaded and the S3 requests it made.
         """
         logger.info('Running plan "%s"', self.name)
 
-        # 1) (if applicable) Run the external command provided
-        if self.command is not None:
-            self.__run_command()
+        self.__reset()
+        self.run_started = time.time()
+        self.metrics = metrics.PlanMetrics(self.name)
+
+        self.__engine().track(self.output_file_prefix, self.metrics)
 
-        # 2) Zip the source file to the destination file
-        self.__zip_files()
+        try:
+            updated = self.__run_phases()
+        except Exception as e:
+            self.metrics.finish('failed', error=e)
+            raise
+        finally:
+            self.__engine().untrack(self.output_file_prefix)
+
+        self.metrics.finish('success', updated, self.output_file)
 
+        return updated, self.output_file
+
+    def __run_phases(self):
         updated = False
 
-        try:
-            # 3) Perform hash check to see if there are any changes (which would require an upload)
-            if not self.__hash_check():
-                # 4) Upload destination file to S3 bucket
-                self.__upload()
+        if self.__resume_pending_upload():
+            try:
+                with self.metrics.phase('update_state'):
+                    self.__update_state(True)
 
-                # 5) Update hash file with new hash
-                self.__update_hash()
+                with self.metrics.phase('prune'):
+                    self.__clear_old_backups()
+                    self.__abort_stale_uploads()
+            finally:
+                self.__cleanup()
 
-                updated = True
+            return True
+
+        # 1) (if applicable) Run the external command provided
+        if self.command is not None:
+            with self.metrics.phase('command'):
+                self.__run_command()
+
+        file_list = None
+
+        try:
+            fileset = self.__get_fileset()
+
+            if self.manifest:
+                with self.metrics.phase('manifest_check'):
+                    # The file set is needed twice, to check the manifest and then to back up. Plans large enough
+                    # to need volumes keep it on disk rather than in memory.
+                    if self.split_volumes:
+                        fileset = file_list = volumes.FileList(fileset, os.path.dirname(self.__manifest_file()))
+                    else:
+                        fileset = list(fileset)
+                    # The output of a stream command is only known by running it, so can't be in the manifest
+                    unchanged = self.__manifest_check(fileset) and self.stream_command is None
+            else:
+                unchanged = False
+
+            if unchanged:
+                logger.info('No source files have changed since the last upload, skipping zip and upload')
+            else:
+                if self.storage_mode == 'dedup':
+                    # 2 - 4) Upload new chunks, then the snapshot index if anything changed
+                    with self.metrics.phase('dedup'):
+                        updated = self.__dedup_backup(fileset)
+                elif self.split_volumes:
+                    # 2 - 4) Write the archive in volumes, uploading each while the next is written
+                    with self.metrics.phase('volumes'):
+                        updated = self.__volume_backup(fileset)
+                elif self.streaming:
+                    # 2 - 4) Zip the source files straight into S3, checking the hash before completing
+                    with self.metrics.phase('stream'):
+                        updated = self.__stream_upload(fileset)
+                else:
+                    # 2) Zip the source file to the destination file
+                    with self.metrics.phase('archive'):
+                        self.__zip_files(fileset)
+
+                    # 3) Perform hash check to see if there are any changes (which would require an upload)
+                    with self.metrics.phase('hash_check'):
+                        unchanged = self.__hash_check()
+
+                    if not unchanged:
+                        # 4) Upload destination file to S3 bucket
+                        with self.metrics.phase('upload'):
+                            self.__upload()
+
+                        updated = True
+
+                # 5) Update the plan state with the new hash
+                with self.metrics.phase('update_state'):
+                    self.__update_state(updated)
 
             # 6) Remove any previous backups if required
-            self.__clear_old_backups()
+            with self.metrics.phase('prune'):
+                self.__clear_old_backups()
+                self.__abort_stale_uploads()
 
         finally:
+            if file_list is not None:
+                file_list.close()
+
+            # Only left if the run didn't get as far as saving it
+            if self.new_manifest is not None:
+                manifest.discard_manifest(self.new_manifest)
+
             self.__cleanup()
 
-        return updated, self.output_file
+        return updated
+
+    def dry_run(self):
+        """
+            The files a run would back up now, with their sizes, found with stat calls alone: no command is run,
+            and nothing is read, written or sent to S3. What a Command or StreamCommand would produce can't be
+            known without running it.
+        """
+        files = []
+
+        for file_name in self.__get_fileset():
+            if not os.path.isdir(file_name):
+                files.append((file_name, os.path.getsize(file_name)))
+
+        return files
 
     def __run_command(self):
         logger.info('Executing custom command...')
 
-        try:
-            command_path = self.command
+        # stderr is kept for the failure email, stdout is discarded as before
+        command.run_command(command.command_path(self.command))
+
+    def __get_fileset(self):
+        """
+            The source files are produced lazily as the source directories are walked, rather than all being
+            found up front
+        """
+        if self.src is None:
+            return iter([])
 
-            if self.command[0] is not '/':
-                command_path = os.path.join(sys.path[0], self.command)
+        src_paths = self.src if isinstance(self.src, list) else [self.src]
+        patterns = []
 
-            logger.info('Executing %s', command_path)
+        for src_path in src_paths:
+            normalized_src = os.path.normpath(src_path)
+            if not os.path.isabs(normalized_src):
+                normalized_src = os.path.normpath(os.path.join(sys.path[0], src_path))
 
-            fnull = open(os.devnull, "w")
-            retcode = subprocess.call(command_path, shell=True, stdout=fnull, stderr=subprocess.STDOUT)
+            patterns.append(normalized_src)
 
-            logger.info('Process returned code %d', retcode)
+        fileset = iter(walker.Walker(patterns, self.exclude, self.include_hidden, self.walker_threads,
+                                     self.directory_cache))
 
-            if retcode != 0:
-                raise Exception('Failed with code %d' % retcode)
+        # Check there are files in the file set
+        first = next(fileset, None)
+        if first is None:
+            raise Exception('No input files retrieved from pattern: %s' % self.src)
 
-        except subprocess.CalledProcessError as e:
-            logger.error('Failed with code %d : %s', e.returncode, e.output)
-            raise
+        return itertools.chain([first], fileset)
+
+    def __zip_files(self, fileset):
+        logger.info('Outputting to %s', self.output_file)
+
+        # The hash (and ETag) are calculated as the zip is written, rather than reading it back afterwards
+        part_size = self.__engine().part_size(self.transfer_settings)
+
+        with open(self.staged_file, 'wb') as output, \
+                self.__archive_output(output, part_size if self.verify_upload else None) as (writer, uploaded):
+            self.__write_archive(writer, fileset)
+
+        self.new_hash = writer.hash_value()
+        self.metrics.add('bytes_compressed', uploaded.tell())
+
+        if self.verify_upload:
+            if uploaded.tell() > part_size * MAX_UPLOAD_PARTS:
+                # boto3 raises the part size for files this large, so the ETag can't be predicted
+                logger.warning('Output file is too large to verify its ETag after upload')
+            else:
+                self.expected_etag = uploaded.etag(multipart=uploaded.tell() >= part_size)
+
+        logger.info('Output file created')
+
+    def __extension(self):
+        extension = compression.FORMATS[self.compression['Format']]
+
+        if self.encryption is not None:
+            extension += encryption.ENCRYPTED_SUFFIX
+
+        return extension
+
+    @contextmanager
+    def __archive_output(self, output, etag_part_size):
+        """
+            Gives (writer, uploaded) for writing an archive to the output. The writer hashes the archive as it
+            is written, then for an encrypted plan it is encrypted on its way to the output, a segment at a time.
+            uploaded sees what is written to the output, so gives its size and ETag.
+        """
+        if self.encryption is None:
+            writer = hash_file.HashingWriter(output, self.hash_algorithm, etag_part_size)
+            yield writer, writer
+            return
 
-    def __zip_files(self):
-        fileset = []
+        # The hash is of the archive before it is encrypted (with a new data key each time), or it would never
+        # match the last one
+        uploaded = hash_file.HashingWriter(output, None, etag_part_size)
+        encryptor = encryption.EncryptingWriter(uploaded, self.encryption)
 
-        if isinstance(self.src, list):
-            for src_path in self.src:
-                normalized_src = os.path.normpath(src_path)
-                if src_path[0] is not '/':
-                    normalized_src = os.path.normpath(os.path.join(sys.path[0], src_path))
+        yield hash_file.HashingWriter(encryptor, self.hash_algorithm, hash_key=self.encryption.hash_key), uploaded
 
-                for filename in glob2.glob(normalized_src):
-                    fileset.append(filename)
+        encryptor.finish()
+
+    def __write_archive(self, output, fileset, with_command=True):
+        if self.compression['Format'] == 'tar.zst':
+            self.__write_tar(output, fileset)
         else:
-            normalized_src = os.path.normpath(self.src)
-            if self.src[0] is not '/':
-                normalized_src = os.path.join(sys.path[0], self.src)
+            self.__write_zip(output, fileset, with_command)
 
-            for filename in glob2.glob(normalized_src):
-                fileset.append(filename)
+    def __write_zip(self, output, fileset, with_command=True):
+        codec = self.compression['Codec']
+        level = self.compression['Level']
 
-        # Check there are files in the file set
-        if len(fileset) == 0:
-            raise Exception('No input files retrieved from pattern: %s' % self.src)
+        # Media and archives are stored rather than spending CPU on squeezing nothing out of them
+        if self.compression['AutoStore'] and codec != 'store':
+            compress_check = compression.worth_compressing
+        else:
+            compress_check = None
+
+        with ZipFile(output, 'w', compression=compression.ZIP_CODECS[codec], allowZip64=self.zip64,
+                     compresslevel=level) as myzip:
+            if with_command and self.stream_command is not None:
+                self.__write_command_output(myzip)
+
+            # The sizes of the source files are already in the entries, so they are counted without another stat
+            first_entry = len(myzip.filelist)
+
+            # Entries are only worth caching if it took some work to compress them
+            cache = self.CONFIGURATION['ENTRY_CACHE'] if codec != 'store' else None
+
+            if self.compression_workers > 1 and codec == 'deflate':
+                writer = ParallelZipWriter(myzip,
+                                           self.compression_workers,
+                                           self.compression_memory_limit,
+                                           level=level if level is not None else zlib.Z_DEFAULT_COMPRESSION,
+                                           compress_check=compress_check,
+                                           cache=cache)
+                writer.write_files(fileset)
+                self.__log_cache_hits(writer)
+                self.metrics.count_files(info.file_size for info in myzip.filelist[first_entry:]
+                                         if not info.is_dir())
+                return
+
+            if self.compression_workers > 1:
+                logger.warning('Only deflate can be compressed in parallel, compressing with %s in one process',
+                               codec)
+
+            if cache is not None:
+                cached_writer = entry_cache.CachedZipWriter(myzip, cache, compression.ZIP_CODECS[codec], level)
+            else:
+                cached_writer = None
 
-        logger.info('Outputting to %s', self.output_file)
+            for file_name in fileset:
+                try:
+                    if compress_check is not None and not os.path.isdir(file_name) and not compress_check(file_name):
+                        logger.debug('Adding: %s', file_name)
+                        myzip.write(file_name, compress_type=ZIP_STORED)
+                    elif cached_writer is None or not cached_writer.write(file_name):
+                        logger.debug('Adding: %s', file_name)
+                        myzip.write(file_name)
+                except Exception as e:
+                    logger.error('Error while adding file to the archive: %s - %s', file_name, e)
+                    raise
+
+            if cached_writer is not None:
+                self.__log_cache_hits(cached_writer)
+
+            self.metrics.count_files(info.file_size for info in myzip.filelist[first_entry:] if not info.is_dir())
+
+    @staticmethod
+    def __log_cache_hits(writer):
+        if writer.cache is not None and writer.hits > 0:
+            logger.info('Copied %d unchanged entries (%s before compression) from the entry cache',
+                        writer.hits, metrics.format_size(writer.hit_bytes))
+
+    def __write_command_output(self, myzip):
+        """
+            Write the stdout of the stream command into an entry of the archive as it is produced, so a dump never
+            has to be written to the local disk and read back
+        """
+        logger.info('Streaming the output of %s into %s', self.stream_command, self.stream_command_entry)
+
+        # Unlike Command, this is a shell command line (such as a mysqldump) rather than a path to a script
+        with command.CommandStream(self.stream_command) as stream:
+            with myzip.open(self.stream_command_entry, 'w', force_zip64=self.zip64) as entry:
+                for data in iter(stream.read, b''):
+                    entry.write(data)
+                    self.metrics.add('bytes_read', len(data))
+
+        self.metrics.add('files')
 
-        with ZipFile(self.output_file, 'w', allowZip64=self.zip64) as myzip:
+        logger.info('Streamed %d bytes of command output', stream.bytes_read)
+
+    def __write_tar(self, output, fileset):
+        # zstd compresses data it can't shrink quickly, so every file goes through it
+        zstd_writer = compression.open_zstd_writer(output, self.compression['Level'], self.compression_workers)
+
+        with tarfile.open(fileobj=zstd_writer, mode='w|') as mytar:
             for file_name in fileset:
                 try:
                     logger.debug('Adding: %s', file_name)
-                    myzip.write(file_name)
+                    mytar.add(file_name, recursive=False)
                 except Exception as e:
                     logger.error('Error while adding file to the archive: %s - %s', file_name, e)
                     raise
 
-        logger.info('Output file created')
+            self.metrics.count_files(member.size for member in mytar.getmembers() if member.isfile())
+
+        zstd_writer.close()
+
+    def __stream_upload(self, fileset):
+        logger.info('Streaming to %s', self.output_file)
+
+        try:
+            stream = self.__engine().multipart_stream(self.output_file,
+                                                      self.transfer_settings,
+                                                      part_size=self.stream_part_size)
+
+        except Exception as e:
+            logger.error('Failed to start streaming upload to S3: %s', e)
+            raise
+
+        try:
+            with self.__archive_output(stream, self.stream_part_size if self.verify_upload else None) as \
+                    (writer, uploaded):
+                self.__write_archive(writer, fileset)
+        except Exception:
+            stream.abort()
+            raise
+
+        previous_hash = self.__previous_hash()
+        self.new_hash = writer.hash_value()
+        self.metrics.add('bytes_compressed', uploaded.tell())
+
+        logger.debug('New hash for plan %s of %s', self.name, self.new_hash)
+
+        if previous_hash == self.new_hash:
+            logger.info('Backup set has not changed, discarding streamed upload')
+            stream.abort()
+            return False
+
+        try:
+            stream.complete()
+        except Exception as e:
+            logger.error('Failed to upload backup file to S3: %s', e)
+            raise
+
+        try:
+            # The hash wasn't known when the upload was started, so can't be in its metadata
+            s3_util.tag_hash(self.__engine().client('s3', self.transfer_settings),
+                             self.CONFIGURATION['AWS_BUCKET'],
+                             self.output_file,
+                             self.new_hash)
+        except Exception as e:
+            logger.warning('Failed to tag %s with its hash: %s', self.output_file, e)
+
+        self.upload_size = stream.tell()
+        self.metrics.add('bytes_uploaded', self.upload_size)
+
+        if self.verify_upload:
+            self.expected_etag = uploaded.etag(multipart=True)
+            self.__verify_upload(self.output_file, self.expected_etag)
+
+        return True
+
+    def __volume_backup(self, fileset):
+        base_key = self.output_file[:-len(volumes.INDEX_SUFFIX)]
+        extension = self.__extension()
+        part_size = self.__engine().part_size(self.transfer_settings)
+
+        previous_hash = self.__previous_hash()
+
+        # Volumes matching the last backup are held back until one doesn't, so an unchanged backup isn't sent
+        if previous_hash is not None:
+            previous_hashes = self.CONFIGURATION['STATE'].get_value(self.name, VOLUME_HASHES_KEY)
+        else:
+            previous_hashes = None
+
+        uploads = volumes.VolumeUploads(self.__upload_volume, self.__copy_volume, self.__delete_volumes,
+                                        previous_hashes=previous_hashes,
+                                        previous_keys=lambda: self.__previous_volume_keys(previous_hashes),
+                                        threads=self.volume_uploads)
 
-    def __clear_old_backups(self):
         try:
-            s3_client = boto3.client(
-                's3',
-                region_name=self.CONFIGURATION['AWS_REGION'],
-                aws_access_key_id=self.CONFIGURATION['AWS_KEY'],
-                aws_secret_access_key=self.CONFIGURATION['AWS_SECRET']
-            )
+            for number, volume_files in enumerate(volumes.split_volumes(fileset,
+                                                                        self.volume_size,
+                                                                        self.volume_max_entries), 1):
+                key = volumes.volume_key(base_key, number, extension)
+                staged_file = os.path.abspath(key)
+
+                logger.info('Outputting volume %d to %s', number, key)
+
+                # A volume being written is deleted by the uploads once it is added, or here if writing fails
+                try:
+                    with open(staged_file, 'wb') as output, \
+                            self.__archive_output(output, part_size if self.verify_upload else None) as \
+                            (writer, uploaded):
+                        self.__write_archive(writer, volume_files, with_command=number == 1)
+                except Exception:
+                    if os.path.isfile(staged_file):
+                        os.remove(staged_file)
+                    raise
+
+                self.metrics.add('bytes_compressed', uploaded.tell())
+
+                if self.verify_upload and uploaded.tell() <= part_size * MAX_UPLOAD_PARTS:
+                    expected_etag = uploaded.etag(multipart=uploaded.tell() >= part_size)
+                else:
+                    expected_etag = None
 
-            backup_keys = []
+                uploads.add(staged_file, key, writer.hash_value(), uploaded.tell(), expected_etag)
 
-            for key in s3_client.list_objects(Bucket=self.CONFIGURATION['AWS_BUCKET'],
-                                              Prefix=self.output_file_prefix)['Contents']:
-                backup_keys.append(key['Key'])
+            self.volume_hashes = [volume['hash'] for volume in uploads.volumes]
+            self.new_hash = volumes.combined_hash(self.volume_hashes, self.hash_algorithm)
 
-            backup_keys.sort()
+            logger.debug('New hash for plan %s of %s', self.name, self.new_hash)
 
-            logger.info('There are %d previous backups', len(backup_keys))
+            if previous_hash == self.new_hash:
+                logger.info('Backup set has not changed, discarding %d volumes', len(uploads.volumes))
+                uploads.discard()
+                return False
 
-            max_backups = self.previous_backups_count + 1  # Because this is run after current backup uploaded
+            uploads.finish()
 
-            if len(backup_keys) > max_backups:
-                backups_to_remove = len(backup_keys) - max_backups
-                logger.info('Removing %d previous backups', backups_to_remove)
+            index = {'version': volumes.INDEX_VERSION,
+                     'format': self.compression['Format'],
+                     'hash': self.new_hash,
+                     'volumes': uploads.volumes}
 
-                for i in range(backups_to_remove):
-                    logger.info('Removing previous backup: %s', backup_keys[i])
-                    s3_client.delete_object(Bucket=self.CONFIGURATION['AWS_BUCKET'], Key=backup_keys[i])
+            volumes.upload_index(self.__engine().client('s3', self.transfer_settings),
+                                 self.CONFIGURATION['AWS_BUCKET'],
+                                 self.output_file,
+                                 index,
+                                 s3_util.hash_metadata(self.new_hash))
+
+        except Exception:
+            uploads.discard()
+            raise
+
+        self.upload_size = sum(volume['size'] for volume in uploads.volumes)
+
+        return True
+
+    def __upload_volume(self, staged_file, key, hash_value, expected_etag):
+        # Each volume carries its own hash, so it can be checked on its own
+        size = self.__engine().upload_file(staged_file,
+                                           key,
+                                           self.transfer_settings,
+                                           {'Metadata': s3_util.hash_metadata(hash_value)})
+        self.metrics.add('bytes_uploaded', size)
+
+        if expected_etag is not None:
+            self.__verify_upload(key, expected_etag)
+
+    def __copy_volume(self, source_key, key, hash_value):
+        self.__engine().copy(source_key, key, self.transfer_settings, {'Metadata': s3_util.hash_metadata(hash_value)})
+
+    def __previous_volume_keys(self, previous_hashes):
+        """
+            The keys of the volumes of the newest backup in S3, which has to be the one the volume hashes in the
+            plan state are from
+        """
+        s3_client = self.__engine().client('s3', self.transfer_settings)
+
+        grouped = retention.group_backups(s3_util.list_keys(s3_client,
+                                                            self.CONFIGURATION['AWS_BUCKET'],
+                                                            self.output_file_prefix + '_'),
+                                          self.output_file_prefix)
+        indexes = [volumes.backup_key(keys) for timestamp, keys in grouped.items()]
+        indexes = [key for key in indexes if key is not None and volumes.is_index(key) and key != self.output_file]
+
+        previous = volumes.load_index(s3_client, self.CONFIGURATION['AWS_BUCKET'], indexes[-1])['volumes'] \
+            if len(indexes) > 0 else []
+
+        if [volume['hash'] for volume in previous] != previous_hashes:
+            # Held volumes are already deleted, so this run can't finish. Without the hashes, the next run uploads
+            # every volume rather than holding any back.
+            self.CONFIGURATION['STATE'].update(self.name, {VOLUME_HASHES_KEY: None})
+            raise Exception('The newest backup in S3 does not match the volume hashes in the plan state, so '
+                            'unchanged volumes can\'t be copied from it')
+
+        return [volume['key'] for volume in previous]
+
+    def __delete_volumes(self, keys):
+        s3_util.delete_keys(self.__engine().client('s3', self.transfer_settings),
+                            self.CONFIGURATION['AWS_BUCKET'],
+                            keys,
+                            int(self.transfer_settings['MaxConcurrency']))
+
+    def __dedup_backup(self, fileset):
+        store = self.__get_dedup_store()
+
+        index_file = self.__manifest_file('snapshot.json.gz')
+        previous_index = dedup.load_index(index_file)
+
+        if previous_index is None:
+            snapshots = store.list_snapshots()
+            if len(snapshots) > 0:
+                logger.debug('Using previous snapshot %s from S3', snapshots[-1])
+                previous_index = store.load_snapshot(snapshots[-1])
+
+        index = store.backup(fileset, previous_index)
+        self.metrics.count_files(entry['size'] for entry in index['files'])
+
+        previous_hash = self.__previous_hash()
+        self.new_hash = dedup.index_hash(index, self.hash_algorithm)
+
+        logger.debug('New hash for plan %s of %s', self.name, self.new_hash)
+
+        if previous_hash == self.new_hash:
+            logger.info('Backup set has not changed, no new snapshot uploaded')
+        else:
+            try:
+                store.upload_snapshot(self.output_file, index, s3_util.hash_metadata(self.new_hash))
+            except Exception as e:
+                logger.error('Failed to upload snapshot to S3: %s', e)
+                raise
+
+            self.upload_size = store.uploaded_bytes
+
+        # New chunks are uploaded whether or not there is a new snapshot
+        self.metrics.add('bytes_uploaded', store.uploaded_bytes)
+
+        dedup.save_index(index_file, index)
+
+        return previous_hash != self.new_hash
+
+    def __get_dedup_store(self):
+        if self.dedup_store is None:
+            engine = self.__engine()
+
+            self.dedup_store = dedup.DedupStore(engine.client('s3', self.transfer_settings),
+                                                self.CONFIGURATION['AWS_BUCKET'],
+                                                self.output_file_prefix,
+                                                self.dedup_chunk_size,
+                                                upload_threads=int(self.transfer_settings['MaxConcurrency']),
+                                                throttle=engine.throttle(self.transfer_settings))
+
+        return self.dedup_store
+
+    def prune(self):
+        """
+            Remove the previous backups the retention rules no longer keep, and abandoned uploads, without
+            backing anything up
+        """
+        try:
+            self.__clear_old_backups()
+            self.__abort_stale_uploads()
+        finally:
+            self.dedup_store = None
+
+    def expired_backups(self):
+        """
+            The previous backups which would be removed now, as the keys of each by timestamp, oldest first.
+            Nothing is removed.
+        """
+        if self.storage_mode == 'dedup':
+            backups = self.__get_dedup_store().snapshots()
+            incomplete = []
+        else:
+            s3_client = self.__engine().client('s3', self.transfer_settings)
+
+            backups = retention.group_backups(s3_util.list_keys(s3_client,
+                                                                self.CONFIGURATION['AWS_BUCKET'],
+                                                                self.output_file_prefix + '_'),
+                                              self.output_file_prefix)
+
+            # Volumes without an index are from a run which never finished. They don't count as a backup, and
+            # are removed once they are too old to be from a run still going.
+            incomplete = [timestamp for timestamp, keys in backups.items() if volumes.incomplete(keys)]
+
+        cutoff = datetime.now() - timedelta(hours=self.stale_upload_hours)
+
+        logger.info('There are %d previous backups', len(backups) - len(incomplete))
+
+        expired = self.retention.to_remove([timestamp for timestamp in backups if timestamp not in incomplete])
+        expired += [timestamp for timestamp in incomplete if timestamp < cutoff]
+
+        return OrderedDict((timestamp, backups[timestamp]) for timestamp in sorted(expired))
+
+    def __clear_old_backups(self):
+        concurrency = int(self.transfer_settings['MaxConcurrency'])
+
+        if self.storage_mode == 'dedup':
+            try:
+                self.__get_dedup_store().prune(self.retention, concurrency,
+                                               grace=timedelta(hours=self.stale_upload_hours))
+            except Exception as e:
+                logger.error('Failed to clear out previous snapshots from S3: %s', e)
+                raise
+            return
+
+        try:
+            expired = self.expired_backups()
+
+            if len(expired) > 0:
+                logger.info('Removing %d previous backups', len(expired))
+
+                keys = []
+                for timestamp, backup_keys in expired.items():
+                    for key in backup_keys:
+                        logger.info('Removing previous backup: %s', key)
+                        keys.append(key)
+
+                s3_util.delete_keys(self.__engine().client('s3', self.transfer_settings),
+                                    self.CONFIGURATION['AWS_BUCKET'],
+                                    keys,
+                                    concurrency)
             else:
                 logger.info('No previous backups require removal')
 
@@ -209,50 +983,243 @@ class Plan:
             logger.error('Failed to clear out previous backups from S3: %s', e)
             raise
 
-    def __upload(self):
-        try:
-            s3_client = boto3.client(
-                's3',
-                region_name=self.CONFIGURATION['AWS_REGION'],
-                aws_access_key_id=self.CONFIGURATION['AWS_KEY'],
-                aws_secret_access_key=self.CONFIGURATION['AWS_SECRET']
-            )
-
-            tc = boto3.s3.transfer.TransferConfig()
-            t = boto3.s3.transfer.S3Transfer(client=s3_client,
-                                             config=tc)
+    def __upload(self, previous_state=None):
+        def checkpoint(upload_state):
+            # Enough to pick the upload up again from the staged archive if this run never finishes
+            upload_state.update({'file': self.staged_file,
+                                 'hash': self.new_hash,
+                                 'expected_etag': self.expected_etag})
+            self.CONFIGURATION['STATE'].update(self.name, {PENDING_UPLOAD_KEY: upload_state})
+            self.keep_staged = True
 
-            t.upload_file(self.output_file, self.CONFIGURATION['AWS_BUCKET'], self.output_file)
+        try:
+            self.upload_size = self.__engine().resumable_upload(self.staged_file,
+                                                                self.output_file,
+                                                                checkpoint,
+                                                                previous_state,
+                                                                self.transfer_settings,
+                                                                {'Metadata': s3_util.hash_metadata(self.new_hash)})
+            self.keep_staged = False
+            self.metrics.add('bytes_uploaded', self.upload_size)
 
         except Exception as e:
             logger.error('Failed to upload backup file to S3: %s', e)
+            if self.keep_staged:
+                logger.info('Keeping %s so the upload can be resumed by the next run', self.staged_file)
             raise
 
+        if self.expected_etag is not None:
+            self.__verify_upload(self.output_file, self.expected_etag)
+
+    def __resume_pending_upload(self):
+        pending = self.CONFIGURATION['STATE'].get_value(self.name, PENDING_UPLOAD_KEY)
+
+        if pending is None:
+            return False
+
+        if not os.path.isfile(pending['file']):
+            logger.warning('The archive of the interrupted upload of %s is gone, starting again', pending['key'])
+            self.__abandon_pending_upload(pending)
+            return False
+
+        logger.info('Resuming the interrupted upload of %s', pending['key'])
+
+        self.output_file = pending['key']
+        self.staged_file = pending['file']
+        self.new_hash = pending['hash']
+        self.expected_etag = pending['expected_etag']
+        self.resumed = True
+
+        with self.metrics.phase('upload'):
+            self.__upload(pending)
+
+        return True
+
+    def __abandon_pending_upload(self, pending):
+        s3_client = self.__engine().client('s3', self.transfer_settings)
+
+        try:
+            s3_client.abort_multipart_upload(Bucket=self.CONFIGURATION['AWS_BUCKET'],
+                                             Key=pending['key'],
+                                             UploadId=pending['upload_id'])
+        except Exception as e:
+            logger.debug('Could not abort upload %s: %s', pending['upload_id'], e)
+
+        self.CONFIGURATION['STATE'].update(self.name, {PENDING_UPLOAD_KEY: None})
+
+    def __abort_stale_uploads(self):
+        """
+            Abort multipart uploads under the output prefix which were started long enough ago that they can only
+            have been abandoned, so their parts stop being billed
+        """
+        pending = self.CONFIGURATION['STATE'].get_value(self.name, PENDING_UPLOAD_KEY)
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=self.stale_upload_hours)
+
+        try:
+            s3_client = self.__engine().client('s3', self.transfer_settings)
+
+            for upload in s3_util.list_multipart_uploads(s3_client,
+                                                         self.CONFIGURATION['AWS_BUCKET'],
+                                                         self.output_file_prefix):
+                if not (upload['Key'].startswith(self.output_file_prefix + '_') or
+                        upload['Key'].startswith(self.output_file_prefix + '/')):
+                    continue
+
+                if pending is not None and upload['UploadId'] == pending['upload_id']:
+                    continue
+
+                if upload['Initiated'] > cutoff:
+                    continue
+
+                logger.info('Aborting stale multipart upload of %s started %s', upload['Key'], upload['Initiated'])
+                s3_client.abort_multipart_upload(Bucket=self.CONFIGURATION['AWS_BUCKET'],
+                                                 Key=upload['Key'],
+                                                 UploadId=upload['UploadId'])
+
+        except Exception as e:
+            # Nothing about this backup depends on the clean up, so it is only reported
+            logger.error('Failed to abort stale multipart uploads: %s', e)
+
+    def __engine(self):
+        return self.CONFIGURATION['TRANSFER_ENGINE']
+
+    def __verify_upload(self, key, expected_etag):
+        s3_client = self.__engine().client('s3', self.transfer_settings)
+        response = s3_client.head_object(Bucket=self.CONFIGURATION['AWS_BUCKET'], Key=key)
+        etag = response['ETag'].strip('"')
+
+        if etag != expected_etag:
+            logger.error('Uploaded backup %s has ETag %s, expected %s', key, etag, expected_etag)
+            raise Exception('Uploaded backup %s does not match the local archive' % key)
+
+        logger.info('Verified upload of %s (ETag %s)', key, etag)
+
     def __hash_check(self):
-        previous_hash = hash_file.find_hash(self.CONFIGURATION['HASH_CHECK_FILE'], self.name)
+        previous_hash = self.__previous_hash()
 
         if previous_hash is None:
             logger.debug('No previous hash found for plan %s', self.name)
         else:
             logger.debug('Got a previous hash for plan %s of %s', self.name, previous_hash)
 
-        self.new_hash = hash_file.calc_hash(self.output_file)
-
         logger.debug('New hash for plan %s of %s', self.name, self.new_hash)
 
         return previous_hash == self.new_hash
 
-    def __update_hash(self):
-        if self.new_hash is None:
-            logger.error('Could not update hash as no hash was found')
-            return
+    def __previous_hash(self):
+        """
+            The hash of the last backup. In remote mode this is read from the newest backup in S3, unless it was
+            checked (or uploaded) within the cache time, so runs on a new host or in a fresh container only upload
+            if the files really have changed.
+        """
+        if self.change_detection == 'local':
+            return self.CONFIGURATION['STATE'].get_value(self.name, state_store.HASH_KEY)
+
+        if self.previous_hash_found:
+            return self.previous_hash
+
+        state = self.CONFIGURATION['STATE']
+        checked = state.get_value(self.name, REMOTE_CHECKED_KEY)
+
+        if checked is not None and time.time() - checked < self.change_detection_cache:
+            self.previous_hash = state.get_value(self.name, state_store.HASH_KEY)
+            logger.debug('Using the hash of plan %s checked against S3 %ds ago', self.name, time.time() - checked)
+        else:
+            self.previous_hash = self.__remote_hash()
+
+            if self.previous_hash is not None:
+                state.update(self.name, {state_store.HASH_KEY: self.previous_hash, REMOTE_CHECKED_KEY: time.time()})
+
+        self.previous_hash_found = True
 
-        hash_file.update_hash(self.CONFIGURATION['HASH_CHECK_FILE'], self.name, self.new_hash)
+        return self.previous_hash
+
+    def __remote_hash(self):
+        s3_client = self.__engine().client('s3', self.transfer_settings)
+
+        if self.storage_mode == 'dedup':
+            backups = self.__get_dedup_store().list_snapshots()
+        else:
+            grouped = retention.group_backups(s3_util.list_keys(s3_client,
+                                                                self.CONFIGURATION['AWS_BUCKET'],
+                                                                self.output_file_prefix + '_'),
+                                              self.output_file_prefix)
+            backups = [volumes.backup_key(keys) for keys in grouped.values()]
+            backups = [key for key in backups if key is not None]
+
+        if len(backups) == 0:
+            logger.debug('No backups of plan %s found in S3', self.name)
+            return None
+
+        hash_value = s3_util.object_hash(s3_client, self.CONFIGURATION['AWS_BUCKET'], backups[-1])
+
+        logger.debug('Newest backup of plan %s in S3 is %s, with hash %s', self.name, backups[-1], hash_value)
+
+        return hash_value
+
+    def __update_state(self, updated):
+        values = {'last_run': time.strftime("%Y-%m-%d_%H-%M-%S")}
+
+        if updated:
+            if self.new_hash is None:
+                logger.error('Could not update hash as no hash was found')
+            else:
+                values[state_store.HASH_KEY] = self.new_hash
+
+            values['last_upload_key'] = self.output_file
+            values[VOLUME_HASHES_KEY] = self.volume_hashes
+
+            if self.change_detection == 'remote':
+                # This run's upload is now the newest backup in S3
+                values[REMOTE_CHECKED_KEY] = time.time()
+            values[PENDING_UPLOAD_KEY] = None
+            values['last_upload_size'] = self.upload_size
+            values['last_upload_duration'] = round(time.time() - self.run_started, 3)
+
+        elif self.volume_hashes is not None:
+            # An unchanged backup found without the volume hashes (on a new host, say) has them for next time
+            values[VOLUME_HASHES_KEY] = self.volume_hashes
+
+        # Either way, the backup in S3 now matches the files that were zipped. A resumed upload has no manifest,
+        # so the next run will build one (and find the backup unchanged)
+        if self.manifest and not self.resumed:
+            if self.new_manifest is None:
+                logger.error('Could not update manifest as no manifest was built')
+            else:
+                manifest.save_manifest(self.__manifest_file(), self.new_manifest)
+                self.new_manifest = None
+                values['manifest'] = self.__manifest_file()
+
+        # All the values are written together, so the hash can never point at a different upload
+        self.CONFIGURATION['STATE'].update(self.name, values)
+
+    def __manifest_file(self, suffix='manifest.json'):
+        manifest_dir = self.CONFIGURATION['MANIFEST_DIR']
+
+        if manifest_dir is None:
+            manifest_dir = os.path.dirname(os.path.abspath(self.CONFIGURATION['HASH_CHECK_FILE']))
+
+        return manifest.manifest_path(manifest_dir, self.name, suffix)
+
+    def __manifest_check(self, fileset):
+        self.new_manifest, unchanged = manifest.build_manifest(fileset, self.__manifest_file(),
+                                                               self.manifest_content_hash)
+
+        # Without a stored hash there is nothing to say the previous upload completed
+        if self.__previous_hash() is None:
+            return False
+
+        return unchanged
 
     def __cleanup(self):
-        logger.info('Cleaning up temporary file: %s', self.output_file)
+        self.dedup_store = None
+
+        if self.keep_staged:
+            return
+
+        logger.info('Cleaning up temporary file: %s', self.staged_file)
         try:
-            if os.path.isfile(self.output_file):
-                os.remove(self.output_file)
+            if os.path.isfile(self.staged_file):
+                os.remove(self.staged_file)
         except Exception as e:
             logger.error('Failed to remove temporary file: %s', e)
@@ -0,0 +1,43 @@
+import threading
+
+
+class ResourcePool:
+    """
+        Hands out weighted CPU and I/O slots to plans. A plan only starts when both its CPU and its I/O weight
+        fit within what is left, and fewer than max_plans are running, and everything is acquired together so
+        two plans can never deadlock on each other.
+    """
+
+    def __init__(self, cpu_capacity, io_capacity, max_plans=None):
+        self.cpu_capacity = cpu_capacity
+        self.io_capacity = io_capacity
+        self.max_plans = max_plans
+
+        self.__cpu_used = 0
+        self.__io_used = 0
+        self.__plans = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self, cpu_weight, io_weight):
+        # A plan heavier than the whole pool still gets to run, just on its own
+        cpu_weight = min(cpu_weight, self.cpu_capacity)
+        io_weight = min(io_weight, self.io_capacity)
+
+        with self.__condition:
+            while self.__cpu_used + cpu_weight > self.cpu_capacity or \
+                    self.__io_used + io_weight > self.io_capacity or \
+                    (self.max_plans is not None and self.__plans >= self.max_plans):
+                self.__condition.wait()
+
+            self.__cpu_used += cpu_weight
+            self.__io_used += io_weight
+            self.__plans += 1
+
+        return cpu_weight, io_weight
+
+    def release(self, cpu_weight, io_weight):
+        with self.__condition:
+            self.__cpu_used -= cpu_weight
+            self.__io_used -= io_weight
+            self.__plans -= 1
+            self.__condition.notify_all()
@@ -0,0 +1,599 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import fnmatch
+import io
+import itertools
+import logging
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from S3Backup import compression
+from S3Backup import config_loader
+from S3Backup import dedup
+from S3Backup import encryption
+from S3Backup import retention
+from S3Backup import s3_util
+from S3Backup import transfer
+from S3Backup import volumes
+
+DEFAULT_THREADS = 8
+
+# Each ranged GET of a large entry (or a whole archive) fetches this much
+RANGE_SIZE = 8 * 1024 * 1024
+
+# The end of central directory records are at the end of the archive, and for most backups the whole central
+# directory is too, so the tail is fetched in one request up front
+TAIL_SIZE = 1024 * 1024
+
+# Local headers can have a different extra field to the central directory, so this much more is fetched with
+# each entry to read the header and (for small entries) the data in a single request
+HEADER_SLACK = 1024
+
+COPY_SIZE = 1024 * 1024
+
+logger = logging.getLogger(name='Restore')
+
+
+class S3RangeSource:
+    """
+        An object in S3, read by byte range
+    """
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+        self.__size = None
+
+    @property
+    def size(self):
+        if self.__size is None:
+            self.__size = self.s3_client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+
+        return self.__size
+
+    def tail(self, length):
+        """
+            The last length bytes of the object (or all of it, if it is smaller), finding its size on the way
+        """
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=-%d' % length)
+
+        if response.get('ContentRange'):
+            self.__size = int(response['ContentRange'].rsplit('/', 1)[1])
+        else:
+            self.__size = response['ContentLength']
+
+        return response['Body'].read()
+
+    def read(self, start, end):
+        if end <= start:
+            return b''
+
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end - 1))
+        data = response['Body'].read()
+
+        if len(data) != end - start:
+            raise Exception('Short read of %s: expected %d bytes from %d, got %d' % (self.key, end - start, start,
+                                                                                    len(data)))
+
+        return data
+
+
+class FileRangeSource:
+    """
+        A local archive, read by byte range like one in S3
+    """
+
+    def __init__(self, filename):
+        self.key = filename
+        self.size = os.path.getsize(filename)
+
+    def tail(self, length):
+        return self.read(max(0, self.size - length), self.size)
+
+    def read(self, start, end):
+        with open(self.key, 'rb') as source:
+            source.seek(start)
+            return source.read(max(0, end - start))
+
+
+def fetch_in_order(fetches, threads):
+    """
+        Call each of the fetches (functions taking no arguments) with up to threads of them running at once,
+        yielding their results in order
+    """
+    fetches = iter(fetches)
+
+    if threads <= 1:
+        for fetch in fetches:
+            yield fetch()
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque(executor.submit(fetch) for fetch in itertools.islice(fetches, threads))
+
+        try:
+            while len(pending) > 0:
+                result = pending.popleft().result()
+
+                fetch = next(fetches, None)
+                if fetch is not None:
+                    pending.append(executor.submit(fetch))
+
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def range_blocks(source, start, end, threads):
+    return fetch_in_order(((lambda block_start=block_start: source.read(block_start,
+                                                                         min(block_start + RANGE_SIZE, end)))
+                           for block_start in range(start, end, RANGE_SIZE)),
+                          threads)
+
+
+class BlockReader:
+    """
+        A read only stream over an iterator of blocks of bytes
+    """
+
+    def __init__(self, blocks):
+        self.__blocks = iter(blocks)
+        self.__buffer = b''
+        self.__offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.__buffer[self.__offset:] + b''.join(self.__blocks)
+            self.__buffer, self.__offset = b'', 0
+            return data
+
+        while len(self.__buffer) - self.__offset < size:
+            block = next(self.__blocks, None)
+            if block is None:
+                break
+
+            self.__buffer = self.__buffer[self.__offset:] + block
+            self.__offset = 0
+
+        data = self.__buffer[self.__offset:self.__offset + size]
+        self.__offset += len(data)
+
+        return data
+
+    def close(self):
+        if hasattr(self.__blocks, 'close'):
+            self.__blocks.close()
+
+
+class RangeFile:
+    """
+        A seekable, read only file over a range source, for zipfile to read the central directory through
+    """
+
+    def __init__(self, source, threads):
+        self.source = source
+        self.threads = threads
+
+        self.__tail = source.tail(TAIL_SIZE)
+        self.__tail_start = source.size - len(self.__tail)
+        self.__position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__position
+        elif whence == os.SEEK_END:
+            offset += self.source.size
+
+        self.__position = max(0, offset)
+        return self.__position
+
+    def read(self, size=-1):
+        end = self.source.size if size is None or size < 0 else min(self.__position + size, self.source.size)
+        data = b''
+
+        if self.__position < self.__tail_start:
+            middle_end = min(end, self.__tail_start)
+
+            if middle_end - self.__position > RANGE_SIZE:
+                data = b''.join(range_blocks(self.source, self.__position, middle_end, self.threads))
+            else:
+                data = self.source.read(self.__position, middle_end)
+
+        if end > self.__tail_start:
+            data += self.__tail[max(self.__position, self.__tail_start) - self.__tail_start:end - self.__tail_start]
+
+        self.__position = max(self.__position, end)
+
+        return data
+
+    def close(self):
+        pass
+
+
+def selected(name, patterns):
+    """
+        Whether an entry is picked out by the patterns: an exact path, a directory it is under, or a glob
+    """
+    if not patterns:
+        return True
+
+    name = name.strip('/')
+
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+
+        if name == pattern or name.startswith(pattern + '/') or fnmatch.fnmatchcase(name, pattern):
+            return True
+
+    return False
+
+
+def target_path(destination, name):
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ['', '.']]
+
+    if '..' in parts or len(parts) == 0 or os.path.splitdrive(parts[0])[0] != '':
+        raise Exception('Refusing to restore an entry outside the destination: %s' % name)
+
+    return os.path.join(destination, *parts)
+
+
+def _write_file(reader, target, mode=None, mtime=None):
+    """
+        Write the stream to the target as it is read, only putting it in place once it is complete
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_path = target + '.restoring'
+
+    try:
+        with open(temp_path, 'wb') as output:
+            shutil.copyfileobj(reader, output, COPY_SIZE)
+            size = output.tell()
+
+        os.replace(temp_path, target)
+    except Exception:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if mode:
+        os.chmod(target, mode)
+
+    if mtime is not None:
+        os.utime(target, (mtime, mtime))
+
+    return size
+
+
+class Restore:
+    """
+        Restores backups from S3 without downloading any more of them than is needed.
+
+        For zip archives the central directory is read with ranged GETs from the end of the archive, then only
+        the byte ranges of the selected entries are fetched, being decompressed and written to disk as they
+        arrive. Small entries are restored several at a time, and large ones one at a time with several of
+        their ranges in flight, so no more than about threads * RANGE_SIZE is held in memory.
+
+        tar.zst archives can't be read out of order, so are streamed from the start with ranged GETs running
+        ahead of the decompression. Dedup snapshots fetch the chunks of each selected file, and backups split
+        into volumes restore each volume in turn. Encrypted archives are read the same way, with only the
+        segments holding each range fetched being decrypted, given the plan's Encryption settings.
+    """
+
+    def __init__(self, s3_client, bucket, threads=DEFAULT_THREADS, encryption=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.threads = max(1, int(threads))
+        self.encryption = encryption
+
+    def list_backups(self, plan):
+        """
+            The keys of the plan's backups in S3, oldest first
+        """
+        if plan.storage_mode == 'dedup':
+            return dedup.DedupStore(self.s3_client, self.bucket, plan.output_file_prefix,
+                                    plan.dedup_chunk_size).list_snapshots()
+
+        backups = retention.group_backups(s3_util.list_keys(self.s3_client,
+                                                            self.bucket,
+                                                            plan.output_file_prefix + '_'),
+                                          plan.output_file_prefix)
+
+        backups = [volumes.backup_key(keys) for keys in backups.values()]
+
+        return [key for key in backups if key is not None]
+
+    def latest_backup(self, plan):
+        backups = self.list_backups(plan)
+
+        if len(backups) == 0:
+            raise Exception('No backups found for plan %s' % plan.name)
+
+        return backups[-1]
+
+    def list_entries(self, key):
+        """
+            The (name, size) of every entry in the backup
+        """
+        if key.endswith('.json.gz'):
+            index = self.__load_snapshot(key)
+            return [(entry['path'], entry['size']) for entry in index['files']]
+
+        if volumes.is_index(key):
+            index = volumes.load_index(self.s3_client, self.bucket, key)
+            return [entry for volume in index['volumes'] for entry in self.list_entries(volume['key'])]
+
+        if encryption.plain_key(key).endswith('.tar.zst'):
+            with self.__open_tar(key) as archive:
+                return [(member.name, member.size) for member in archive]
+
+        with zipfile.ZipFile(RangeFile(self.__source(key), self.threads)) as archive:
+            return [(info.filename, info.file_size) for info in archive.infolist()]
+
+    def restore(self, key, destination, patterns=None):
+        """
+            Restore the entries of the backup matching the patterns (all of them if there are none) under the
+            destination, returning the number of files and bytes restored
+        """
+        logger.info('Restoring %s to %s', key, destination)
+
+        started = time.monotonic()
+
+        if key.endswith('.json.gz'):
+            files, size = self.__restore_snapshot(key, destination, patterns)
+        elif volumes.is_index(key):
+            files, size = self.__restore_volumes(key, destination, patterns)
+        elif encryption.plain_key(key).endswith('.tar.zst'):
+            files, size = self.__restore_tar(key, destination, patterns)
+        else:
+            files, size = self.__restore_zip(self.__source(key), destination, patterns)
+
+        transfer.TransferEngine.log_throughput('Restored %d files from' % files, key, size,
+                                               time.monotonic() - started)
+
+        return files, size
+
+    def __source(self, key):
+        source = S3RangeSource(self.s3_client, self.bucket, key)
+
+        if not encryption.is_encrypted(key):
+            return source
+
+        if self.encryption is None:
+            raise Exception('%s is encrypted, but the plan has no Encryption settings to decrypt it' % key)
+
+        return encryption.DecryptingSource(source, self.encryption)
+
+    def __restore_volumes(self, key, destination, patterns):
+        # Each volume is a complete archive of its own, restored with all the threads in turn
+        files = 0
+        size = 0
+
+        for volume in volumes.load_index(self.s3_client, self.bucket, key)['volumes']:
+            if encryption.plain_key(volume['key']).endswith('.tar.zst'):
+                restored = self.__restore_tar(volume['key'], destination, patterns)
+            else:
+                restored = self.__restore_zip(self.__source(volume['key']), destination, patterns)
+
+            files += restored[0]
+            size += restored[1]
+
+        return files, size
+
+    def __restore_all(self, small, large, restore_one):
+        files = 0
+        size = 0
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for restored in executor.map(restore_one, small):
+                files += 1
+                size += restored
+
+        for item in large:
+            size += restore_one(item)
+            files += 1
+
+        return files, size
+
+    def __restore_zip(self, source, destination, patterns):
+        with zipfile.ZipFile(RangeFile(source, self.threads)) as archive:
+            entries = [info for info in archive.infolist() if selected(info.filename, patterns)]
+
+        for info in entries:
+            if info.is_dir():
+                os.makedirs(target_path(destination, info.filename), exist_ok=True)
+
+        entries = [info for info in entries if not info.is_dir()]
+
+        return self.__restore_all([info for info in entries if info.compress_size <= RANGE_SIZE],
+                                  [info for info in entries if info.compress_size > RANGE_SIZE],
+                                  lambda info: self.__restore_entry(source, info, destination))
+
+    def __restore_entry(self, source, info, destination):
+        logger.debug('Restoring: %s', info.filename)
+
+        small = info.compress_size <= RANGE_SIZE
+        start = info.header_offset
+        header_size = zipfile.sizeFileHeader + len(info.filename.encode('utf-8')) + len(info.extra) + HEADER_SLACK
+
+        block = source.read(start, min(start + header_size + (info.compress_size if small else 0), source.size))
+
+        if len(block) < zipfile.sizeFileHeader:
+            raise Exception('Truncated local header for %s' % info.filename)
+
+        header = struct.unpack(zipfile.structFileHeader, block[:zipfile.sizeFileHeader])
+        if header[0] != zipfile.stringFileHeader:
+            raise Exception('Bad local header for %s' % info.filename)
+
+        # The name and extra field lengths are the last two fields of the local header
+        data_start = zipfile.sizeFileHeader + header[10] + header[11]
+
+        if small and data_start + info.compress_size <= len(block):
+            reader = io.BytesIO(block[data_start:data_start + info.compress_size])
+        else:
+            reader = BlockReader(range_blocks(source, start + data_start, start + data_start + info.compress_size,
+                                              self.threads))
+
+        mode = (info.external_attr >> 16) & 0o7777
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+
+        try:
+            # ZipExtFile decompresses the entry and checks its CRC as it is read
+            with zipfile.ZipExtFile(reader, 'r', info) as entry:
+                return _write_file(entry, target_path(destination, info.filename), mode, mtime)
+        finally:
+            reader.close()
+
+    def __open_tar(self, key):
+        source = self.__source(key)
+        reader = compression.open_zstd_reader(BlockReader(range_blocks(source, 0, source.size, self.threads)))
+
+        return tarfile.open(fileobj=reader, mode='r|')
+
+    def __restore_tar(self, key, destination, patterns):
+        files = 0
+        size = 0
+
+        with self.__open_tar(key) as archive:
+            for member in archive:
+                if not selected(member.name, patterns):
+                    continue
+
+                target = target_path(destination, member.name)
+
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                elif member.isfile():
+                    logger.debug('Restoring: %s', member.name)
+                    size += _write_file(archive.extractfile(member), target, member.mode & 0o7777, member.mtime)
+                    files += 1
+                else:
+                    logger.debug('Skipping %s, which is not a regular file', member.name)
+
+        return files, size
+
+    def __load_snapshot(self, key):
+        prefix = key.rsplit('/snapshots/', 1)[0]
+        return dedup.DedupStore(self.s3_client, self.bucket, prefix, 0).load_snapshot(key)
+
+    def __restore_snapshot(self, key, destination, patterns):
+        chunk_prefix = '%s/chunks/' % key.rsplit('/snapshots/', 1)[0]
+        entries = [entry for entry in self.__load_snapshot(key)['files'] if selected(entry['path'], patterns)]
+
+        def fetch_chunk(chunk_id):
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=chunk_prefix + chunk_id)
+            return dedup.decode_chunk(response['Body'].read())
+
+        def restore_one(entry):
+            logger.debug('Restoring: %s', entry['path'])
+            fetches = [(lambda chunk_id=chunk_id: fetch_chunk(chunk_id)) for chunk_id, chunk_size in entry['chunks']]
+            reader = BlockReader(fetch_in_order(fetches, self.threads if len(fetches) > 1 else 1))
+
+            try:
+                return _write_file(reader, target_path(destination, entry['path']), entry['mode'] & 0o7777,
+                                   entry['mtime_ns'] / 1e9)
+            finally:
+                reader.close()
+
+        return self.__restore_all([entry for entry in entries if len(entry['chunks']) <= 1],
+                                  [entry for entry in entries if len(entry['chunks']) > 1],
+                                  restore_one)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Restore files from a backup plan')
+    parser.add_argument('config', help='The configuration file of the plan')
+    parser.add_argument('plan', help='The name of the plan to restore')
+    parser.add_argument('patterns', nargs='*', metavar='PATTERN',
+                        help='Paths, directories or globs of the entries to restore (default: everything)')
+    parser.add_argument('--destination', '-d', default=None, help='The directory to restore into')
+    parser.add_argument('--key', default=None, help='The backup to restore (default: the latest)')
+    parser.add_argument('--list', action='store_true', help='List the entries of the backup instead')
+    parser.add_argument('--backups', action='store_true', help='List the backups of the plan instead')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help='Ranged GETs in flight at once (default %d)' % DEFAULT_THREADS)
+    args = parser.parse_intermixed_args(argv)
+
+    if args.destination is None and not (args.list or args.backups):
+        parser.error('A --destination is needed to restore into')
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    configuration, plans = config_loader.config_setup(args.config)
+
+    plan = next((plan for plan in plans if plan.name == args.plan), None)
+    if plan is None:
+        parser.error('No plan named %s in %s' % (args.plan, args.config))
+
+    restore = Restore(configuration['TRANSFER_ENGINE'].client('s3', plan.transfer_settings),
+                      configuration['AWS_BUCKET'],
+                      args.threads,
+                      plan.encryption)
+
+    if args.backups:
+        for key in restore.list_backups(plan):
+            print(key)
+        return 0
+
+    key = args.key if args.key is not None else restore.latest_backup(plan)
+
+    if args.list:
+        for name, size in restore.list_entries(key):
+            if selected(name, args.patterns):
+                print('%12d  %s' % (size, name))
+        return 0
+
+    restore.restore(key, args.destination, args.patterns)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+from S3Backup.stream_upload import MAX_PARTS
+
+logger = logging.getLogger(name='ResumableUpload')
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ResumableUpload:
+    """
+        Uploads a local file as a multipart upload, recording the upload ID and the ETag of every completed part
+        through checkpoint(state) as it goes. Given the state saved by an earlier, interrupted attempt, only the
+        parts S3 doesn't already have are sent, as long as the file itself has not changed since.
+    """
+
+    def __init__(self, s3_client, bucket, key, filename, part_size, max_in_flight=2, throttle=None,
+                 checkpoint=None, previous_state=None, extra_args=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.filename = filename
+        self.throttle = throttle
+        self.checkpoint = checkpoint
+        self.extra_args = extra_args or {}
+        self.max_in_flight = max(1, max_in_flight)
+
+        self.size, self.mtime_ns = file_signature(filename)
+
+        # Stay within the part limit, keeping parts a whole number of MB
+        megabyte = 1024 * 1024
+        minimum = -(-self.size // MAX_PARTS)
+        self.part_size = max(part_size, -(-minimum // megabyte) * megabyte)
+
+        self.upload_id = None
+        self.parts = {}
+        self.sent_bytes = 0
+
+        self.__lock = threading.Lock()
+        self.__checkpoint_lock = threading.Lock()
+
+        if previous_state is not None:
+            self.__resume(previous_state)
+
+    @property
+    def part_count(self):
+        return max(1, -(-self.size // self.part_size))
+
+    def state(self):
+        with self.__lock:
+            return {
+                'upload_id': self.upload_id,
+                'key': self.key,
+                'size': self.size,
+                'mtime_ns': self.mtime_ns,
+                'part_size': self.part_size,
+                'parts': dict((str(number), etag) for number, etag in self.parts.items())
+            }
+
+    def run(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)
+            self.upload_id = response['UploadId']
+            logger.debug('Started multipart upload %s for %s', self.upload_id, self.key)
+            self.__checkpoint()
+
+        missing = [number for number in range(1, self.part_count + 1) if number not in self.parts]
+
+        if len(missing) < self.part_count:
+            logger.info('Resuming upload of %s, %d of %d parts already uploaded',
+                        self.key, self.part_count - len(missing), self.part_count)
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = [executor.submit(self.__upload_part, number) for number in missing]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+
+            for future in not_done:
+                future.cancel()
+
+            for future in done:
+                future.result()
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={
+                'Parts': [{'ETag': self.parts[number], 'PartNumber': number} for number in sorted(self.parts)]
+            })
+
+        return self.size
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logger.info('Aborted multipart upload of %s', self.key)
+        except Exception as e:
+            logger.error('Failed to abort multipart upload %s of %s: %s', self.upload_id, self.key, e)
+
+    def __resume(self, previous_state):
+        if (previous_state.get('key') != self.key or previous_state.get('size') != self.size or
+                previous_state.get('mtime_ns') != self.mtime_ns or previous_state.get('part_size') != self.part_size):
+            logger.warning('%s has changed since its upload was interrupted, starting again', self.filename)
+            self.__abort_previous(previous_state)
+            return
+
+        # S3 is the authority on which parts arrived, the checkpoint may have missed the last few
+        try:
+            parts = {}
+            paginator = self.s3_client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket, Key=self.key, UploadId=previous_state['upload_id']):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part
+        except Exception as e:
+            logger.warning('Unable to resume multipart upload %s of %s, starting again: %s',
+                           previous_state['upload_id'], self.key, e)
+            return
+
+        for number, part in parts.items():
+            expected = min(self.part_size, self.size - (number - 1) * self.part_size)
+            if part['Size'] == expected:
+                self.parts[number] = part['ETag']
+
+        self.upload_id = previous_state['upload_id']
+
+    def __abort_previous(self, previous_state):
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket,
+                                                  Key=previous_state['key'],
+                                                  UploadId=previous_state['upload_id'])
+        except Exception as e:
+            logger.debug('Could not abort previous upload %s: %s', previous_state['upload_id'], e)
+
+    def __upload_part(self, number):
+        offset = (number - 1) * self.part_size
+
+        with open(self.filename, 'rb') as source:
+            source.seek(offset)
+            data = source.read(self.part_size)
+
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+
+        response = self.s3_client.upload_part(Bucket=self.bucket,
+                                              Key=self.key,
+                                              UploadId=self.upload_id,
+                                              PartNumber=number,
+                                              Body=data)
+
+        with self.__lock:
+            self.parts[number] = response['ETag']
+            self.sent_bytes += len(data)
+
+        logger.debug('Uploaded part %d of %d of %s (%d bytes)', number, self.part_count, self.key, len(data))
+        self.__checkpoint()
+
+    def __checkpoint(self):
+        if self.checkpoint is None:
+            return
+
+        # Checkpoints are saved one at a time, so an older state never overwrites a newer one
+        with self.__checkpoint_lock:
+            self.checkpoint(self.state())
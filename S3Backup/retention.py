@@ -0,0 +1,89 @@
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+retention_values = ['KeepLast', 'KeepWithinDays', 'KeepHourly', 'KeepDaily', 'KeepWeekly', 'KeepMonthly',
+                    'KeepYearly']
+
+# How each grandfather-father-son rule groups backups into periods
+PERIODS = OrderedDict([
+    ('KeepHourly', lambda dt: (dt.date(), dt.hour)),
+    ('KeepDaily', lambda dt: dt.date()),
+    ('KeepWeekly', lambda dt: dt.isocalendar()[:2]),
+    ('KeepMonthly', lambda dt: (dt.year, dt.month)),
+    ('KeepYearly', lambda dt: dt.year)
+])
+
+
+def group_backups(keys, prefix, separator='_'):
+    """
+        Group keys by the timestamp in their name ("<prefix>_<timestamp>[.<anything>]"), oldest first. Keys that
+        don't follow the pattern (such as those of another plan whose prefix starts the same way) are ignored.
+    """
+    pattern = re.compile('^%s%s(\\d{4}-\\d{2}-\\d{2}_\\d{2}-\\d{2}-\\d{2})(\\..*)?$' % (re.escape(prefix),
+                                                                                      re.escape(separator)))
+    backups = {}
+
+    for key in keys:
+        match = pattern.match(key)
+        if match is None:
+            continue
+
+        try:
+            timestamp = datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+
+        backups.setdefault(timestamp, []).append(key)
+
+    return OrderedDict((timestamp, sorted(backups[timestamp])) for timestamp in sorted(backups))
+
+
+class RetentionPolicy:
+    """
+        Decides which backups to keep. A backup is kept if any rule keeps it:
+
+            KeepLast        - the newest N backups
+            KeepWithinDays  - every backup from the last N days
+            KeepHourly, KeepDaily, KeepWeekly, KeepMonthly, KeepYearly
+                            - the newest backup in each of the last N hours/days/weeks/months/years which have one
+    """
+
+    def __init__(self, raw_policy, keep_last):
+        self.rules = {'KeepLast': keep_last}
+
+        for key, value in (raw_policy or {}).items():
+            if key not in retention_values:
+                raise Exception('Unknown retention setting: %s' % key)
+            self.rules[key] = int(value)
+
+    def to_remove(self, timestamps, now=None):
+        """
+            Returns the timestamps which should be removed, oldest first
+        """
+        if now is None:
+            now = datetime.now()
+
+        newest_first = sorted(timestamps, reverse=True)
+        keep = set(newest_first[:max(self.rules['KeepLast'], 0)])
+
+        if 'KeepWithinDays' in self.rules:
+            cutoff = now - timedelta(days=self.rules['KeepWithinDays'])
+            keep.update(timestamp for timestamp in newest_first if timestamp >= cutoff)
+
+        for rule, period in PERIODS.items():
+            if rule not in self.rules:
+                continue
+
+            seen = set()
+            for timestamp in newest_first:
+                if len(seen) >= self.rules[rule]:
+                    break
+
+                if period(timestamp) not in seen:
+                    seen.add(period(timestamp))
+                    keep.add(timestamp)
+
+        return [timestamp for timestamp in reversed(newest_first) if timestamp not in keep]
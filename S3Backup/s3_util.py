@@ -0,0 +1,104 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_DELETE_BATCH = 1000
+
+# The content hash of a backup is stored in its metadata (or tags) under this name
+HASH_METADATA = 's3backup-hash'
+
+logger = logging.getLogger(name='S3Util')
+
+
+def list_objects(s3_client, bucket, prefix):
+    """
+        Yield the listing (key, size, last modified time and so on) of every object under the prefix, following
+        continuation tokens past the first 1000
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            yield item
+
+
+def list_keys(s3_client, bucket, prefix):
+    """
+        Yield every key under the prefix
+    """
+    for item in list_objects(s3_client, bucket, prefix):
+        yield item['Key']
+
+
+def list_multipart_uploads(s3_client, bucket, prefix):
+    """
+        Yield every multipart upload in progress under the prefix
+    """
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            yield upload
+
+
+def hash_metadata(hash_value):
+    return {HASH_METADATA: hash_value}
+
+
+def object_hash(s3_client, bucket, key):
+    """
+        The content hash stored with a backup: in its metadata, or for streamed uploads (whose hash is only known
+        once they are complete) in its tags. None if it has neither.
+    """
+    metadata = s3_client.head_object(Bucket=bucket, Key=key).get('Metadata', {})
+
+    if HASH_METADATA in metadata:
+        return metadata[HASH_METADATA]
+
+    try:
+        tags = s3_client.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+    except Exception as e:
+        logger.debug('Could not read the tags of %s: %s', key, e)
+        return None
+
+    for tag in tags:
+        if tag['Key'] == HASH_METADATA:
+            return tag['Value']
+
+    return None
+
+
+def tag_hash(s3_client, bucket, key, hash_value):
+    s3_client.put_object_tagging(Bucket=bucket,
+                                 Key=key,
+                                 Tagging={'TagSet': [{'Key': HASH_METADATA, 'Value': hash_value}]})
+
+
+def delete_keys(s3_client, bucket, keys, concurrency=1):
+    """
+        Delete the keys in batches of up to 1000 per request, with up to concurrency batches in flight at once.
+        Returns the number of keys deleted.
+    """
+    keys = list(keys)
+    batches = [keys[start:start + MAX_DELETE_BATCH] for start in range(0, len(keys), MAX_DELETE_BATCH)]
+
+    if len(batches) <= 1 or concurrency <= 1:
+        return sum(_delete_batch(s3_client, bucket, batch) for batch in batches)
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+        return sum(executor.map(lambda batch: _delete_batch(s3_client, bucket, batch), batches))
+
+
+def _delete_batch(s3_client, bucket, batch):
+    response = s3_client.delete_objects(Bucket=bucket,
+                                        Delete={
+                                            'Objects': [{'Key': key} for key in batch],
+                                            'Quiet': True
+                                        })
+
+    errors = response.get('Errors', [])
+    if len(errors) > 0:
+        raise Exception('Failed to delete %d objects, first error: %s - %s' % (len(errors),
+                                                                              errors[0].get('Key'),
+                                                                              errors[0].get('Message')))
+
+    return len(batch)
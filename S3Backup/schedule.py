@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *'
+}
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+WEEKDAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+# (lowest, highest, names) of minute, hour, day of month, month and day of week. Sunday is 0 or 7.
+FIELDS = [(0, 59, None), (0, 23, None), (1, 31, None), (1, 12, MONTHS), (0, 7, WEEKDAYS)]
+
+# No schedule can go longer than this without a run (29 February on a Monday comes round within 28 years)
+MAX_SEARCH_DAYS = 366 * 28
+
+
+def _value(text, lowest, names):
+    text = text.lower()
+
+    if names is not None and text in names:
+        return names.index(text) + lowest
+
+    return int(text)
+
+
+def _parse_field(text, lowest, highest, names):
+    values = set()
+
+    for item in text.split(','):
+        item, _, step = item.partition('/')
+        step = int(step) if step else 1
+
+        if item == '*':
+            start, end = lowest, highest
+        elif '-' in item:
+            start, end = [_value(value, lowest, names) for value in item.split('-', 1)]
+        else:
+            start = _value(item, lowest, names)
+            end = highest if step > 1 else start
+
+        if start < lowest or end > highest or start > end or step < 1:
+            raise ValueError(item)
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class CronSchedule:
+    """
+        A standard five field cron expression ("minute hour day-of-month month day-of-week", with lists, ranges,
+        steps and names) or one of the @hourly style aliases, in local time. As in cron, when both the day of the
+        month and the day of the week are restricted, a day matching either is run.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+
+        fields = ALIASES.get(expression.strip().lower(), expression).split()
+
+        if len(fields) != 5:
+            raise Exception('Schedule must have 5 fields: %s' % expression)
+
+        try:
+            self.minutes, self.hours, self.days, self.months, self.weekdays = \
+                [_parse_field(field, *FIELDS[index]) for index, field in enumerate(fields)]
+        except ValueError as e:
+            raise Exception('Invalid schedule %s: %s' % (expression, e))
+
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+        # Reject a schedule which can never run (such as 30 February) along with the rest of the config
+        self.next_run()
+
+    def __day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def next_run(self, after=None):
+        """
+            The first time the schedule runs strictly after the given time (or now)
+        """
+        if after is None:
+            after = datetime.now()
+
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=MAX_SEARCH_DAYS)
+
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.__day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+
+        raise Exception('Schedule never runs: %s' % self.expression)
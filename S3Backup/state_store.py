@@ -0,0 +1,283 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The change detection hash has always been stored under this key
+HASH_KEY = 'hash'
+
+logger = logging.getLogger(name='StateStore')
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(backend, filename, legacy_hash_file=None):
+    """
+        Get the state store for a file, so every plan (and thread) using the same file shares one store
+    """
+    filename = os.path.abspath(os.path.normpath(filename))
+
+    with _stores_lock:
+        if (backend, filename) not in _stores:
+            if backend == 'text':
+                store = TextStateStore(filename)
+            elif backend == 'sqlite':
+                store = SqliteStateStore(filename, legacy_hash_file)
+            else:
+                raise Exception('Unknown state backend: %s' % backend)
+
+            _stores[(backend, filename)] = store
+
+        return _stores[(backend, filename)]
+
+
+# Characters which would be taken for the separators (or end the line) are percent encoded in plan names
+_ESCAPES = {'%': '%25', '#': '%23', '=': '%3D', '\n': '%0A', '\r': '%0D'}
+_UNESCAPES = dict((escaped, character) for character, escaped in _ESCAPES.items())
+_ESCAPED = re.compile('|'.join(_UNESCAPES))
+
+
+def _escape_name(plan_name):
+    return ''.join(_ESCAPES.get(character, character) for character in plan_name)
+
+
+def _unescape_name(name):
+    return _ESCAPED.sub(lambda match: _UNESCAPES[match.group(0)], name)
+
+
+def _parse_line(line):
+    """
+        Lines are either the original "<plan>=<hash>" format, or "<plan>#<key>=<json value>" for everything else
+    """
+    name, separator, value = line.strip().partition('=')
+
+    if separator == '':
+        return None
+
+    plan_name, separator, key = name.partition('#')
+
+    if separator != '':
+        try:
+            return _unescape_name(plan_name), key, json.loads(value)
+        except ValueError:
+            # A hash line written by an older version for a plan with a # in its name
+            pass
+
+    return _unescape_name(name), HASH_KEY, value
+
+
+def _format_line(plan_name, key, value):
+    if key == HASH_KEY:
+        return '%s=%s\n' % (_escape_name(plan_name), value)
+
+    return '%s#%s=%s\n' % (_escape_name(plan_name), key, json.dumps(value))
+
+
+class TextStateStore:
+    """
+        Keeps plan state in the original plain text hash file. Extra keys are written on their own lines, which
+        older versions skip over. The file is cached in memory (and re-read only when it changes on disk), and
+        is rewritten through a temporary file which replaces the original in one step.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.__state = {}
+        self.__file_version = None
+        self.__lock = threading.RLock()
+
+    def get(self, plan_name):
+        with self.__lock:
+            self.__refresh()
+            return dict(self.__state.get(plan_name, {}))
+
+    def get_value(self, plan_name, key, default=None):
+        with self.__lock:
+            self.__refresh()
+            return self.__state.get(plan_name, {}).get(key, default)
+
+    def update(self, plan_name, values):
+        with self.__lock, self.__file_lock():
+            self.__refresh()
+
+            plan_state = self.__state.setdefault(plan_name, {})
+            for key, value in values.items():
+                if value is None:
+                    plan_state.pop(key, None)
+                else:
+                    plan_state[key] = value
+
+            self.__write()
+
+    def __current_version(self):
+        try:
+            stat = os.stat(self.filename)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def __refresh(self):
+        version = self.__current_version()
+
+        if version == self.__file_version:
+            return
+
+        state = {}
+
+        if version is not None:
+            with open(self.filename, 'r') as state_file:
+                for line in state_file:
+                    parsed = _parse_line(line)
+                    if parsed is not None:
+                        plan_name, key, value = parsed
+                        state.setdefault(plan_name, {})[key] = value
+
+        self.__state = state
+        self.__file_version = version
+
+    def __write(self):
+        directory = os.path.dirname(self.filename)
+        fh, abs_path = mkstemp(dir=directory)
+
+        with os.fdopen(fh, 'w') as new_file:
+            for plan_name in sorted(self.__state):
+                for key in sorted(self.__state[plan_name]):
+                    new_file.write(_format_line(plan_name, key, self.__state[plan_name][key]))
+
+            new_file.flush()
+            os.fsync(new_file.fileno())
+
+        os.replace(abs_path, self.filename)
+
+        self.__file_version = self.__current_version()
+
+    @contextmanager
+    def __file_lock(self):
+        # Guards against other processes updating the same file, where the platform supports it
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class SqliteStateStore:
+    """
+        Keeps plan state in an SQLite database in WAL mode. Lookups are indexed, updates of several keys are a
+        single transaction, and any number of threads or processes can read and write at the same time.
+    """
+
+    def __init__(self, filename, legacy_hash_file=None):
+        self.filename = filename
+
+        self.__local = threading.local()
+
+        connection = self.__connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS plan_state ('
+                           'plan TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                           'PRIMARY KEY (plan, key)) WITHOUT ROWID')
+
+        if legacy_hash_file is not None and os.path.isfile(legacy_hash_file):
+            self.__import_legacy(legacy_hash_file)
+
+    def get(self, plan_name):
+        rows = self.__connection().execute('SELECT key, value FROM plan_state WHERE plan = ?', (plan_name,))
+        return dict((key, json.loads(value)) for key, value in rows)
+
+    def get_value(self, plan_name, key, default=None):
+        row = self.__connection().execute('SELECT value FROM plan_state WHERE plan = ? AND key = ?',
+                                          (plan_name, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def update(self, plan_name, values):
+        connection = self.__connection()
+
+        with self.__transaction(connection):
+            for key, value in values.items():
+                if value is None:
+                    connection.execute('DELETE FROM plan_state WHERE plan = ? AND key = ?', (plan_name, key))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO plan_state (plan, key, value) VALUES (?, ?, ?)',
+                                       (plan_name, key, json.dumps(value)))
+
+    def __connection(self):
+        connection = getattr(self.__local, 'connection', None)
+
+        if connection is None:
+            # Transactions are managed explicitly, see __transaction
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.__local.connection = connection
+
+        return connection
+
+    @contextmanager
+    def __transaction(self, connection):
+        # Take the write lock up front, so concurrent writers queue rather than fail part way through
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __import_legacy(self, legacy_hash_file):
+        connection = self.__connection()
+
+        with self.__transaction(connection):
+            if connection.execute('SELECT COUNT(*) FROM plan_state').fetchone()[0] > 0:
+                return
+
+            imported = 0
+            with open(legacy_hash_file, 'r') as state_file:
+                for line in state_file:
+                    parsed = _parse_line(line)
+                    if parsed is not None:
+                        plan_name, key, value = parsed
+                        connection.execute('INSERT OR REPLACE INTO plan_state (plan, key, value) VALUES (?, ?, ?)',
+                                           (plan_name, key, json.dumps(value)))
+                        imported += 1
+
+        logger.info('Imported %d values from %s', imported, legacy_hash_file)
@@ -0,0 +1,173 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+logger = logging.getLogger(name='MultipartUploadStream')
+
+
+class MultipartUploadStream:
+    """
+        Write-only, unseekable file object which sends everything written to it to S3 as a multipart upload.
+
+        At most max_in_flight parts (plus the part currently being filled) are held in memory at once, writers
+        block until a part upload completes when that limit is reached. Nothing is stored in S3 until complete()
+        is called, so the upload can still be abandoned with abort() once all the data has been written.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=MIN_PART_SIZE, max_in_flight=2, throttle=None):
+        if part_size < MIN_PART_SIZE:
+            raise Exception('Multipart upload part size must be at least %d bytes' % MIN_PART_SIZE)
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.throttle = throttle
+
+        self.__buffer = bytearray()
+        self.__position = 0
+        self.__parts = {}
+        self.__futures = []
+        self.__part_number = 0
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.__finished = False
+        self.__started = time.monotonic()
+
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self.upload_id = response['UploadId']
+
+        logger.debug('Started multipart upload %s for %s', self.upload_id, self.key)
+
+    def write(self, data):
+        if self.__finished:
+            raise ValueError('Write to a finished upload stream')
+
+        self.__buffer += data
+        self.__position += len(data)
+
+        while len(self.__buffer) >= self.part_size:
+            self.__send_part(bytes(self.__buffer[:self.part_size]))
+            del self.__buffer[:self.part_size]
+
+        return len(data)
+
+    def tell(self):
+        return self.__position
+
+    def flush(self):
+        # Parts are only sent once full, everything else stays buffered until complete()
+        pass
+
+    def complete(self):
+        """
+            Send the final (possibly short) part and complete the upload
+        """
+        if len(self.__buffer) > 0 or self.__part_number == 0:
+            self.__send_part(bytes(self.__buffer))
+            self.__buffer = bytearray()
+
+        self.__finished = True
+
+        try:
+            self.__wait_for_parts()
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={
+                    'Parts': [{'ETag': self.__parts[number], 'PartNumber': number}
+                              for number in sorted(self.__parts)]
+                })
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.__executor.shutdown(wait=True)
+
+        seconds = max(time.monotonic() - self.__started, 0.001)
+        logger.info('Completed multipart upload of %s (%d bytes in %d parts, %.1fs, %.2f MB/s)',
+                    self.key, self.__position, len(self.__parts), seconds,
+                    self.__position / 1024.0 / 1024.0 / seconds)
+
+    def abort(self):
+        """
+            Discard everything sent so far, so no partial object (or billed parts) are left behind
+        """
+        self.__finished = True
+        self.__buffer = bytearray()
+        self.__executor.shutdown(wait=True)
+
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logger.info('Aborted multipart upload of %s', self.key)
+        except Exception as e:
+            logger.error('Failed to abort multipart upload %s of %s: %s', self.upload_id, self.key, e)
+
+    def __send_part(self, data):
+        self.__part_number += 1
+
+        if self.__part_number > MAX_PARTS:
+            raise Exception('Upload of %s needs more than %d parts, increase the part size' % (self.key, MAX_PARTS))
+
+        # Re-raise any failures from earlier parts before queueing more work
+        for future in [f for f in self.__futures if f.done()]:
+            future.result()
+            self.__futures.remove(future)
+
+        self.__slots.acquire()
+
+        try:
+            self.__futures.append(self.__executor.submit(self.__upload_part, self.__part_number, data))
+        except Exception:
+            self.__slots.release()
+            raise
+
+    def __upload_part(self, part_number, data):
+        try:
+            if self.throttle is not None:
+                self.throttle.consume(len(data))
+
+            response = self.s3_client.upload_part(Bucket=self.bucket,
+                                                  Key=self.key,
+                                                  UploadId=self.upload_id,
+                                                  PartNumber=part_number,
+                                                  Body=data)
+            self.__parts[part_number] = response['ETag']
+            logger.debug('Uploaded part %d of %s (%d bytes)', part_number, self.key, len(data))
+        finally:
+            self.__slots.release()
+
+    def __wait_for_parts(self):
+        for future in self.__futures:
+            future.result()
+        self.__futures = []
@@ -0,0 +1,380 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import os
+import threading
+import time
+from S3Backup.resumable_upload import ResumableUpload
+from S3Backup.stream_upload import MultipartUploadStream
+
+transfer_values = ['PartSize', 'MaxConcurrency', 'MaxPoolConnections', 'BandwidthLimit', 'BandwidthLimitHours']
+
+default_transfer_settings = {
+    'PartSize': 8,              # MB
+    'MaxConcurrency': 10,
+    'MaxPoolConnections': None,  # Defaults to MaxConcurrency
+    'BandwidthLimit': None,     # KB/s
+    'BandwidthLimitHours': None  # e.g. "08:00-18:00", local time. Always applies when not set
+}
+
+logger = logging.getLogger(name='TransferEngine')
+
+
+def transfer_settings(*raw_settings):
+    """
+        Merge the defaults with each set of settings in turn (e.g. the root, then a plan's own overrides)
+    """
+    settings = dict(default_transfer_settings)
+
+    for raw in raw_settings:
+        if raw is None:
+            continue
+
+        for key, value in raw.items():
+            if key not in transfer_values:
+                raise Exception('Unknown transfer setting: %s' % key)
+            settings[key] = value
+
+    if settings['MaxPoolConnections'] is None:
+        settings['MaxPoolConnections'] = settings['MaxConcurrency']
+
+    return settings
+
+
+def _parse_hours(hours):
+    start, end = hours.split('-')
+    start_hour, start_minute = start.strip().split(':')
+    end_hour, end_minute = end.strip().split(':')
+    return int(start_hour) * 60 + int(start_minute), int(end_hour) * 60 + int(end_minute)
+
+
+class TokenBucket:
+    """
+        Limits throughput to rate bytes per second, allowing bursts of up to one second's worth. When hours
+        are given ("HH:MM-HH:MM", local time, may wrap past midnight) the limit only applies within them.
+    """
+
+    def __init__(self, rate, hours=None):
+        self.rate = float(rate)
+        self.capacity = float(rate)
+        self.hours = _parse_hours(hours) if hours is not None else None
+
+        self.__tokens = self.capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def active(self):
+        if self.hours is None:
+            return True
+
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        start, end = self.hours
+
+        if start <= end:
+            return start <= minute < end
+
+        return minute >= start or minute < end
+
+    def consume(self, amount):
+        if not self.active():
+            return
+
+        while amount > 0:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+                self.__last = now
+
+                # Large requests are taken in pieces, so they never wait on more than the bucket can hold
+                take = min(amount, self.capacity)
+
+                if self.__tokens >= take:
+                    self.__tokens -= take
+                    amount -= take
+                    continue
+
+                wait = (take - self.__tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    """
+        File object wrapper which holds back reads to stay within a token bucket
+    """
+
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class TransferEngine:
+    """
+        Owns the boto3 session and clients shared by every plan, so connections are pooled and reused across
+        plans and runs, and applies the configured part size, concurrency and bandwidth limits to transfers.
+    """
+
+    def __init__(self, configuration):
+        self.CONFIGURATION = configuration
+        self.settings = transfer_settings(configuration['TRANSFER'])
+
+        self.__session = None
+        self.__clients = {}
+        self.__buckets = {}
+        self.__tracked = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        return self.CONFIGURATION['AWS_BUCKET']
+
+    def client(self, service='s3', settings=None):
+        """
+            Clients are thread safe, so one is shared for each service and connection pool size
+        """
+        if settings is None:
+            settings = self.settings
+
+        key = (service, settings['MaxPoolConnections'])
+
+        with self.__lock:
+            if key not in self.__clients:
+                # boto3 is slow to import, so it is only loaded once something is actually sent to AWS
+                import boto3
+                from botocore.config import Config
+
+                # Sessions are not thread safe, so they are only ever used under the lock
+                if self.__session is None:
+                    self.__session = boto3.session.Session(
+                        region_name=self.CONFIGURATION['AWS_REGION'],
+                        aws_access_key_id=self.CONFIGURATION['AWS_KEY'],
+                        aws_secret_access_key=self.CONFIGURATION['AWS_SECRET']
+                    )
+
+                if service == 's3' and self.CONFIGURATION['AWS_ENDPOINT_URL'] is not None:
+                    # S3 compatible services (and local stand-ins) are addressed by path rather than host name
+                    self.__clients[key] = self.__session.client(
+                        service,
+                        endpoint_url=self.CONFIGURATION['AWS_ENDPOINT_URL'],
+                        config=Config(max_pool_connections=settings['MaxPoolConnections'],
+                                      s3={'addressing_style': 'path'})
+                    )
+                else:
+                    self.__clients[key] = self.__session.client(
+                        service,
+                        config=Config(max_pool_connections=settings['MaxPoolConnections'])
+                    )
+
+                if service == 's3':
+                    self.__instrument(self.__clients[key])
+
+            return self.__clients[key]
+
+    def track(self, prefix, plan_metrics):
+        """
+            Record the S3 requests for keys under the prefix against the plan's metrics, until untracked. Clients
+            are shared between plans running at the same time, so requests are told apart by their keys.
+        """
+        with self.__lock:
+            self.__tracked[prefix] = plan_metrics
+
+    def untrack(self, prefix):
+        with self.__lock:
+            self.__tracked.pop(prefix, None)
+
+    def __instrument(self, s3_client):
+        s3_client.meta.events.register('provide-client-params.s3', self.__request_started)
+        s3_client.meta.events.register('after-call.s3', self.__request_finished)
+        s3_client.meta.events.register('after-call-error.s3', self.__request_failed)
+
+    def __request_started(self, params, model, context, **kwargs):
+        key = params.get('Key', params.get('Prefix'))
+
+        if key is None and 'Delete' in params and len(params['Delete'].get('Objects', [])) > 0:
+            key = params['Delete']['Objects'][0]['Key']
+
+        context['s3backup_request'] = (model.name, key, time.monotonic())
+
+    def __request_finished(self, http_response, context, **kwargs):
+        self.__record_request(context, http_response.status_code >= 300)
+
+    def __request_failed(self, context, **kwargs):
+        self.__record_request(context, True)
+
+    def __record_request(self, context, failed):
+        if 's3backup_request' not in context:
+            return
+
+        operation, key, started = context.pop('s3backup_request')
+
+        if key is None:
+            return
+
+        with self.__lock:
+            matches = [prefix for prefix in self.__tracked
+                       if key == prefix or key.startswith(prefix + '_') or key.startswith(prefix + '/')]
+            plan_metrics = self.__tracked[max(matches, key=len)] if len(matches) > 0 else None
+
+        if plan_metrics is not None:
+            plan_metrics.add_request(operation, time.monotonic() - started, failed)
+
+    def throttle(self, settings=None):
+        """
+            The token bucket for the settings, or None if they have no bandwidth limit. Plans with the same limit
+            share a bucket, so the limit applies to all of their traffic together.
+        """
+        if settings is None:
+            settings = self.settings
+
+        if settings['BandwidthLimit'] is None:
+            return None
+
+        key = (settings['BandwidthLimit'], settings['BandwidthLimitHours'])
+
+        with self.__lock:
+            if key not in self.__buckets:
+                self.__buckets[key] = TokenBucket(int(settings['BandwidthLimit']) * 1024,
+                                                  settings['BandwidthLimitHours'])
+
+            return self.__buckets[key]
+
+    def part_size(self, settings=None):
+        if settings is None:
+            settings = self.settings
+
+        return int(settings['PartSize']) * 1024 * 1024
+
+    def upload_file(self, filename, key, settings=None, extra_args=None):
+        if settings is None:
+            settings = self.settings
+
+        s3_client = self.client('s3', settings)
+        bucket = self.throttle(settings)
+
+        # Already imported by client()
+        import boto3.s3.transfer
+
+        config = boto3.s3.transfer.TransferConfig(multipart_threshold=self.part_size(settings),
+                                                  multipart_chunksize=self.part_size(settings),
+                                                  max_concurrency=int(settings['MaxConcurrency']))
+
+        size = os.path.getsize(filename)
+        started = time.monotonic()
+
+        if bucket is not None:
+            with open(filename, 'rb') as source:
+                s3_client.upload_fileobj(ThrottledReader(source, bucket), self.bucket, key,
+                                         ExtraArgs=extra_args, Config=config)
+        else:
+            s3_client.upload_file(filename, self.bucket, key, ExtraArgs=extra_args, Config=config)
+
+        self.log_throughput('Uploaded', key, size, time.monotonic() - started)
+
+        return size
+
+    def copy(self, source_key, key, settings=None, extra_args=None):
+        """
+            Copy an object within the bucket without downloading it, as a multipart copy if it is larger than a part
+        """
+        if settings is None:
+            settings = self.settings
+
+        s3_client = self.client('s3', settings)
+
+        # Already imported by client()
+        import boto3.s3.transfer
+
+        config = boto3.s3.transfer.TransferConfig(multipart_threshold=self.part_size(settings),
+                                                  multipart_chunksize=self.part_size(settings),
+                                                  max_concurrency=int(settings['MaxConcurrency']))
+
+        extra_args = dict(extra_args or {})
+        if 'Metadata' in extra_args:
+            extra_args['MetadataDirective'] = 'REPLACE'
+
+        started = time.monotonic()
+
+        s3_client.copy({'Bucket': self.bucket, 'Key': source_key}, self.bucket, key, ExtraArgs=extra_args,
+                       Config=config)
+
+        logger.info('Copied %s to %s in %.1fs', source_key, key, time.monotonic() - started)
+
+    def resumable_upload(self, filename, key, checkpoint, previous_state=None, settings=None, extra_args=None):
+        """
+            Upload a file as a multipart upload which saves its progress through checkpoint(state), so passing
+            that state back in after an interruption only sends the parts which are missing. Files no bigger
+            than one part are uploaded normally, as there would be nothing to resume.
+        """
+        if settings is None:
+            settings = self.settings
+
+        if os.path.getsize(filename) <= self.part_size(settings):
+            return self.upload_file(filename, key, settings, extra_args)
+
+        upload = ResumableUpload(self.client('s3', settings),
+                                 self.bucket,
+                                 key,
+                                 filename,
+                                 self.part_size(settings),
+                                 max_in_flight=int(settings['MaxConcurrency']),
+                                 throttle=self.throttle(settings),
+                                 checkpoint=checkpoint,
+                                 previous_state=previous_state,
+                                 extra_args=extra_args)
+
+        started = time.monotonic()
+        size = upload.run()
+
+        self.log_throughput('Uploaded', key, upload.sent_bytes, time.monotonic() - started)
+
+        return size
+
+    def multipart_stream(self, key, settings=None, part_size=None):
+        if settings is None:
+            settings = self.settings
+
+        if part_size is None:
+            part_size = self.part_size(settings)
+
+        return MultipartUploadStream(self.client('s3', settings),
+                                     self.bucket,
+                                     key,
+                                     part_size=part_size,
+                                     max_in_flight=int(settings['MaxConcurrency']),
+                                     throttle=self.throttle(settings))
+
+    @staticmethod
+    def log_throughput(action, key, size, seconds):
+        logger.info('%s %s: %d bytes in %.1fs (%.2f MB/s)',
+                    action, key, size, seconds, size / 1024.0 / 1024.0 / max(seconds, 0.001))
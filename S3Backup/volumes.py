@@ -0,0 +1,307 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Mike Goodfellow
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tempfile import mkstemp
+from S3Backup import compression
+from S3Backup import encryption
+from S3Backup import hash_file
+
+INDEX_VERSION = 1
+
+# "<prefix>_<timestamp>.volumes.json" lists the volumes "<prefix>_<timestamp>.vol0001.zip", ".vol0002.zip", ...
+INDEX_SUFFIX = '.volumes.json'
+VOLUME_PATTERN = re.compile(r'\.vol\d{4,}(\.[a-z.]+)$')
+
+DEFAULT_UPLOAD_THREADS = 2
+
+READ_SIZE = 1024 * 1024
+
+logger = logging.getLogger(name='Volumes')
+
+
+def volume_key(base_key, number, extension):
+    return '%s.vol%04d%s' % (base_key, number, extension)
+
+
+def is_volume(key):
+    return VOLUME_PATTERN.search(key) is not None
+
+
+def is_index(key):
+    return key.endswith(INDEX_SUFFIX)
+
+
+def incomplete(keys):
+    """
+        Whether the keys of one backup are volumes without an index, left behind by a run which never finished
+    """
+    return any(is_volume(key) for key in keys) and not any(is_index(key) for key in keys)
+
+
+def backup_key(keys):
+    """
+        The key to restore (or read the hash of) one backup from the keys sharing its timestamp: the volume index
+        of a split backup, otherwise the archive. None if there isn't a finished backup among them.
+    """
+    for key in keys:
+        if is_index(key):
+            return key
+
+    archives = [key for key in keys
+                if encryption.plain_key(key).endswith(tuple(compression.FORMATS.values())) and not is_volume(key)]
+
+    return archives[-1] if len(archives) > 0 else None
+
+
+def combined_hash(volume_hashes, algorithm=hash_file.DEFAULT_ALGORITHM):
+    # Volume boundaries only depend on the source files, so the same files always give the same volumes
+    hasher = hash_file.new_hasher(algorithm)
+    hasher.update('\n'.join(volume_hashes).encode('utf-8'))
+    return hash_file.format_hash(algorithm, hasher.hexdigest())
+
+
+def upload_index(s3_client, bucket, key, index, metadata=None):
+    body = json.dumps(index, indent=1).encode('utf-8')
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body, Metadata=metadata or {})
+    logger.info('Uploaded volume index %s (%d volumes)', key, len(index['volumes']))
+
+
+def load_index(s3_client, bucket, key):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    index = json.loads(response['Body'].read().decode('utf-8'))
+
+    if index.get('version') != INDEX_VERSION:
+        raise Exception('Unknown volume index version in %s: %s' % (key, index.get('version')))
+
+    return index
+
+
+def _source_size(file_name):
+    try:
+        return 0 if os.path.isdir(file_name) else os.path.getsize(file_name)
+    except OSError:
+        # Left for the archive to report
+        return 0
+
+
+def split_volumes(fileset, max_size=None, max_entries=None):
+    """
+        Split the file set into the files of each volume, so each holds at most max_size bytes of source files
+        (a larger file gets a volume of its own) and max_entries entries. The volumes are split by the sizes of
+        the source files rather than of the compressed output, so the same files always split the same way.
+
+        Each volume's files are produced lazily, and have to be used up before asking for the next volume.
+        There is always at least one volume, even if it is empty.
+    """
+    fileset = iter(fileset)
+    state = {'next': next(fileset, None)}
+
+    def volume():
+        size = 0
+        entries = 0
+
+        while state['next'] is not None:
+            file_size = _source_size(state['next'])
+
+            if entries > 0 and ((max_entries is not None and entries >= max_entries) or
+                                (max_size is not None and size + file_size > max_size)):
+                return
+
+            yield state['next']
+
+            size += file_size
+            entries += 1
+            state['next'] = next(fileset, None)
+
+    yield volume()
+
+    while state['next'] is not None:
+        yield volume()
+
+
+class FileList:
+    """
+        A file set written out to a temporary file, so it can be gone through more than once without holding
+        millions of paths in memory
+    """
+
+    def __init__(self, fileset, directory=None):
+        fh, self.filename = mkstemp(dir=directory, suffix='.files')
+        self.count = 0
+
+        try:
+            with os.fdopen(fh, 'wb') as output:
+                for file_name in fileset:
+                    # Names can't contain a NUL, unlike a new line
+                    output.write(os.fsencode(file_name) + b'\0')
+                    self.count += 1
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as source:
+            remainder = b''
+
+            for data in iter(lambda: source.read(READ_SIZE), b''):
+                names = (remainder + data).split(b'\0')
+                remainder = names.pop()
+
+                for name in names:
+                    yield os.fsdecode(name)
+
+    def close(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class VolumeUploads:
+    """
+        Uploads the volumes of a backup as each is finished, a few at a time, while the next ones are written.
+        Finished volumes are deleted locally once uploaded, and adding a volume waits while all the upload
+        threads are busy, so only a few volumes are ever on the local disk.
+
+        Volumes the same as the volume in the same place in the previous backup are held back until one differs,
+        so a backup which turns out not to have changed never uploads anything. Only their keys are held, not the
+        files, and once a volume differs each of them is copied from the previous backup within S3.
+    """
+
+    def __init__(self, upload, copy, delete, previous_hashes=None, previous_keys=None,
+                 threads=DEFAULT_UPLOAD_THREADS):
+        self.volumes = []
+
+        # upload(filename, key, hash_value, expected_etag), copy(source_key, key, hash_value), delete(keys) and
+        # previous_keys(), the keys of the previous backup's volumes
+        self.__upload = upload
+        self.__copy = copy
+        self.__delete = delete
+        self.__previous_hashes = previous_hashes or []
+        self.__previous_keys = previous_keys
+        self.__threads = max(1, threads)
+        self.__executor = ThreadPoolExecutor(max_workers=self.__threads)
+        self.__in_flight = []
+        self.__held = []
+        self.__uploaded = []
+        self.__lock = threading.Lock()
+
+    def add(self, filename, key, hash_value, size, expected_etag=None):
+        number = len(self.volumes)
+        self.volumes.append({'key': key, 'hash': hash_value, 'size': size})
+
+        if len(self.__held) == number and number < len(self.__previous_hashes) and \
+                self.__previous_hashes[number] == hash_value:
+            logger.debug('Volume %s is unchanged, holding it back', key)
+            self.__held.append((number, key, hash_value))
+            _remove(filename)
+            return
+
+        self.__release_held()
+        self.__submit(self.__run_upload, filename, key, hash_value, expected_etag)
+
+    def finish(self):
+        """
+            Copy anything held back, and wait for every upload to finish
+        """
+        self.__release_held()
+
+        try:
+            for future in self.__in_flight:
+                future.result()
+        finally:
+            self.__executor.shutdown()
+
+    def discard(self):
+        """
+            Abandon the backup, deleting whatever was uploaded of it
+        """
+        for future in self.__in_flight:
+            future.cancel()
+
+        self.__executor.shutdown()
+
+        self.__held = []
+
+        if len(self.__uploaded) > 0:
+            logger.info('Removing %d uploaded volumes', len(self.__uploaded))
+
+            try:
+                self.__delete(self.__uploaded)
+            except Exception as e:
+                logger.error('Failed to remove uploaded volumes: %s', e)
+
+    def __release_held(self):
+        if len(self.__held) == 0:
+            return
+
+        # Only looked up once a volume differs, so an unchanged backup makes no requests for them
+        previous_keys = self.__previous_keys()
+
+        for number, key, hash_value in self.__held:
+            self.__submit(self.__run_copy, previous_keys[number], key, hash_value)
+
+        self.__held = []
+
+    def __submit(self, function, *args):
+        while len(self.__in_flight) >= self.__threads:
+            done, pending = wait(self.__in_flight, return_when=FIRST_COMPLETED)
+            self.__in_flight = list(pending)
+
+            # A failed upload fails the backup straight away, rather than once every volume is written
+            for future in done:
+                future.result()
+
+        self.__in_flight.append(self.__executor.submit(function, *args))
+
+    def __run_upload(self, filename, key, hash_value, expected_etag):
+        try:
+            self.__upload(filename, key, hash_value, expected_etag)
+
+            with self.__lock:
+                self.__uploaded.append(key)
+        finally:
+            _remove(filename)
+
+    def __run_copy(self, source_key, key, hash_value):
+        self.__copy(source_key, key, hash_value)
+
+        with self.__lock:
+            self.__uploaded.append(key)
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        logger.error('Failed to remove temporary file %s: %s', filename, e)
@@ -0,0 +1,286 @@
+import fnmatch
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_THREADS = 4
+
+logger = logging.getLogger(name='Walker')
+
+_MAGIC = re.compile('[*?[]')
+_FLAGS = re.IGNORECASE if os.name == 'nt' else 0
+
+
+def has_magic(component):
+    return _MAGIC.search(component) is not None
+
+
+def split_path(path):
+    """
+        Split a path into its components, keeping the root (such as "/" or "c:\\") as the first one
+    """
+    drive, rest = os.path.splitdrive(path)
+    parts = [part for part in re.split('[\\\\/]' if os.altsep else '/', rest) if part not in ['', '.']]
+
+    if rest[:1] in [os.sep, os.altsep or os.sep]:
+        return [drive + os.sep] + parts
+
+    if drive != '':
+        return [drive] + parts
+
+    return parts
+
+
+class _Part:
+    """
+        One component of a glob pattern: "**", a wildcard such as "*.txt", or a literal name
+    """
+
+    def __init__(self, text, literal=False):
+        self.double = not literal and text == '**'
+        self.literal = text if literal or not has_magic(text) else None
+        # Hidden names are only matched by a component which starts with a dot itself, as with shell globs
+        self.dot = text.startswith('.')
+
+        if self.literal is not None and not _FLAGS:
+            self.match = self.literal.__eq__
+        elif self.literal is not None:
+            self.match = re.compile(re.escape(self.literal) + '$', _FLAGS).match
+        else:
+            self.match = re.compile(fnmatch.translate(text), _FLAGS).match
+
+
+def _compile(pattern):
+    return [_Part(part) for part in split_path(pattern)]
+
+
+def _match(parts, names, include_hidden, prefix=False, pi=0, ni=0):
+    """
+        Does the list of names match the pattern parts? With prefix, could names followed by more names match?
+    """
+    while True:
+        if ni == len(names):
+            if prefix:
+                return pi < len(parts)
+            return all(part.double for part in parts[pi:])
+
+        if pi == len(parts):
+            return False
+
+        part = parts[pi]
+        name = names[ni]
+
+        if part.double:
+            if _match(parts, names, include_hidden, prefix, pi + 1, ni):
+                return True
+            if not include_hidden and name.startswith('.'):
+                return False
+            ni += 1
+            continue
+
+        if not part.match(name):
+            return False
+        if not include_hidden and name.startswith('.') and not part.dot:
+            return False
+
+        pi += 1
+        ni += 1
+
+
+class _Exclude:
+    """
+        A pattern without a separator (e.g. "node_modules" or "*.tmp") matches that name anywhere in the tree,
+        a relative pattern matches the end of a path ("build/**/*.o"), and an absolute one the whole path.
+    """
+
+    def __init__(self, pattern):
+        self.parts = _compile(os.path.normpath(pattern))
+        self.anchored = os.path.isabs(pattern)
+
+        if not self.anchored:
+            self.parts = [_Part('**')] + self.parts
+
+        self.name_only = not self.anchored and len(self.parts) == 2
+
+    def matches(self, name, components):
+        if self.name_only:
+            return bool(self.parts[1].match(name))
+
+        return _match(self.parts, components(), True)
+
+
+class _Root:
+    """
+        A directory to walk, and the include patterns (relative to it) which are matched below it. Each pattern
+        comes with the depth of the directory it was written for, as a pattern never matches that directory
+        itself, even once folded into a root further up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = split_path(path)
+        self.patterns = []
+
+
+def _scan(path):
+    """
+        Sorted (name, path, is_dir, is_symlink) for each entry in the directory, or [] if it can't be read
+    """
+    try:
+        with os.scandir(path) as iterator:
+            entries = [(entry.name, entry.path, entry.is_dir(), entry.is_symlink()) for entry in iterator]
+    except OSError as e:
+        logger.warning('Unable to read directory %s: %s', path, e)
+        return []
+
+    entries.sort()
+    return entries
+
+
+class Walker:
+    """
+        Enumerates the files and directories matching a set of glob patterns (which may use "**" for any number
+        of directories) with os.scandir. Directories matching an exclude pattern are pruned without being read,
+        and directories which can't contain a match are never read at all.
+
+        Each directory is walked at most once however the patterns overlap, so every path is produced once.
+        Entries are produced in sorted order as they are found, while the directories coming up next are read
+        ahead on a pool of threads.
+
+        Given a directory cache (a watcher.DirectoryCache), directories are listed through it, so only those
+        which have changed since it last listed them are read again.
+    """
+
+    def __init__(self, patterns, excludes=None, include_hidden=False, threads=DEFAULT_THREADS, cache=None):
+        self.include_hidden = include_hidden
+        self.threads = max(1, threads)
+        self.cache = cache
+        self.excludes = [_Exclude(pattern) for pattern in (excludes or [])]
+
+        self.literals = []
+        self.roots = []
+
+        self.__add_patterns([os.path.normpath(pattern) for pattern in patterns])
+
+    def __add_patterns(self, patterns):
+        roots = {}
+
+        for pattern in patterns:
+            parts = split_path(pattern)
+            static = 0
+            while static < len(parts) and not has_magic(parts[static]):
+                static += 1
+
+            if static == len(parts):
+                # No wildcards, so there is nothing to walk
+                if pattern not in self.literals:
+                    self.literals.append(pattern)
+                continue
+
+            base = os.path.join(*parts[:static]) if static > 0 else os.curdir
+            roots.setdefault(base, []).append([_Part(part) for part in parts[static:]])
+
+        # Roots inside another root are folded into it, so no directory is ever walked twice
+        for base in sorted(roots, key=lambda path: len(split_path(path))):
+            outer = self.__find_root(base)
+
+            if outer is None:
+                outer = _Root(base)
+                self.roots.append(outer)
+                prefix = []
+            else:
+                prefix = [_Part(name, literal=True) for name in split_path(base)[len(outer.parts):]]
+
+            outer.patterns.extend((prefix + pattern, len(prefix)) for pattern in roots[base])
+
+        self.roots.sort(key=lambda root: root.path)
+
+    def __find_root(self, path):
+        parts = split_path(path)
+
+        for root in self.roots:
+            if parts[:len(root.parts)] == root.parts:
+                return root
+
+        return None
+
+    def __iter__(self):
+        seen_literals = set()
+
+        for literal in self.literals:
+            if self.cache is not None:
+                self.cache.watch_path(literal)
+
+            if os.path.lexists(literal) and not self.__excluded(os.path.basename(literal), split_path(literal)):
+                seen_literals.add(literal)
+                yield literal
+
+        if len(self.roots) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for root in self.roots:
+                if not os.path.isdir(root.path):
+                    if self.cache is not None:
+                        self.cache.watch_path(root.path)
+                    continue
+
+                for path in self.__walk(executor, root, root.path, [], self.__scan(executor, root.path)):
+                    if path not in seen_literals:
+                        yield path
+
+    def __walk(self, executor, root, directory, names, listing):
+        entries = listing.result()
+        subdirectories = []
+
+        for name, path, is_dir, is_symlink in entries:
+            entry_names = names + [name]
+
+            if self.__excluded(name, lambda: root.parts + entry_names):
+                continue
+
+            if any(len(entry_names) > depth and _match(pattern, entry_names, self.include_hidden)
+                   for pattern, depth in root.patterns):
+                yield path
+
+            if is_dir and any(_match(pattern, entry_names, self.include_hidden, prefix=True)
+                              for pattern, depth in root.patterns):
+                if is_symlink and self.__is_loop(directory, path):
+                    logger.warning('Not following symlink back into its own tree: %s', path)
+                    continue
+                subdirectories.append((path, entry_names))
+
+        # Read ahead a few of the directories which will be walked next, keeping memory bounded on wide trees
+        window = self.threads * 2
+        pending = []
+
+        for index, (path, entry_names) in enumerate(subdirectories):
+            while len(pending) < window and index + len(pending) < len(subdirectories):
+                pending.append(self.__scan(executor, subdirectories[index + len(pending)][0]))
+
+            for found in self.__walk(executor, root, path, entry_names, pending.pop(0)):
+                yield found
+
+    def __scan(self, executor, path):
+        if self.cache is not None:
+            return executor.submit(self.cache.scan, path, _scan)
+
+        return executor.submit(_scan, path)
+
+    def __excluded(self, name, components):
+        if len(self.excludes) == 0:
+            return False
+
+        if not callable(components):
+            full = components
+            components = lambda: full
+
+        return any(exclude.matches(name, components) for exclude in self.excludes)
+
+    @staticmethod
+    def __is_loop(directory, path):
+        target = os.path.realpath(path)
+        current = os.path.realpath(directory)
+
+        return current == target or current.startswith(target.rstrip(os.sep) + os.sep)
@@ -0,0 +1,269 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Events for an entry which add, remove or replace a whole directory tree
+TREE_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+logger = logging.getLogger(name='Watcher')
+
+
+def _libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    return libc if hasattr(libc, 'inotify_init1') else None
+
+
+class InotifyWatcher:
+    """
+        Watches directories with inotify (through ctypes, so Linux only), recording which have changed. Events
+        wait in the kernel until changes() reads them, so nothing runs in the background. If the queue
+        overflows, changes may have been missed, and that is reported instead.
+    """
+
+    def __init__(self):
+        self.__libc = _libc()
+
+        if self.__libc is None:
+            raise Exception('inotify is not available on this platform')
+
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1 failed: %s' % os.strerror(error))
+
+        self.__paths = {}
+        self.__descriptors = {}
+        self.__dirty = set()
+        self.__dirty_trees = set()
+        self.__overflowed = False
+        self.__lock = threading.Lock()
+
+    def watch(self, path):
+        """
+            Watch a directory, returning whether it is being watched
+        """
+        with self.__lock:
+            if path in self.__descriptors:
+                return True
+
+            descriptor = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), WATCH_MASK)
+
+            if descriptor < 0:
+                error = ctypes.get_errno()
+
+                if error == errno.ENOSPC:
+                    logger.warning('Out of inotify watches, so %s will be scanned on every run. '
+                                   'Raise fs.inotify.max_user_watches to watch more directories', path)
+                elif error not in [errno.ENOENT, errno.ENOTDIR]:
+                    logger.debug('Could not watch %s: %s', path, os.strerror(error))
+
+                return False
+
+            self.__paths[descriptor] = path
+            self.__descriptors[path] = descriptor
+
+            return True
+
+    def changes(self):
+        """
+            Read the waiting events, returning (directories whose contents changed, directories whose whole tree
+            was created, removed or moved, whether changes may have been missed) since the last call
+        """
+        self.__read_events()
+
+        with self.__lock:
+            changes = (self.__dirty, self.__dirty_trees, self.__overflowed)
+            self.__dirty = set()
+            self.__dirty_trees = set()
+            self.__overflowed = False
+
+            return changes
+
+    def __read_events(self):
+        while True:
+            try:
+                data = os.read(self.__fd, READ_SIZE)
+            except BlockingIOError:
+                return
+
+            offset = 0
+
+            with self.__lock:
+                while offset + EVENT_HEADER.size <= len(data):
+                    descriptor, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                    name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                    offset += EVENT_HEADER.size + length
+
+                    self.__handle(descriptor, mask, name)
+
+    def __handle(self, descriptor, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Too many changes to track at once, the sources will be scanned in full')
+            self.__overflowed = True
+            return
+
+        path = self.__paths.get(descriptor)
+        if path is None:
+            return
+
+        self.__dirty.add(path)
+
+        if name and mask & IN_ISDIR and mask & TREE_EVENTS:
+            self.__dirty_trees.add(os.path.join(path, os.fsdecode(name)))
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            # The path no longer names what is watched, so the watch is dropped and made again if it is listed
+            self.__dirty_trees.add(path)
+
+            if not mask & IN_IGNORED:
+                self.__libc.inotify_rm_watch(self.__fd, descriptor)
+
+            del self.__paths[descriptor]
+            del self.__descriptors[path]
+
+    def close(self):
+        os.close(self.__fd)
+
+
+class DirectoryCache:
+    """
+        Directory listings kept between runs of a plan, for the walker. Every directory listed is watched first,
+        so only directories which have changed since are listed again, and a plan whose sources have not changed
+        at all since its last successful run can be skipped without walking them.
+
+        Until a run has completed with the watches in place, or if changes may have been missed, the sources
+        are always treated as changed. Without inotify, nothing is cached.
+    """
+
+    def __init__(self):
+        try:
+            self.__watcher = InotifyWatcher()
+        except Exception as e:
+            logger.info('Not tracking changes to source files: %s', e)
+            self.__watcher = None
+
+        self.__listings = {}
+        self.__changed = True
+        self.__lock = threading.Lock()
+
+    @property
+    def tracking(self):
+        return self.__watcher is not None
+
+    def poll(self):
+        """
+            Drop the listings of everything which has changed. Called regularly, so the kernel's event queue
+            doesn't overflow, but never while the plan is running.
+        """
+        if self.__watcher is None:
+            return
+
+        dirty, dirty_trees, overflowed = self.__watcher.changes()
+
+        with self.__lock:
+            if overflowed:
+                self.__listings.clear()
+                self.__changed = True
+                return
+
+            for path in dirty:
+                self.__listings.pop(path, None)
+
+            for tree in dirty_trees:
+                prefix = tree.rstrip(os.sep) + os.sep
+                for path in [path for path in self.__listings if path == tree or path.startswith(prefix)]:
+                    del self.__listings[path]
+
+            if len(dirty) > 0 or len(dirty_trees) > 0:
+                self.__changed = True
+
+    def changed(self):
+        """
+            Whether anything under the sources may have changed since the last successful run
+        """
+        self.poll()
+
+        return self.__watcher is None or self.__changed
+
+    def begin_run(self):
+        self.poll()
+        self.__changed = False
+
+    def end_run(self, success):
+        if not success:
+            self.__changed = True
+
+    def scan(self, path, scan):
+        with self.__lock:
+            listing = self.__listings.get(path)
+
+        if listing is not None:
+            return listing
+
+        # The watch is made before reading, so no change can slip in between
+        watched = self.__watcher is not None and self.__watcher.watch(path)
+
+        listing = scan(path)
+
+        if watched:
+            with self.__lock:
+                self.__listings[path] = listing
+        elif self.__watcher is not None:
+            self.__changed = True
+
+        return listing
+
+    def watch_path(self, path):
+        """
+            Watch for changes to a path which isn't listed by the walker (a single file, or a directory which
+            doesn't exist yet), through the nearest directory containing it
+        """
+        if self.__watcher is None:
+            return
+
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+
+        while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory)
+
+        if not self.__watcher.watch(directory):
+            self.__changed = True
+
+    def close(self):
+        if self.__watcher is not None:
+            self.__watcher.close()
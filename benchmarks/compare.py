@@ -0,0 +1,85 @@
+"""
+Compare two sets of benchmark results from run.py, reporting the change in each metric for every dataset,
+variant and phase they have in common. Exits with status 1 if anything regressed by more than the threshold.
+
+    python benchmarks/compare.py before.json after.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+# Metric, and whether a higher value is better
+METRICS = [
+    ('wall_seconds', False),
+    ('cpu_seconds', False),
+    ('peak_rss_mb', False),
+    ('bytes_uploaded', False),
+    ('throughput_mb_s', True)
+]
+
+
+def _index(results):
+    return dict(((result['dataset'], result['variant']), result) for result in results['results'])
+
+
+def compare(before, after, threshold):
+    """
+        Returns a row (dataset, variant, phase, metric, before, after, change %, regressed) for each metric
+    """
+    rows = []
+    before_index = _index(before)
+    after_index = _index(after)
+
+    for key in sorted(set(before_index) & set(after_index)):
+        before_phases = before_index[key]['phases']
+        after_phases = after_index[key]['phases']
+
+        for phase in [name for name in after_phases if name in before_phases and name != 'generate']:
+            for metric, higher_is_better in METRICS:
+                old = before_phases[phase].get(metric)
+                new = after_phases[phase].get(metric)
+
+                if old is None or new is None:
+                    continue
+
+                change = (new - old) * 100.0 / old if old else (0.0 if new == old else float('inf'))
+                regressed = (change < -threshold) if higher_is_better else (change > threshold)
+
+                rows.append((key[0], key[1], phase, metric, old, new, change, regressed))
+
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Percentage change counted as a regression (default 10)')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = json.load(before_file)
+        after = json.load(after_file)
+
+    if before.get('scale') != after.get('scale'):
+        print('Warning: the results were run at different scales (%s and %s)' % (before.get('scale'),
+                                                                                 after.get('scale')))
+
+    print('Comparing %s with %s' % ((before.get('commit') or '?')[:10], (after.get('commit') or '?')[:10]))
+
+    rows = compare(before, after, args.threshold)
+
+    for dataset, variant, phase, metric, old, new, change, regressed in rows:
+        print('%-16s %-10s %-14s %-16s %14.2f %14.2f %+8.1f%%%s' %
+              (dataset, variant, phase, metric, old, new, change, '  REGRESSION' if regressed else ''))
+
+    regressions = [row for row in rows if row[7]]
+    print('%d regressions beyond %.0f%%' % (len(regressions), args.threshold))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Synthetic source trees for the benchmarks. Everything is generated from a fixed seed, so a dataset is the same
+on every run and results can be compared between commits.
+"""
+
+import os
+import random
+import shutil
+
+# name: [(file count, file size in bytes, kind, extension)]
+DATASETS = {
+    'small_files': [(20000, 2 * 1024, 'text', '.txt')],
+    'huge_files': [(1, 256 * 1024 * 1024, 'text', '.sql'), (1, 256 * 1024 * 1024, 'random', '.bin')],
+    'compressible': [(200, 1024 * 1024, 'text', '.log')],
+    'incompressible': [(200, 1024 * 1024, 'random', '.jpg')],
+}
+
+FILES_PER_DIRECTORY = 100
+BLOCK_SIZE = 1024 * 1024
+
+WORDS = ('insert into values select from where backup archive table index null default varchar integer '
+         'primary key create update delete commit transaction user order customer product price total '
+         'status pending shipped 2015 2016 2017 hello world lorem ipsum dolor sit amet').split()
+
+
+def _text_block(rng):
+    words = []
+    length = 0
+    while length < BLOCK_SIZE:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return (' '.join(words) + '\n').encode('ascii')[:BLOCK_SIZE]
+
+
+def _write_file(path, size, kind, rng, text_block):
+    with open(path, 'wb') as output:
+        remaining = size
+        while remaining > 0:
+            length = min(remaining, BLOCK_SIZE)
+
+            if kind == 'text':
+                # A random slice of a block of words compresses like real text, without generating it word by word
+                start = rng.randrange(0, BLOCK_SIZE - length + 1)
+                output.write(text_block[start:start + length])
+            else:
+                output.write(rng.getrandbits(length * 8).to_bytes(length, 'little'))
+
+            remaining -= length
+
+
+def files(name, scale=1.0):
+    """
+        The (relative path, size, kind) of every file in the dataset, scaling the number of files (or the size of
+        single huge files)
+    """
+    index = 0
+
+    for group, (count, size, kind, extension) in enumerate(DATASETS[name]):
+        if count == 1:
+            scaled_count, scaled_size = 1, max(1, int(size * scale))
+        else:
+            scaled_count, scaled_size = max(1, int(count * scale)), size
+
+        for number in range(scaled_count):
+            directory = 'group%d/dir%04d' % (group, number // FILES_PER_DIRECTORY)
+            yield os.path.join(directory, 'file%06d%s' % (index, extension)), scaled_size, kind
+            index += 1
+
+
+def generate(name, directory, scale=1.0, seed=0):
+    """
+        Write the dataset under the directory, returning the number of files and bytes written
+    """
+    rng = random.Random(seed)
+    text_block = _text_block(rng)
+    count = 0
+    total = 0
+
+    for relative_path, size, kind in files(name, scale):
+        path = os.path.join(directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_file(path, size, kind, rng, text_block)
+
+        count += 1
+        total += size
+
+    return count, total
+
+
+def modify(name, directory, fraction=0.01, scale=1.0, seed=1, originals=None):
+    """
+        Rewrite a fraction (at least one) of the files in the dataset with new content of the same size,
+        returning the number of bytes rewritten. With an originals directory the files are moved there first,
+        so restore() can put the dataset back as it was generated.
+    """
+    rng = random.Random(seed)
+    text_block = _text_block(rng)
+    all_files = list(files(name, scale))
+    total = 0
+
+    for relative_path, size, kind in rng.sample(all_files, max(1, int(len(all_files) * fraction))):
+        path = os.path.join(directory, relative_path)
+
+        if originals is not None:
+            original = os.path.join(originals, relative_path)
+            os.makedirs(os.path.dirname(original), exist_ok=True)
+            os.replace(path, original)
+
+        _write_file(path, size, kind, rng, text_block)
+        total += size
+
+    return total
+
+
+def restore(directory, originals):
+    """
+        Move the files saved by modify() back into the dataset, returning the number of files restored
+        (which keep their original content and modification times)
+    """
+    count = 0
+
+    for parent, directories, file_names in os.walk(originals):
+        for file_name in file_names:
+            original = os.path.join(parent, file_name)
+            os.replace(original, os.path.join(directory, os.path.relpath(original, originals)))
+            count += 1
+
+    shutil.rmtree(originals, ignore_errors=True)
+
+    return count
@@ -0,0 +1,319 @@
+"""
+End to end benchmarks of S3Backup plans against a local stand-in for S3 (or any S3 compatible endpoint, such
+as a moto server, with --endpoint).
+
+For each dataset a synthetic source tree is generated, then for each plan variant the plan is run three times:
+
+    first_backup    - nothing in the bucket or plan state yet, so the backup is built and uploaded
+    unchanged       - the same tree again, so nothing should be uploaded
+    modified        - after rewriting 1% of the files
+
+and the wall time, CPU time, throughput, peak RSS and bytes uploaded and written to disk are recorded for each
+phase, along with the plan's own metrics for each step of the run. Results are written as JSON, to be compared
+between commits with compare.py.
+
+    python benchmarks/run.py --scale 0.1 --output results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import datasets
+from S3Backup import config_loader
+
+RESULTS_VERSION = 1
+
+DEFAULT_VARIANTS = {
+    'store': {},
+    'deflate': {'Compression': {'Codec': 'deflate', 'Level': 6}}
+}
+
+PHASES = ['first_backup', 'unchanged', 'modified']
+
+logger = logging.getLogger(name='Benchmark')
+
+
+class StubProcess:
+    """
+        Runs s3_stub.py in its own process, so it doesn't count towards the memory and CPU being measured
+    """
+
+    def __init__(self, directory):
+        self.process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 's3_stub.py'),
+                                         '--directory', directory],
+                                        stdout=subprocess.PIPE)
+        self.port = int(self.process.stdout.readline())
+        self.endpoint = 'http://127.0.0.1:%d' % self.port
+
+    def stats(self):
+        with urlopen(self.endpoint + '/__stats') as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def _read_proc(path, field):
+    try:
+        with open(path) as proc_file:
+            for line in proc_file:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Linux only, resets VmHWM so the peak can be measured for each phase
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    peak = _read_proc('/proc/self/status', 'VmHWM:')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak //= 1024
+    return round(peak / 1024.0, 1)
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=BENCHMARK_DIR,
+                                stderr=subprocess.DEVNULL) != 0
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir or tempfile.mkdtemp(prefix='s3backup-bench-')
+        self.stub = None
+
+        if args.endpoint is None:
+            self.stub = StubProcess(os.path.join(self.workdir, 's3'))
+            self.endpoint = self.stub.endpoint
+        else:
+            self.endpoint = args.endpoint
+
+    def run(self):
+        commit, dirty = _git_commit()
+        results = {
+            'version': RESULTS_VERSION,
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': self.args.scale,
+            'endpoint': 'stub' if self.stub is not None else self.args.endpoint,
+            'results': []
+        }
+
+        try:
+            for dataset in self.args.datasets:
+                results['results'].extend(self.__run_dataset(dataset))
+        finally:
+            if self.stub is not None:
+                self.stub.stop()
+            if not self.args.keep:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+        return results
+
+    def __run_dataset(self, dataset):
+        source = os.path.join(self.workdir, 'source', dataset)
+
+        logger.info('Generating dataset %s', dataset)
+        generate = self.__measure(lambda: datasets.generate(dataset, source, self.args.scale))
+        files, size = generate.pop('result')
+        generate['bytes'] = size
+        generate['throughput_mb_s'] = round(size / 1048576.0 / max(generate['wall_seconds'], 0.001), 2)
+
+        results = []
+        originals = os.path.join(self.workdir, 'originals', dataset)
+
+        for variant, plan_options in sorted(self.args.variants.items()):
+            result = {'dataset': dataset,
+                      'variant': variant,
+                      'plan': plan_options,
+                      'files': files,
+                      'bytes': size,
+                      'phases': {'generate': generate}}
+
+            config_file = self.__write_config(dataset, variant, source, plan_options)
+
+            try:
+                for phase in PHASES:
+                    if phase == 'modified':
+                        datasets.modify(dataset, source, scale=self.args.scale, originals=originals)
+
+                    logger.info('Running %s / %s: %s', dataset, variant, phase)
+                    result['phases'][phase] = self.__run_phase(config_file, size)
+            finally:
+                # Every variant starts from the generated dataset, so each modified phase rewrites the same files
+                # with content they didn't have before
+                datasets.restore(source, originals)
+
+            results.append(result)
+            self.__print(result)
+
+        shutil.rmtree(source, ignore_errors=True)
+
+        return results
+
+    def __write_config(self, dataset, variant, source, plan_options):
+        directory = os.path.join(self.workdir, 'runs', '%s-%s' % (dataset, variant))
+        os.makedirs(directory, exist_ok=True)
+
+        plan = {'Name': '%s-%s' % (dataset, variant),
+                'Src': os.path.join(source, '**', '*'),
+                'OutputPrefix': 'bench/%s-%s' % (dataset, variant)}
+        plan.update(plan_options)
+
+        configuration = {'AWS_KEY': 'benchmark',
+                         'AWS_SECRET': 'benchmark',
+                         'AWS_BUCKET': self.args.bucket,
+                         'AWS_REGION': 'us-east-1',
+                         'AWS_ENDPOINT_URL': self.endpoint,
+                         'HASH_CHECK_FILE': os.path.join(directory, 'hashes.txt'),
+                         'Plans': [plan]}
+
+        config_file = os.path.join(directory, 'config.json')
+        with open(config_file, 'w') as output:
+            json.dump(configuration, output, indent=2)
+
+        # Archives are staged in the working directory, and OutputPrefix contains a directory
+        os.makedirs(os.path.join(directory, 'bench'), exist_ok=True)
+
+        return config_file
+
+    def __run_phase(self, config_file, source_bytes):
+        # Plans stage their archives in the working directory
+        previous_directory = os.getcwd()
+        os.chdir(os.path.dirname(config_file))
+
+        try:
+            configuration, plans = config_loader.config_setup(config_file)
+            uploaded_before = self.stub.stats()['bytes_received'] if self.stub is not None else None
+            metrics = self.__measure(plans[0].run)
+            uploaded, key = metrics.pop('result')
+        finally:
+            os.chdir(previous_directory)
+
+        metrics['uploaded'] = uploaded
+        # The plan's own breakdown of where the time went
+        metrics['plan_phases'] = plans[0].metrics.to_dict()['phases']
+        metrics['throughput_mb_s'] = round(source_bytes / 1048576.0 / max(metrics['wall_seconds'], 0.001), 2)
+
+        if self.stub is not None:
+            metrics['bytes_uploaded'] = self.stub.stats()['bytes_received'] - uploaded_before
+
+        return metrics
+
+    @staticmethod
+    def __measure(function):
+        _reset_peak_rss()
+        written_before = _read_proc('/proc/self/io', 'write_bytes:')
+        cpu_before = _cpu_seconds()
+        started = time.perf_counter()
+
+        result = function()
+
+        metrics = {'wall_seconds': round(time.perf_counter() - started, 3),
+                   'cpu_seconds': round(_cpu_seconds() - cpu_before, 3),
+                   'peak_rss_mb': _peak_rss_mb(),
+                   'result': result}
+
+        written_after = _read_proc('/proc/self/io', 'write_bytes:')
+        if written_before is not None and written_after is not None:
+            metrics['disk_write_bytes'] = written_after - written_before
+
+        return metrics
+
+    @staticmethod
+    def __print(result):
+        print('%s / %s (%d files, %.1f MB)' % (result['dataset'], result['variant'], result['files'],
+                                              result['bytes'] / 1048576.0))
+        for phase, metrics in result['phases'].items():
+            print('    %-14s %8.2fs wall %8.2fs cpu %9.2f MB/s %8.1f MB peak %12s bytes uploaded' %
+                  (phase, metrics['wall_seconds'], metrics['cpu_seconds'], metrics['throughput_mb_s'],
+                   metrics['peak_rss_mb'], metrics.get('bytes_uploaded', '-')))
+        sys.stdout.flush()
+
+
+def _variant(value):
+    name, _, options = value.partition('=')
+    return name, json.loads(options) if options else {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark S3Backup plans against a local stand-in for S3')
+    parser.add_argument('--datasets', default=','.join(sorted(datasets.DATASETS)),
+                        help='Comma separated datasets to run (default: all of %s)' %
+                             ', '.join(sorted(datasets.DATASETS)))
+    parser.add_argument('--variant', action='append', type=_variant, default=None, metavar='NAME=JSON',
+                        help='Plan options to benchmark, e.g. deflate=\'{"Compression": {"Codec": "deflate"}}\'. '
+                             'May be repeated (default: store and deflate)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Scale the number of files (or size of huge files) in each dataset')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--endpoint', default=None,
+                        help='Use this S3 compatible endpoint (e.g. a moto server) instead of the built in stub')
+    parser.add_argument('--bucket', default='benchmark')
+    parser.add_argument('--workdir', default=None, help='Where to generate datasets (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory afterwards')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    args.datasets = [name.strip() for name in args.datasets.split(',') if name.strip()]
+    for name in args.datasets:
+        if name not in datasets.DATASETS:
+            parser.error('Unknown dataset: %s' % name)
+
+    args.variants = dict(args.variant) if args.variant else DEFAULT_VARIANTS
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    results = Benchmark(args).run()
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
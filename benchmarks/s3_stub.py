@@ -0,0 +1,597 @@
+"""
+A small stand-in for S3, covering just the calls S3Backup makes, so benchmarks can run without AWS.
+
+Objects and parts are spooled to a directory rather than held in memory, and the server normally runs in its
+own process, so neither skews the memory or CPU figures of the process being measured. GET /__stats returns
+the number of requests and bytes received and sent so far.
+
+    python benchmarks/s3_stub.py --port 9000 --directory /tmp/s3
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class S3Stub:
+    """
+        The state of the stand-in: objects (as files in the directory) and multipart uploads in progress
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects = {}
+        self.uploads = {}
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0}
+        self.lock = threading.Lock()
+
+    def new_file(self):
+        return os.path.join(self.directory, uuid.uuid4().hex)
+
+    def put(self, key, path, etag, metadata):
+        with self.lock:
+            previous = self.objects.get(key)
+            self.objects[key] = {'path': path,
+                                 'size': os.path.getsize(path),
+                                 'etag': etag,
+                                 'metadata': metadata,
+                                 'tags': {},
+                                 'modified': datetime.now(timezone.utc)}
+
+        if previous is not None and previous['path'] != path:
+            _remove(previous['path'])
+
+    def delete(self, key):
+        with self.lock:
+            previous = self.objects.pop(key, None)
+
+        if previous is not None:
+            _remove(previous['path'])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    # Request plumbing
+
+    def __parse(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        query = dict((name, values[0]) for name, values in parse_qs(parts.query, keep_blank_values=True).items())
+
+        with self.stub.lock:
+            self.stub.stats['requests'] += 1
+
+        return bucket, key, query
+
+    def __read_body(self, target=None):
+        """
+            Read the request body (undoing HTTP and aws-chunked framing) into target, or return it as bytes
+        """
+        output = target if target is not None else bytearray()
+        received = 0
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            raw = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                raw += self.rfile.read(size)
+                self.rfile.readline()
+            source = _BytesReader(bytes(raw))
+            length = len(raw)
+        else:
+            source = self.rfile
+            length = int(self.headers.get('Content-Length', 0))
+
+        streaming = ('aws-chunked' in self.headers.get('Content-Encoding', '') or
+                     self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'))
+
+        if streaming:
+            while True:
+                header = source.readline()
+                received += len(header)
+                size = int(header.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Trailing checksums, ended by a blank line
+                    while True:
+                        line = source.readline()
+                        received += len(line)
+                        if line.strip() == b'':
+                            break
+                    break
+                _copy(source, output, size)
+                received += size + len(source.readline())
+        else:
+            _copy(source, output, length)
+            received = length
+
+        with self.stub.lock:
+            self.stub.stats['bytes_received'] += received
+
+        return output
+
+    def __respond(self, status, body=b'', headers=None, content_type='application/xml'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        headers = headers or {}
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+            with self.stub.lock:
+                self.stub.stats['bytes_sent'] += len(body)
+
+    def __error(self, status, code, message):
+        self.__respond(status, '<?xml version="1.0" encoding="UTF-8"?>'
+                               '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, escape(message)))
+
+    def __xml(self, root, body):
+        self.__respond(200, '<?xml version="1.0" encoding="UTF-8"?><%s xmlns="%s">%s</%s>' %
+                       (root, S3_NAMESPACE, body, root))
+
+    # Verbs
+
+    def do_GET(self):
+        bucket, key, query = self.__parse()
+
+        if bucket == '__stats':
+            with self.stub.lock:
+                stats = json.dumps(self.stub.stats)
+            return self.__respond(200, stats, content_type='application/json')
+
+        if key == '' and 'uploads' in query:
+            return self.__list_uploads(query)
+        if key == '':
+            return self.__list_objects(query)
+        if 'uploadId' in query:
+            return self.__list_parts(key, query)
+        if 'tagging' in query:
+            return self.__get_tagging(key)
+
+        return self.__get_object(key)
+
+    def do_HEAD(self):
+        bucket, key, query = self.__parse()
+
+        obj = self.stub.objects.get(key)
+        if obj is None:
+            return self.__respond(404)
+
+        # HEAD responses give the length of the object, not of their (empty) body
+        headers = self.__object_headers(obj, obj['size'])
+        headers['Content-Length'] = str(obj['size'])
+
+        self.__respond(200, headers=headers)
+
+    def do_PUT(self):
+        bucket, key, query = self.__parse()
+
+        if key == '':
+            self.__read_body()
+            return self.__respond(200)
+        if 'x-amz-copy-source' in self.headers:
+            return self.__copy(bucket, key, query)
+        if 'uploadId' in query:
+            return self.__upload_part(key, query)
+        if 'tagging' in query:
+            return self.__put_tagging(key)
+
+        path = self.stub.new_file()
+        hasher = _HashingFile(path)
+        self.__read_body(hasher)
+        hasher.close()
+
+        etag = '"%s"' % hasher.hexdigest()
+        self.stub.put(key, path, etag, self.__metadata())
+        self.__respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self.__parse()
+
+        if key == '' and 'delete' in query:
+            return self.__delete_objects()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.stub.lock:
+                self.stub.uploads[upload_id] = {'key': key,
+                                                'parts': {},
+                                                'metadata': self.__metadata(),
+                                                'initiated': datetime.now(timezone.utc)}
+            self.__read_body()
+            return self.__xml('InitiateMultipartUploadResult',
+                              '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>' %
+                              (escape(bucket), escape(key), upload_id))
+        if 'uploadId' in query:
+            return self.__complete_upload(bucket, key, query)
+
+        self.__read_body()
+        self.__error(400, 'NotImplemented', 'Unsupported request')
+
+    def do_DELETE(self):
+        bucket, key, query = self.__parse()
+        self.__read_body()
+
+        if 'uploadId' in query:
+            with self.stub.lock:
+                upload = self.stub.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self.__error(404, 'NoSuchUpload', 'The specified upload does not exist')
+            for part in upload['parts'].values():
+                _remove(part['path'])
+            return self.__respond(204)
+
+        self.stub.delete(key)
+        self.__respond(204)
+
+    # Operations
+
+    def __metadata(self):
+        return dict((name[len('x-amz-meta-'):], value) for name, value in self.headers.items()
+                    if name.lower().startswith('x-amz-meta-'))
+
+    @staticmethod
+    def __object_headers(obj, length):
+        headers = {'ETag': obj['etag'],
+                   'Last-Modified': formatdate(obj['modified'].timestamp(), usegmt=True),
+                   'Accept-Ranges': 'bytes'}
+        for name, value in obj['metadata'].items():
+            headers['x-amz-meta-' + name] = value
+        return headers
+
+    def __get_object(self, key):
+        obj = self.stub.objects.get(key)
+        if obj is None:
+            return self.__error(404, 'NoSuchKey', 'The specified key does not exist')
+
+        start, end = 0, obj['size'] - 1
+        status = 200
+        headers = self.__object_headers(obj, obj['size'])
+
+        if 'Range' in self.headers:
+            first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+            if first == '':
+                start = max(0, obj['size'] - int(last))
+            else:
+                start = int(first)
+                end = min(end, int(last)) if last != '' else end
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, obj['size'])
+
+        length = max(0, end - start + 1)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        with open(obj['path'], 'rb') as source:
+            source.seek(start)
+            _copy(source, self.wfile, length)
+
+        with self.stub.lock:
+            self.stub.stats['bytes_sent'] += length
+
+    def __list_objects(self, query):
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys', 1000))
+        start_after = query.get('continuation-token', query.get('start-after', ''))
+
+        with self.stub.lock:
+            keys = sorted(key for key in self.stub.objects if key.startswith(prefix) and key > start_after)
+            page = [(key, self.stub.objects[key]) for key in keys[:max_keys]]
+
+        truncated = len(keys) > max_keys
+        body = '<Name>bucket</Name><Prefix>%s</Prefix><KeyCount>%d</KeyCount><MaxKeys>%d</MaxKeys>' \
+               '<IsTruncated>%s</IsTruncated>' % (escape(prefix), len(page), max_keys, str(truncated).lower())
+
+        if truncated:
+            body += '<NextContinuationToken>%s</NextContinuationToken>' % escape(page[-1][0])
+
+        for key, obj in page:
+            body += '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag><Size>%d</Size>' \
+                    '<StorageClass>STANDARD</StorageClass></Contents>' % \
+                    (escape(key), obj['modified'].strftime('%Y-%m-%dT%H:%M:%S.000Z'), escape(obj['etag']),
+                     obj['size'])
+
+        self.__xml('ListBucketResult', body)
+
+    def __list_uploads(self, query):
+        prefix = query.get('prefix', '')
+
+        with self.stub.lock:
+            uploads = sorted((upload['key'], upload_id, upload['initiated'])
+                             for upload_id, upload in self.stub.uploads.items() if upload['key'].startswith(prefix))
+
+        body = '<Bucket>bucket</Bucket><IsTruncated>false</IsTruncated>'
+        for key, upload_id, initiated in uploads:
+            body += '<Upload><Key>%s</Key><UploadId>%s</UploadId><Initiated>%s</Initiated></Upload>' % \
+                    (escape(key), upload_id, initiated.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+        self.__xml('ListMultipartUploadsResult', body)
+
+    def __list_parts(self, key, query):
+        upload = self.stub.uploads.get(query['uploadId'])
+        if upload is None:
+            return self.__error(404, 'NoSuchUpload', 'The specified upload does not exist')
+
+        body = '<Bucket>bucket</Bucket><Key>%s</Key><UploadId>%s</UploadId><IsTruncated>false</IsTruncated>' % \
+               (escape(key), query['uploadId'])
+        for number in sorted(upload['parts']):
+            part = upload['parts'][number]
+            body += '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag><Size>%d</Size></Part>' % \
+                    (number, escape(part['etag']), part['size'])
+
+        self.__xml('ListPartsResult', body)
+
+    def __upload_part(self, key, query):
+        upload = self.stub.uploads.get(query['uploadId'])
+        if upload is None:
+            self.__read_body()
+            return self.__error(404, 'NoSuchUpload', 'The specified upload does not exist')
+
+        path = self.stub.new_file()
+        hasher = _HashingFile(path)
+        self.__read_body(hasher)
+        hasher.close()
+
+        number = int(query['partNumber'])
+        etag = '"%s"' % hasher.hexdigest()
+
+        with self.stub.lock:
+            previous = upload['parts'].get(number)
+            upload['parts'][number] = {'path': path, 'etag': etag, 'size': hasher.size,
+                                       'digest': hasher.digest()}
+
+        if previous is not None:
+            _remove(previous['path'])
+
+        self.__respond(200, headers={'ETag': etag})
+
+    def __copy(self, bucket, key, query):
+        """
+            CopyObject, or UploadPartCopy of a byte range of the source when it is part of a multipart upload
+        """
+        self.__read_body()
+
+        # "/bucket/key", URL encoded, possibly with a version
+        source_key = unquote(self.headers['x-amz-copy-source'].split('?', 1)[0]).lstrip('/').partition('/')[2]
+        source = self.stub.objects.get(source_key)
+        if source is None:
+            return self.__error(404, 'NoSuchKey', 'The specified key does not exist')
+
+        start, end = 0, source['size'] - 1
+        if 'x-amz-copy-source-range' in self.headers:
+            first, _, last = self.headers['x-amz-copy-source-range'][len('bytes='):].partition('-')
+            start, end = int(first), min(end, int(last))
+
+        path = self.stub.new_file()
+        hasher = _HashingFile(path)
+        with open(source['path'], 'rb') as data:
+            data.seek(start)
+            _copy(data, hasher, end - start + 1)
+        hasher.close()
+
+        etag = '"%s"' % hasher.hexdigest()
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+        if 'uploadId' in query:
+            upload = self.stub.uploads.get(query['uploadId'])
+            if upload is None:
+                _remove(path)
+                return self.__error(404, 'NoSuchUpload', 'The specified upload does not exist')
+
+            with self.stub.lock:
+                previous = upload['parts'].get(int(query['partNumber']))
+                upload['parts'][int(query['partNumber'])] = {'path': path, 'etag': etag, 'size': hasher.size,
+                                                             'digest': hasher.digest()}
+
+            if previous is not None:
+                _remove(previous['path'])
+
+            return self.__xml('CopyPartResult', '<LastModified>%s</LastModified><ETag>%s</ETag>' %
+                              (modified, escape(etag)))
+
+        if self.headers.get('x-amz-metadata-directive', 'COPY').upper() == 'REPLACE':
+            metadata = self.__metadata()
+        else:
+            metadata = dict(source['metadata'])
+
+        self.stub.put(key, path, etag, metadata)
+
+        self.__xml('CopyObjectResult', '<LastModified>%s</LastModified><ETag>%s</ETag>' % (modified, escape(etag)))
+
+    def __complete_upload(self, bucket, key, query):
+        request = ElementTree.fromstring(bytes(self.__read_body()))
+
+        with self.stub.lock:
+            upload = self.stub.uploads.pop(query['uploadId'], None)
+
+        if upload is None:
+            return self.__error(404, 'NoSuchUpload', 'The specified upload does not exist')
+
+        numbers = [int(element.text) for element in request.iter() if element.tag.endswith('PartNumber')]
+        path = self.stub.new_file()
+        digests = b''
+
+        with open(path, 'wb') as output:
+            for number in numbers:
+                part = upload['parts'][number]
+                digests += part['digest']
+                with open(part['path'], 'rb') as source:
+                    shutil.copyfileobj(source, output)
+
+        for part in upload['parts'].values():
+            _remove(part['path'])
+
+        etag = '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(numbers))
+        self.stub.put(key, path, etag, upload['metadata'])
+
+        self.__xml('CompleteMultipartUploadResult', '<Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>' %
+                   (escape(bucket), escape(key), escape(etag)))
+
+    def __delete_objects(self):
+        request = ElementTree.fromstring(bytes(self.__read_body()))
+        keys = [element.text for element in request.iter() if element.tag.endswith('Key')]
+
+        for key in keys:
+            self.stub.delete(key)
+
+        self.__xml('DeleteResult', ''.join('<Deleted><Key>%s</Key></Deleted>' % escape(key) for key in keys))
+
+    def __get_tagging(self, key):
+        obj = self.stub.objects.get(key)
+        if obj is None:
+            return self.__error(404, 'NoSuchKey', 'The specified key does not exist')
+
+        self.__xml('Tagging', '<TagSet>%s</TagSet>' % ''.join(
+            '<Tag><Key>%s</Key><Value>%s</Value></Tag>' % (escape(name), escape(value))
+            for name, value in obj['tags'].items()))
+
+    def __put_tagging(self, key):
+        request = ElementTree.fromstring(bytes(self.__read_body()))
+        obj = self.stub.objects.get(key)
+        if obj is None:
+            return self.__error(404, 'NoSuchKey', 'The specified key does not exist')
+
+        tags = {}
+        for tag in request.iter():
+            if tag.tag.endswith('}Tag') or tag.tag == 'Tag':
+                values = dict((child.tag.split('}')[-1], child.text or '') for child in tag)
+                tags[values['Key']] = values['Value']
+
+        obj['tags'] = tags
+        self.__respond(200)
+
+
+class _BytesReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def readline(self):
+        end = self.data.find(b'\n', self.position)
+        end = len(self.data) if end < 0 else end + 1
+        line = self.data[self.position:end]
+        self.position = end
+        return line
+
+
+class _HashingFile:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.hasher = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def digest(self):
+        return self.hasher.digest()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def _copy(source, target, length):
+    remaining = length
+    while remaining > 0:
+        chunk = source.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        if isinstance(target, bytearray):
+            target += chunk
+        else:
+            target.write(chunk)
+        remaining -= len(chunk)
+
+
+def serve(port=0, directory=None):
+    """
+        Start the stand-in on a background thread, returning the server (server.server_port is the port)
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='s3stub-')
+    else:
+        os.makedirs(directory, exist_ok=True)
+
+    handler = type('StubHandler', (Handler,), {'stub': S3Stub(directory)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for S3')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--directory', default=None)
+    args = parser.parse_args(argv)
+
+    server = serve(args.port, args.directory)
+
+    # The benchmark runner reads the port from the first line
+    print(server.server_port)
+    sys.stdout.flush()
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -41,4 +41,9 @@ setup(
     zip_safe=False,
     install_requires=requirements,
     keywords=['backup', 'aws', 's3'],
+    entry_points={
+        'console_scripts': [
+            's3backup = S3Backup.cli:main',
+        ],
+    },
 )
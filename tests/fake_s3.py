@@ -0,0 +1,220 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+from S3Backup import config_loader
+from S3Backup.transfer import TransferEngine
+
+
+class FakeS3Client:
+    """
+        An in memory stand in for the few S3 client calls the backups make, including ranged GETs, multipart
+        uploads, tags and paginated listings
+    """
+
+    def __init__(self):
+        # Key: (body, metadata, last modified)
+        self.objects = {}
+        # Key: ETag, for objects put together from parts (others have the MD5 of their body)
+        self.etags = {}
+        # Upload ID: {'Key', 'Metadata', 'Initiated', 'Parts': {part number: (body, ETag)}}
+        self.uploads = {}
+        # Key: TagSet
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+
+        with self.lock:
+            self.objects[Key] = (bytes(Body), dict(Metadata or {}), datetime.now(timezone.utc))
+            self.etags.pop(Key, None)
+            self.tags.pop(Key, None)
+
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        body, metadata, last_modified = self.objects[Key]
+        response = {'Metadata': metadata, 'LastModified': last_modified}
+
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            if start == '':
+                start = max(len(body) - int(end), 0)
+                end = len(body) - 1
+            start, end = int(start), min(int(end), len(body) - 1)
+            response['ContentRange'] = 'bytes %d-%d/%d' % (start, end, len(body))
+            body = body[start:end + 1]
+
+        response['Body'] = io.BytesIO(body)
+        response['ContentLength'] = len(body)
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        body, metadata, last_modified = self.objects[Key]
+        etag = self.etags.get(Key, hashlib.md5(body).hexdigest())
+        return {'ContentLength': len(body), 'Metadata': metadata, 'LastModified': last_modified,
+                'ETag': '"%s"' % etag}
+
+    def get_object_tagging(self, Bucket, Key):
+        if Key not in self.objects:
+            raise Exception('NoSuchKey: %s' % Key)
+
+        return {'TagSet': list(self.tags.get(Key, []))}
+
+    def put_object_tagging(self, Bucket, Key, Tagging):
+        if Key not in self.objects:
+            raise Exception('NoSuchKey: %s' % Key)
+
+        with self.lock:
+            self.tags[Key] = list(Tagging['TagSet'])
+
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+
+        with self.lock:
+            self.uploads[upload_id] = {'Key': Key, 'Metadata': dict(Metadata or {}),
+                                       'Initiated': datetime.now(timezone.utc), 'Parts': {}}
+
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+
+        with self.lock:
+            self.__upload(Key, UploadId)['Parts'][PartNumber] = (bytes(Body), etag)
+
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self.lock:
+            upload = self.__upload(Key, UploadId)
+            parts = [upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+
+            if [etag for body, etag in parts] != [part['ETag'] for part in MultipartUpload['Parts']]:
+                raise Exception('InvalidPart')
+
+            digests = b''.join(hashlib.md5(body).digest() for body, etag in parts)
+            self.objects[Key] = (b''.join(body for body, etag in parts), upload['Metadata'],
+                                 datetime.now(timezone.utc))
+            self.etags[Key] = '%s-%d' % (hashlib.md5(digests).hexdigest(), len(parts))
+            self.tags.pop(Key, None)
+            del self.uploads[UploadId]
+
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self.lock:
+            self.__upload(Key, UploadId)
+            del self.uploads[UploadId]
+
+        return {}
+
+    def __upload(self, key, upload_id):
+        upload = self.uploads.get(upload_id)
+
+        if upload is None or upload['Key'] != key:
+            raise Exception('NoSuchUpload: %s' % upload_id)
+
+        return upload
+
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for item in Delete['Objects']:
+                self.objects.pop(item['Key'], None)
+                self.tags.pop(item['Key'], None)
+
+        return {}
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+    def age(self, key, delta):
+        body, metadata, last_modified = self.objects[key]
+        self.objects[key] = (body, metadata, last_modified - delta)
+
+
+class FakePaginator:
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, Bucket, Prefix=None, Key=None, UploadId=None):
+        if self.operation == 'list_parts':
+            parts = self.client.uploads[UploadId]['Parts']
+            return [{'Parts': [{'PartNumber': number, 'Size': len(parts[number][0]), 'ETag': parts[number][1]}
+                               for number in sorted(parts)]}]
+
+        if self.operation == 'list_multipart_uploads':
+            return [{'Uploads': [{'Key': upload['Key'], 'UploadId': upload_id, 'Initiated': upload['Initiated']}
+                                 for upload_id, upload in self.client.uploads.items()
+                                 if upload['Key'].startswith(Prefix)]}]
+
+        if self.operation != 'list_objects_v2':
+            return [{}]
+
+        keys = sorted(key for key in self.client.objects if key.startswith(Prefix))
+
+        # Several pages, as S3 returns at most 1000 keys at a time
+        return [{'Contents': [{'Key': key,
+                               'Size': len(self.client.objects[key][0]),
+                               'LastModified': self.client.objects[key][2]} for key in keys[start:start + 2]]}
+                for start in range(0, len(keys), 2)]
+
+
+class FakeTransferEngine(TransferEngine):
+    """
+        The transfer engine, sending everything to a FakeS3Client. Managed transfers (which need boto3) are made
+        as single requests.
+    """
+
+    def __init__(self, configuration, s3_client):
+        super().__init__(configuration)
+        self.s3_client = s3_client
+
+    def client(self, service='s3', settings=None):
+        return self.s3_client
+
+    def upload_file(self, filename, key, settings=None, extra_args=None):
+        with open(filename, 'rb') as source:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=source.read(), **(extra_args or {}))
+
+        return os.path.getsize(filename)
+
+    def copy(self, source_key, key, settings=None, extra_args=None):
+        extra_args = dict(extra_args or {})
+        body, metadata, last_modified = self.s3_client.objects[source_key]
+
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body,
+                                  Metadata=extra_args.pop('Metadata', metadata), **extra_args)
+
+
+def load_plans(directory, plans, s3_client, **root_values):
+    """
+        Write a configuration of the plans to the directory and load it, with the plans backing up to s3_client
+    """
+    config = {
+        'AWS_KEY': 'key',
+        'AWS_SECRET': 'secret',
+        'AWS_BUCKET': 'bucket',
+        'AWS_REGION': 'us-east-1',
+        'HASH_CHECK_FILE': os.path.join(directory, 'hashes.txt'),
+        'Plans': plans
+    }
+    config.update(root_values)
+
+    config_file = os.path.join(directory, 'config.json')
+    with open(config_file, 'w') as output:
+        json.dump(config, output)
+
+    configuration, loaded_plans = config_loader.config_setup(config_file)
+    configuration['TRANSFER_ENGINE'] = FakeTransferEngine(configuration, s3_client)
+
+    return configuration, loaded_plans
@@ -0,0 +1,116 @@
+import os
+import unittest
+from unittest import mock
+from S3Backup import s3_util
+from tests.fake_s3 import FakeS3Client
+from tests.test_plan import PlanTest
+
+
+class ObjectHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_client = FakeS3Client()
+
+    def test_metadata(self):
+        self.s3_client.put_object(Bucket='bucket', Key='backup.zip', Body=b'zip',
+                                  Metadata=s3_util.hash_metadata('sha256:abc'))
+
+        self.assertEqual(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'), 'sha256:abc')
+
+    def test_tag(self):
+        self.s3_client.put_object(Bucket='bucket', Key='backup.zip', Body=b'zip')
+        s3_util.tag_hash(self.s3_client, 'bucket', 'backup.zip', 'sha256:def')
+
+        self.assertEqual(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'), 'sha256:def')
+
+    def test_metadata_first(self):
+        # Tags aren't read at all when the metadata has the hash
+        self.s3_client.put_object(Bucket='bucket', Key='backup.zip', Body=b'zip',
+                                  Metadata=s3_util.hash_metadata('sha256:abc'))
+
+        with mock.patch.object(self.s3_client, 'get_object_tagging') as get_object_tagging:
+            self.assertEqual(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'), 'sha256:abc')
+
+        get_object_tagging.assert_not_called()
+
+    def test_no_hash(self):
+        self.s3_client.put_object(Bucket='bucket', Key='backup.zip', Body=b'zip', Metadata={'other': 'value'})
+        self.assertIsNone(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'))
+
+        self.s3_client.put_object_tagging(Bucket='bucket', Key='backup.zip',
+                                          Tagging={'TagSet': [{'Key': 'owner', 'Value': 'backups'}]})
+        self.assertIsNone(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'))
+
+    def test_tags_unreadable(self):
+        # Without permission to read tags, the backup is treated as having no hash
+        self.s3_client.put_object(Bucket='bucket', Key='backup.zip', Body=b'zip')
+
+        with mock.patch.object(self.s3_client, 'get_object_tagging', side_effect=Exception('AccessDenied')):
+            self.assertIsNone(s3_util.object_hash(self.s3_client, 'bucket', 'backup.zip'))
+
+
+class RemoteChangeDetectionTest(PlanTest):
+
+    def new_host(self):
+        # Nothing is known locally, as on a new host or in a fresh container
+        os.remove(os.path.join(self.directory, 'hashes.txt'))
+
+    def test_unchanged_on_new_host(self):
+        plan = self.plan(ChangeDetection='remote')
+        self.assertTrue(self.run_plan(plan)[0])
+
+        self.new_host()
+        self.assertFalse(self.run_plan(plan)[0])
+        self.assertEqual(len(self.s3_client.objects), 1)
+
+    def test_changed_on_new_host(self):
+        plan = self.plan(ChangeDetection='remote')
+        self.run_plan(plan)
+
+        self.new_host()
+        self.write('one.txt', 'changed\n')
+        self.assertTrue(self.run_plan(plan)[0])
+
+    def test_local_uploads_again(self):
+        plan = self.plan()
+        self.run_plan(plan)
+
+        self.new_host()
+        self.assertTrue(self.run_plan(plan)[0])
+
+    def test_newer_backup_elsewhere(self):
+        plan = self.plan(ChangeDetection='remote', ChangeDetectionCacheMinutes=0)
+        self.run_plan(plan)
+
+        # Another host uploaded a backup of different files since
+        self.s3_client.put_object(Bucket='bucket', Key='backup_2099-01-01_00-00-00.zip', Body=b'zip',
+                                  Metadata=s3_util.hash_metadata('sha256:other'))
+
+        self.assertTrue(self.run_plan(plan)[0])
+
+    def test_cached(self):
+        plan = self.plan(ChangeDetection='remote')
+        self.run_plan(plan)
+
+        # Within the cache time, the hash saved by the last run is trusted without asking S3
+        with mock.patch.object(self.s3_client, 'head_object', wraps=self.s3_client.head_object) as head_object:
+            self.assertFalse(self.run_plan(plan)[0])
+
+        head_object.assert_not_called()
+
+    def test_streamed_tag(self):
+        plan = self.plan(ChangeDetection='remote', Streaming=True)
+        self.assertTrue(self.run_plan(plan)[0])
+
+        # A streamed upload's hash is only known once it is complete, so is in its tags
+        key = sorted(self.s3_client.objects)[-1]
+        self.assertEqual(self.s3_client.objects[key][1], {})
+        self.assertIsNotNone(s3_util.object_hash(self.s3_client, 'bucket', key))
+
+        self.new_host()
+        self.assertFalse(self.run_plan(plan)[0])
+        self.assertEqual(self.s3_client.uploads, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import contextlib
+import io
+import os
+import unittest
+from unittest import mock
+from S3Backup import cli
+from S3Backup import config_loader
+from S3Backup import metrics
+from tests.fake_s3 import FakeTransferEngine, load_plans
+from tests.test_plan import PlanTest
+
+
+class CliTest(PlanTest):
+
+    def setUp(self):
+        super().setUp()
+
+        # Logging is left as the test runner set it up
+        patcher = mock.patch.object(cli.logging, 'basicConfig')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def config(self, *plans, **root_values):
+        raw_plans = []
+        for values in plans or [{}]:
+            raw_plan = {'Name': 'test plan', 'Src': os.path.join(self.source, '**'), 'OutputPrefix': 'backup'}
+            raw_plan.update(values)
+            raw_plans.append(raw_plan)
+
+        load_plans(self.directory, raw_plans, self.s3_client, **root_values)
+        return os.path.join(self.directory, 'config.json')
+
+    def main(self, *argv):
+        """
+            Run the command line, returning its exit code and what it printed
+        """
+        output = io.StringIO()
+
+        # Loading a configuration sets up a transfer engine, which is sent to the fake S3 instead
+        with contextlib.redirect_stdout(output), \
+                mock.patch.object(config_loader.transfer, 'TransferEngine',
+                                  lambda configuration: FakeTransferEngine(configuration, self.s3_client)):
+            code = cli.main(list(argv))
+
+        return code, output.getvalue()
+
+    def backups(self, *timestamps):
+        for timestamp in timestamps:
+            self.s3_client.put_object(Bucket='bucket', Key='backup_%s.zip' % timestamp, Body=b'zip')
+
+    def test_validate(self):
+        config = self.config({}, {'Name': 'other', 'OutputPrefix': 'other'})
+
+        self.assertEqual(self.main('validate', config), (0, '%s: 2 plans OK\n' % config))
+
+    def test_validate_invalid(self):
+        with self.assertRaises(Exception):
+            self.config({'Compression': {'Format': 'rar'}})
+
+        config = os.path.join(self.directory, 'config.json')
+        self.assertEqual(self.main('validate', config), (1, ''))
+
+        self.assertEqual(self.main('validate', os.path.join(self.directory, 'missing.json'))[0], 1)
+
+    def test_plan(self):
+        config = self.config({'Exclude': ['*.log']})
+        code, output = self.main('plan', config)
+
+        self.assertEqual(code, 0)
+        self.assertIn('Plan "test plan"', output)
+        self.assertIn('  Source: %s' % os.path.join(self.source, '**'), output)
+        self.assertIn('  Exclude: *.log', output)
+        self.assertIn('  Output: backup_<timestamp> (zip, archive)', output)
+
+        # Without --dry-run the source isn't walked
+        self.assertNotIn('Files:', output)
+
+    def test_dry_run(self):
+        self.write('debug.log', 'excluded\n')
+        config = self.config({'Exclude': ['*.log']})
+
+        code, output = self.main('plan', config, '--dry-run')
+
+        self.assertEqual(code, 0)
+        self.assertIn(os.path.join(self.source, 'one.txt'), output)
+        self.assertIn(os.path.join(self.source, 'sub', 'two.txt'), output)
+        self.assertNotIn('debug.log', output)
+        self.assertIn('  Files: 2, %s before compression' % metrics.format_size(2300), output)
+        self.assertIn('Backups to remove: not checked', output)
+
+        # Nothing was archived or uploaded
+        self.assertEqual(self.s3_client.objects, {})
+        self.assertEqual(sorted(os.listdir(self.directory)), ['config.json', 'source'])
+
+    def test_dry_run_command(self):
+        config = self.config({'Command': '/bin/false'})
+        code, output = self.main('plan', config, '--dry-run')
+
+        self.assertEqual(code, 0)
+        self.assertIn('the command is not run', output)
+
+    def test_dry_run_remote(self):
+        self.backups('2024-01-01_00-00-00', '2024-01-02_00-00-00', '2024-01-03_00-00-00')
+        config = self.config({'PreviousBackupsCount': 1})
+
+        code, output = self.main('plan', config, '--dry-run', '--remote')
+
+        # The previous backup is kept along with the newest
+        self.assertEqual(code, 0)
+        self.assertIn('Retention: KeepLast 2', output)
+        self.assertIn('Would remove: backup_2024-01-01_00-00-00.zip', output)
+        self.assertNotIn('backup_2024-01-02_00-00-00.zip', output)
+        self.assertNotIn('backup_2024-01-03_00-00-00.zip', output)
+        self.assertEqual(len(self.s3_client.objects), 3)
+
+    def test_selected_plans(self):
+        config = self.config({}, {'Name': 'other', 'OutputPrefix': 'other'})
+
+        code, output = self.main('plan', config, '--plan', 'other')
+        self.assertEqual(code, 0)
+        self.assertIn('Plan "other"', output)
+        self.assertNotIn('Plan "test plan"', output)
+
+        self.assertEqual(self.main('plan', config, '--plan', 'missing'), (1, ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
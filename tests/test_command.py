@@ -0,0 +1,106 @@
+import io
+import os
+import time
+import unittest
+import zipfile
+from S3Backup import command
+from S3Backup.command import CommandStream
+from tests.test_plan import PlanTest
+
+
+class CommandStreamTest(unittest.TestCase):
+
+    def read_all(self, shell_command):
+        with CommandStream(shell_command) as stream:
+            return b''.join(iter(stream.read, b'')), stream
+
+    def test_stdout(self):
+        output, stream = self.read_all('printf "first\\nsecond\\n"')
+
+        self.assertEqual(output, b'first\nsecond\n')
+        self.assertEqual(stream.bytes_read, len(output))
+
+    def test_failed(self):
+        with self.assertRaisesRegex(Exception, r'(?s)code 3.*went wrong'):
+            self.read_all('echo partial; echo "went wrong" >&2; exit 3')
+
+        with self.assertRaisesRegex(Exception, r'^Failed with code 1$'):
+            self.read_all('exit 1')
+
+    def test_stderr_tail(self):
+        # Only the end of a lot of stderr is kept
+        with self.assertRaises(Exception) as raised:
+            self.read_all('head -c 100000 /dev/zero | tr "\\0" x >&2; echo " the end" >&2; exit 1')
+
+        message = str(raised.exception)
+        self.assertTrue(message.endswith('the end'))
+        self.assertLess(len(message), command.STDERR_TAIL_SIZE + 100)
+
+    def test_stderr_drained(self):
+        # More stderr than a pipe holds doesn't hold the command up while stdout is read
+        output, stream = self.read_all('head -c 1000000 /dev/zero >&2; echo done')
+
+        self.assertEqual(output, b'done\n')
+        self.assertEqual(len(stream.stderr()), command.STDERR_TAIL_SIZE)
+
+    def test_reader_failed(self):
+        started = time.monotonic()
+
+        # The command is killed rather than left to finish, and the reader's error is the one raised
+        with self.assertRaisesRegex(Exception, 'archive failed'):
+            with CommandStream('echo start; sleep 30') as stream:
+                stream.read(1)
+                raise Exception('archive failed')
+
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_run_command(self):
+        command.run_command('true')
+
+        with self.assertRaisesRegex(Exception, 'not found'):
+            command.run_command('echo "not found" >&2; exit 127')
+
+
+class StreamCommandPlanTest(PlanTest):
+
+    def test_output_archived(self):
+        plan = self.plan(StreamCommand='printf "dump of the database"')
+        updated, output_file = plan.run()
+
+        self.assertTrue(updated)
+
+        with zipfile.ZipFile(io.BytesIO(self.s3_client.objects[output_file][0])) as archive:
+            self.assertEqual(archive.read('test plan.out'), b'dump of the database')
+
+    def test_failed_command(self):
+        plan = self.plan(StreamCommand='echo partial; echo "access denied" >&2; exit 2')
+
+        with self.assertRaisesRegex(Exception, 'access denied'):
+            plan.run()
+
+        # Nothing was uploaded, and the run is recorded as failed
+        self.assertEqual(self.s3_client.objects, {})
+        self.assertEqual(self.s3_client.uploads, {})
+        self.assertEqual(plan.metrics.status, 'failed')
+        self.assertFalse(os.path.isfile(plan.staged_file))
+
+    def test_failed_streaming(self):
+        plan = self.plan(StreamCommand='echo partial; exit 2', Streaming=True)
+
+        with self.assertRaisesRegex(Exception, 'code 2'):
+            plan.run()
+
+        self.assertEqual(self.s3_client.objects, {})
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_failed_pre_command(self):
+        plan = self.plan(Command='/bin/false')
+
+        with self.assertRaisesRegex(Exception, 'code 1'):
+            plan.run()
+
+        self.assertEqual(self.s3_client.objects, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from S3Backup import compression
+
+
+class CompressionSettingsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(compression.compression_settings(None),
+                         {'Codec': 'store', 'Level': None, 'Format': 'zip', 'AutoStore': True})
+        self.assertEqual(compression.compression_settings(None, compression_workers=4)['Codec'], 'deflate')
+
+    def test_tar_zst(self):
+        self.assertEqual(compression.compression_settings({'Format': 'tar.zst'})['Codec'], 'zstd')
+        self.assertEqual(compression.compression_settings({'Format': 'tar.zst', 'Codec': 'zstd', 'Level': 19})['Level'],
+                         19)
+
+        with self.assertRaises(Exception):
+            compression.compression_settings({'Format': 'tar.zst', 'Codec': 'deflate'})
+        with self.assertRaises(Exception):
+            compression.compression_settings({'Codec': 'zstd'})
+
+    def test_levels(self):
+        for codec, level in [('deflate', 0), ('deflate', 9), ('bzip2', 1), ('deflate', '6')]:
+            self.assertEqual(compression.compression_settings({'Codec': codec, 'Level': level})['Level'], int(level))
+
+        self.assertEqual(compression.compression_settings({'Format': 'tar.zst', 'Level': -5})['Level'], -5)
+
+    def test_invalid_levels(self):
+        for raw_settings in [{'Codec': 'deflate', 'Level': 10}, {'Codec': 'deflate', 'Level': -2},
+                             {'Codec': 'bzip2', 'Level': 0}, {'Codec': 'store', 'Level': 1},
+                             {'Codec': 'lzma', 'Level': 6}, {'Format': 'tar.zst', 'Level': 23},
+                             {'Codec': 'deflate', 'Level': 'best'}]:
+            with self.assertRaises(Exception, msg=raw_settings):
+                compression.compression_settings(raw_settings)
+
+    def test_unknown(self):
+        for raw_settings in [{'Codec': 'brotli'}, {'Format': 'rar'}, {'Speed': 1}]:
+            with self.assertRaises(Exception, msg=raw_settings):
+                compression.compression_settings(raw_settings)
+
+
+if __name__ == '__main__':
+    unittest.main()
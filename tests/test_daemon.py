@@ -0,0 +1,84 @@
+import unittest
+from S3Backup.daemon import Daemon
+
+
+class FakeCache:
+
+    def __init__(self, changed):
+        self.__changed = changed
+        self.runs = []
+
+    def changed(self):
+        return self.__changed
+
+    def begin_run(self):
+        self.runs.append('begin')
+
+    def end_run(self, success):
+        self.runs.append(('end', success))
+
+
+class FakePlan:
+
+    def __init__(self, name, directory_cache, prune_error=None):
+        self.name = name
+        self.directory_cache = directory_cache
+        self.command = None
+        self.stream_command = None
+        self.metrics = None
+        self.pruned = 0
+        self.__prune_error = prune_error
+
+    def prune(self):
+        self.pruned += 1
+        if self.__prune_error is not None:
+            raise self.__prune_error
+
+
+class FakeTool:
+
+    def __init__(self):
+        self.runs = []
+
+    def run_plans(self, plans):
+        self.runs.append([plan.name for plan in plans])
+
+
+class RunDueTest(unittest.TestCase):
+
+    def daemon(self):
+        daemon = Daemon('config.json')
+        daemon.tool = FakeTool()
+        return daemon
+
+    def test_unchanged_plans_are_pruned(self):
+        daemon = self.daemon()
+        changed = FakePlan('changed', FakeCache(True))
+        unchanged = FakePlan('unchanged', FakeCache(False))
+
+        daemon.run_due([changed, unchanged])
+
+        self.assertEqual(daemon.tool.runs, [['changed']])
+        self.assertEqual(changed.pruned, 0)
+        self.assertEqual(unchanged.pruned, 1)
+        self.assertEqual(unchanged.directory_cache.runs, [])
+
+    def test_pruned_when_nothing_runs(self):
+        daemon = self.daemon()
+        plans = [FakePlan('first', FakeCache(False)), FakePlan('second', FakeCache(False))]
+
+        daemon.run_due(plans)
+        daemon.run_due(plans)
+
+        self.assertEqual(daemon.tool.runs, [])
+        self.assertEqual([plan.pruned for plan in plans], [2, 2])
+
+    def test_prune_failure_does_not_stop_others(self):
+        daemon = self.daemon()
+        failing = FakePlan('failing', FakeCache(False), prune_error=Exception('Access Denied'))
+        other = FakePlan('other', FakeCache(False))
+
+        with self.assertLogs('Daemon', level='ERROR'):
+            daemon.run_due([failing, other])
+
+        self.assertEqual(other.pruned, 1)
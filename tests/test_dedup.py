@@ -0,0 +1,158 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+from S3Backup import dedup
+from S3Backup.restore import Restore
+from S3Backup.retention import RetentionPolicy
+from tests.fake_s3 import FakeS3Client
+
+
+def numpy_installed():
+    return dedup._load_numpy() is not None
+
+
+class ChunkingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(5)
+
+    def data(self, size):
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def test_chunk_sizes(self):
+        data = self.data(300000)
+        chunks = list(dedup.iter_chunks(io.BytesIO(data), 4096))
+
+        self.assertEqual(b''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 1024)
+            self.assertLessEqual(len(chunk), 4 * 4096)
+
+    def test_empty(self):
+        self.assertEqual(list(dedup.iter_chunks(io.BytesIO(b''), 4096)), [])
+
+    def test_insert_keeps_later_chunks(self):
+        data = self.data(200000)
+        before = list(dedup.iter_chunks(io.BytesIO(data), 4096))
+        after = list(dedup.iter_chunks(io.BytesIO(data[:1000] + b'inserted' + data[1000:]), 4096))
+
+        # Content defined boundaries resynchronise after the change
+        self.assertGreater(len(set(before) & set(after)), len(before) - 3)
+
+    @unittest.skipUnless(numpy_installed(), 'numpy is not installed')
+    def test_numpy_cut_points_match(self):
+        for avg_size in [256, 4096, 65536]:
+            min_size = max(avg_size // 4, 64)
+            max_size = avg_size * 4
+            mask_small, mask_large = dedup._cut_masks(avg_size)
+
+            for length in [0, min_size, min_size + 1, avg_size, max_size - 1, max_size + 100]:
+                for data in [self.data(length), bytes(length)]:
+                    self.assertEqual(
+                        dedup._cut_point_numpy(data, min_size, avg_size, max_size, mask_small, mask_large),
+                        dedup._cut_point(data, min_size, avg_size, max_size, mask_small, mask_large))
+
+    @unittest.skipUnless(numpy_installed(), 'numpy is not installed')
+    def test_numpy_block_boundaries(self):
+        # Cut points past the first block need the hash carried across from the previous one
+        data = self.data(4 * 65536 + 17)
+        mask_small, mask_large = dedup._cut_masks(65536)
+
+        for mask in [mask_small, 0xFFFFFFFF]:
+            self.assertEqual(dedup._cut_point_numpy(data, 16384, 65536, 4 * 65536, mask, mask_large),
+                             dedup._cut_point(data, 16384, 65536, 4 * 65536, mask, mask_large))
+
+
+class ChunkEncodingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for data in [b'', b'a' * 10000, os.urandom(10000)]:
+            self.assertEqual(dedup.decode_chunk(dedup.encode_chunk(data)), data)
+
+
+class DedupStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        os.makedirs(self.source)
+        self.client = FakeS3Client()
+        self.files = {}
+
+        for number, size in enumerate([0, 100, 50000, 200000]):
+            self.write('file%d.bin' % number, os.urandom(size))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        file_name = os.path.join(self.source, name)
+        with open(file_name, 'wb') as output:
+            output.write(data)
+        self.files[file_name] = data
+
+    def store(self):
+        return dedup.DedupStore(self.client, 'bucket', 'plan', 4096, upload_threads=2)
+
+    def backup(self, timestamp, previous_index=None):
+        index = self.store().backup(sorted(self.files), previous_index)
+        key = dedup.snapshot_key('plan', timestamp)
+        self.store().upload_snapshot(key, index)
+        return key, index
+
+    def chunk_keys(self):
+        return set(key for key in self.client.objects if key.startswith('plan/chunks/'))
+
+    def test_restore(self):
+        key, index = self.backup('2024-01-01_00-00-00')
+
+        destination = os.path.join(self.directory, 'restored')
+        files, size = Restore(self.client, 'bucket', threads=3).restore(key, destination)
+
+        self.assertEqual(files, len(self.files))
+        for file_name, data in self.files.items():
+            with open(os.path.join(destination, file_name.lstrip('/')), 'rb') as restored:
+                self.assertEqual(restored.read(), data)
+
+    def test_unchanged_backup_uploads_nothing(self):
+        key, index = self.backup('2024-01-01_00-00-00')
+        chunks = self.chunk_keys()
+
+        store = self.store()
+        self.assertEqual(store.backup(sorted(self.files), index)['files'], index['files'])
+        self.assertEqual(store.uploaded_chunks, 0)
+        self.assertEqual(self.chunk_keys(), chunks)
+
+    def test_prune(self):
+        first, first_index = self.backup('2024-01-01_00-00-00')
+        old_chunks = self.chunk_keys()
+        for chunk_key in old_chunks:
+            self.client.age(chunk_key, timedelta(days=2))
+
+        self.write('file3.bin', os.urandom(200000))
+        second, second_index = self.backup('2024-01-02_00-00-00')
+        referenced = set('plan/chunks/' + chunk_id for entry in second_index['files']
+                         for chunk_id, chunk_size in entry['chunks'])
+
+        # An unreferenced chunk uploaded just now may belong to a backup still running
+        self.client.put_object(Bucket='bucket', Key='plan/chunks/running', Body=b'R')
+
+        self.store().prune(RetentionPolicy(None, 1))
+
+        self.assertNotIn(first, self.client.objects)
+        self.assertIn(second, self.client.objects)
+        self.assertEqual(self.chunk_keys(), referenced | {'plan/chunks/running'})
+        self.assertTrue(old_chunks - referenced)
+
+        # Left for the next prune which removes a snapshot
+        third, third_index = self.backup('2024-01-03_00-00-00')
+        self.store().prune(RetentionPolicy(None, 1), grace=timedelta(0))
+        self.assertEqual(self.chunk_keys(), referenced)
+
+
+if __name__ == '__main__':
+    unittest.main()
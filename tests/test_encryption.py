@@ -0,0 +1,148 @@
+import base64
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from S3Backup import encryption
+from S3Backup.restore import Restore
+from tests.fake_s3 import FakeS3Client
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+
+class BytesSource:
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.key = 'archive.zip.enc'
+
+    def read(self, start, end):
+        return self.data[start:end]
+
+
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class EncryptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.encryption = self.settings()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def settings(self, name='master.key'):
+        key_file = os.path.join(self.directory, name)
+        if not os.path.exists(key_file):
+            with open(key_file, 'w') as output:
+                output.write(base64.b64encode(os.urandom(32)).decode('ascii'))
+
+        return encryption.Encryption({'KeyFile': key_file, 'SegmentSizeKB': 1})
+
+    def encrypt(self, data, write_size=700):
+        output = io.BytesIO()
+        writer = encryption.EncryptingWriter(output, self.encryption)
+
+        for start in range(0, len(data), write_size):
+            writer.write(data[start:start + write_size])
+
+        writer.finish()
+        return output.getvalue()
+
+    def test_round_trip(self):
+        # Either side of the segment boundaries, and empty
+        for size in [0, 1, 1023, 1024, 1025, 2048, 2049, 10000]:
+            data = os.urandom(size)
+            encrypted = self.encrypt(data)
+            source = encryption.DecryptingSource(BytesSource(encrypted), self.encryption)
+
+            self.assertEqual(source.size, size)
+            self.assertEqual(encryption.plain_size(len(encrypted), 1024), size)
+            self.assertEqual(source.read(0, size), data)
+
+    def test_ranges(self):
+        data = os.urandom(5000)
+        source = encryption.DecryptingSource(BytesSource(self.encrypt(data, 333)), self.encryption)
+
+        for start, end in [(0, 1), (1023, 1025), (1024, 2048), (100, 4000), (4999, 5000), (3000, 3000)]:
+            self.assertEqual(source.read(start, end), data[start:end])
+
+        self.assertEqual(source.tail(300), data[-300:])
+
+    def test_no_plaintext(self):
+        data = b'a very recognisable line of text\n' * 200
+        self.assertNotIn(b'recognisable', self.encrypt(data))
+
+    def test_truncated(self):
+        encrypted = self.encrypt(os.urandom(5000))
+
+        # Cut at a segment boundary, so the remaining segments all decrypt on their own
+        truncated = encrypted[:encryption.HEADER.size + 2 * (1024 + encryption.TAG_SIZE)]
+
+        with self.assertRaises(Exception):
+            encryption.DecryptingSource(BytesSource(truncated), self.encryption).tail(100)
+
+    def test_tampered(self):
+        encrypted = bytearray(self.encrypt(os.urandom(5000)))
+        encrypted[-5] ^= 1
+
+        with self.assertRaises(Exception):
+            encryption.DecryptingSource(BytesSource(bytes(encrypted)), self.encryption).read(4990, 5000)
+
+    def test_wrong_key(self):
+        encrypted = self.encrypt(os.urandom(100))
+
+        with self.assertRaises(Exception):
+            encryption.DecryptingSource(BytesSource(encrypted), self.settings('other.key')).read(0, 100)
+
+    def test_restore_zip(self):
+        files = {'small.txt': b'small file\n', 'large.bin': os.urandom(50000)}
+        archive = io.BytesIO()
+
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for name, data in sorted(files.items()):
+                zip_file.writestr(name, data)
+
+        client = FakeS3Client()
+        key = 'plan_2024-01-01_00-00-00.zip.enc'
+        client.put_object(Bucket='bucket', Key=key, Body=self.encrypt(archive.getvalue(), 4096))
+
+        destination = os.path.join(self.directory, 'restored')
+        restored = Restore(client, 'bucket', threads=3, encryption=self.encryption).restore(key, destination)
+
+        self.assertEqual(restored, (2, sum(len(data) for data in files.values())))
+        for name, data in files.items():
+            with open(os.path.join(destination, name), 'rb') as restored_file:
+                self.assertEqual(restored_file.read(), data)
+
+        with self.assertRaises(Exception):
+            Restore(client, 'bucket').restore(key, destination)
+
+    def test_keys(self):
+        self.assertTrue(encryption.is_encrypted('plan_2024-01-01_00-00-00.zip.enc'))
+        self.assertEqual(encryption.plain_key('plan_2024-01-01_00-00-00.zip.enc'), 'plan_2024-01-01_00-00-00.zip')
+        self.assertEqual(encryption.plain_key('plan_2024-01-01_00-00-00.zip'), 'plan_2024-01-01_00-00-00.zip')
+
+
+class KeyFileTest(unittest.TestCase):
+
+    def test_invalid_key(self):
+        fh, key_file = tempfile.mkstemp()
+
+        try:
+            with os.fdopen(fh, 'w') as output:
+                output.write(base64.b64encode(os.urandom(16)).decode('ascii'))
+
+            with self.assertRaises(Exception):
+                encryption.read_key_file(key_file)
+        finally:
+            os.remove(key_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
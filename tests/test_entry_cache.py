@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+from S3Backup.entry_cache import CachedZipWriter, EntryCache
+from S3Backup.parallel_zip import ParallelZipWriter
+
+
+class EntryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = EntryCache(os.path.join(self.directory, 'cache'), 10 * 1024 * 1024)
+        self.files = []
+
+        for number in range(3):
+            file_name = os.path.join(self.directory, 'file%d.txt' % number)
+            with open(file_name, 'wb') as output:
+                output.write(b'line %d of the file\n' % number * 2000)
+            self.files.append(file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, allow_zip64, name):
+        archive = os.path.join(self.directory, name)
+
+        with zipfile.ZipFile(archive, 'w', allowZip64=allow_zip64) as zip_file:
+            writer = CachedZipWriter(zip_file, self.cache, zipfile.ZIP_DEFLATED, 6)
+            for file_name in self.files:
+                self.assertTrue(writer.write(file_name))
+
+        return archive, writer
+
+    def check(self, archive):
+        with zipfile.ZipFile(archive) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            for file_name in self.files:
+                with open(file_name, 'rb') as source:
+                    self.assertEqual(zip_file.read(file_name.lstrip('/')), source.read())
+
+    def round_trip(self, allow_zip64):
+        first, writer = self.write(allow_zip64, 'first.zip')
+        self.assertEqual(writer.hits, 0)
+
+        second, writer = self.write(allow_zip64, 'second.zip')
+        self.assertEqual(writer.hits, len(self.files))
+
+        self.check(first)
+        self.check(second)
+
+        # The archive is the same whether or not the entries came from the cache
+        with open(first, 'rb') as missed, open(second, 'rb') as hit:
+            self.assertEqual(missed.read(), hit.read())
+
+    def test_zip64(self):
+        self.round_trip(True)
+
+    def test_without_zip64(self):
+        self.round_trip(False)
+
+    def test_changed_file_misses(self):
+        self.write(False, 'first.zip')
+
+        with open(self.files[0], 'ab') as output:
+            output.write(b'more')
+        os.utime(self.files[0], (os.path.getmtime(self.files[0]) + 10,) * 2)
+
+        archive, writer = self.write(False, 'second.zip')
+        self.assertEqual(writer.hits, len(self.files) - 1)
+        self.check(archive)
+
+    def test_eviction(self):
+        self.write(True, 'first.zip')
+        size = sum(os.path.getsize(os.path.join(self.cache.directory, name))
+                   for name in os.listdir(self.cache.directory))
+
+        self.cache.resize(size // 2)
+
+        self.assertLess(sum(os.path.getsize(os.path.join(self.cache.directory, name))
+                            for name in os.listdir(self.cache.directory)), size)
+
+    def test_parallel_hits(self):
+        for allow_zip64 in [True, False]:
+            archives = []
+
+            for run in range(2):
+                archive = os.path.join(self.directory, 'parallel%d.zip' % run)
+                with zipfile.ZipFile(archive, 'w', allowZip64=allow_zip64) as zip_file:
+                    writer = ParallelZipWriter(zip_file, 2, 1024 * 1024, cache=self.cache)
+                    writer.write_files(self.files)
+                archives.append(archive)
+
+            self.assertEqual(writer.hits, len(self.files))
+            for archive in archives:
+                self.check(archive)
+
+    def parallel(self, name):
+        archive = os.path.join(self.directory, name)
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            writer = ParallelZipWriter(zip_file, 2, 1024 * 1024, chunk_size=16 * 1024, cache=self.cache)
+            writer.write_files(self.files)
+        return archive, writer
+
+    def assertSameArchive(self, first, second):
+        self.check(second)
+        with open(first, 'rb') as expected, open(second, 'rb') as actual:
+            self.assertEqual(expected.read(), actual.read())
+
+    def evict_all(self):
+        for name in os.listdir(self.cache.directory):
+            os.remove(os.path.join(self.cache.directory, name))
+
+    def test_evicted_after_lookup(self):
+        first, writer = self.write(False, 'first.zip')
+
+        # Another plan fills the cache once each entry has been found
+        get = self.cache.get
+
+        def get_then_evict(key):
+            entry = get(key)
+            os.remove(os.path.join(self.cache.directory, key))
+            return entry
+
+        with mock.patch.object(self.cache, 'get', get_then_evict):
+            second, writer = self.write(False, 'second.zip')
+
+        self.assertEqual(writer.hits, len(self.files))
+        self.assertSameArchive(first, second)
+
+    def test_evicted_before_copy(self):
+        first, writer = self.write(False, 'first.zip')
+        self.evict_all()
+
+        with mock.patch.object(self.cache, 'add', lambda key, temp_path: os.remove(temp_path)):
+            second, writer = self.write(False, 'second.zip')
+
+        self.assertEqual(writer.hits, 0)
+        self.assertSameArchive(first, second)
+
+    def test_parallel_evicted_after_lookup(self):
+        first, writer = self.parallel('first.zip')
+
+        # Found in the cache, but gone by the time each is written
+        with mock.patch.object(self.cache, 'get', lambda key: None):
+            second, writer = self.parallel('second.zip')
+
+        self.assertEqual(writer.hits, 0)
+        self.assertSameArchive(first, second)
+
+        third, writer = self.parallel('third.zip')
+        self.assertEqual(writer.hits, len(self.files))
+        self.assertSameArchive(first, third)
+
+if __name__ == '__main__':
+    unittest.main()
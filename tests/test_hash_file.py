@@ -0,0 +1,117 @@
+import hashlib
+import hmac
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from S3Backup import hash_file
+from S3Backup.hash_file import HashingWriter
+from S3Backup.stream_upload import MIN_PART_SIZE, MultipartUploadStream
+from tests.fake_s3 import FakeS3Client
+
+
+class HashingWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(250000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer, data=None):
+        data = self.data if data is None else data
+
+        # In uneven pieces, so parts are filled across writes
+        pieces = random.Random(len(data))
+        position = 0
+        while position < len(data):
+            size = pieces.randint(1, 40000)
+            self.assertEqual(writer.write(data[position:position + size]), len(data[position:position + size]))
+            position += size
+
+        return writer
+
+    def saved(self, data=None):
+        filename = os.path.join(self.directory, 'archive.zip')
+        with open(filename, 'wb') as output:
+            output.write(self.data if data is None else data)
+        return filename
+
+    def test_matches_calc_hash(self):
+        for algorithm in ['md5', 'sha1', 'sha256', 'blake2b']:
+            output = io.BytesIO()
+            writer = self.write(HashingWriter(output, algorithm))
+
+            self.assertEqual(writer.hash_value(), hash_file.calc_hash(self.saved(), algorithm), algorithm)
+            self.assertEqual(output.getvalue(), self.data)
+            self.assertEqual(writer.tell(), len(self.data))
+
+    def test_hash_format(self):
+        # MD5 hashes are bare, as they always were, so existing hash files keep matching
+        self.assertEqual(hash_file.calc_hash(self.saved(), 'md5'), hashlib.md5(self.data).hexdigest())
+        self.assertEqual(hash_file.calc_hash(self.saved(), 'sha256'), 'sha256:' + hashlib.sha256(self.data).hexdigest())
+
+    def test_multipart_etag(self):
+        part_size = 100000
+        writer = self.write(HashingWriter(io.BytesIO(), etag_part_size=part_size))
+
+        parts = [self.data[start:start + part_size] for start in range(0, len(self.data), part_size)]
+        expected = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+
+        self.assertEqual(writer.etag(), '%s-%d' % (expected, len(parts)))
+
+        with self.assertRaises(Exception):
+            writer.etag(multipart=False)
+
+    def test_etag_matches_upload(self):
+        s3_client = FakeS3Client()
+        data = os.urandom(MIN_PART_SIZE * 2 + 1000)
+
+        stream = MultipartUploadStream(s3_client, 'bucket', 'backup.zip', part_size=MIN_PART_SIZE)
+        writer = self.write(HashingWriter(stream, etag_part_size=MIN_PART_SIZE), data)
+        stream.complete()
+
+        self.assertEqual(s3_client.head_object(Bucket='bucket', Key='backup.zip')['ETag'].strip('"'), writer.etag())
+
+    def test_whole_parts(self):
+        # Data ending on a part boundary has no empty part after it
+        writer = self.write(HashingWriter(io.BytesIO(), etag_part_size=125000))
+        self.assertTrue(writer.etag().endswith('-2'))
+
+    def test_single_part_etag(self):
+        writer = self.write(HashingWriter(io.BytesIO(), etag_part_size=len(self.data)))
+
+        self.assertEqual(writer.etag(multipart=False), hashlib.md5(self.data).hexdigest())
+        self.assertEqual(writer.etag(), hashlib.md5(hashlib.md5(self.data).digest()).hexdigest() + '-1')
+
+        empty = HashingWriter(io.BytesIO(), etag_part_size=1024)
+        self.assertEqual(empty.etag(multipart=False), hashlib.md5(b'').hexdigest())
+
+    def test_keyed_hash(self):
+        key = b'k' * 32
+        writer = self.write(HashingWriter(io.BytesIO(), 'sha256', hash_key=key))
+
+        plain = 'sha256:' + hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(writer.hash_value(),
+                         'hmac-sha256:' + hmac.new(key, plain.encode(), hashlib.sha256).hexdigest())
+
+    def test_etag_only(self):
+        writer = self.write(HashingWriter(io.BytesIO(), None, etag_part_size=1024 * 1024))
+
+        self.assertEqual(writer.etag(multipart=False), hashlib.md5(self.data).hexdigest())
+        with self.assertRaises(Exception):
+            writer.hash_value()
+
+        with self.assertRaises(Exception):
+            HashingWriter(io.BytesIO()).etag()
+
+    def test_unknown_algorithm(self):
+        with self.assertRaisesRegex(Exception, 'Unknown hash algorithm'):
+            hash_file.new_hasher('crc32')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from S3Backup import manifest
+
+
+class ManifestPathTest(unittest.TestCase):
+
+    def test_names(self):
+        path = manifest.manifest_path('/var/lib/s3backup/', 'daily backup')
+
+        self.assertEqual(os.path.dirname(path), '/var/lib/s3backup')
+        self.assertRegex(os.path.basename(path), r'^daily_backup-[0-9a-f]{8}\.manifest\.json$')
+        self.assertEqual(path, manifest.manifest_path('/var/lib/s3backup', 'daily backup'))
+
+    def test_similar_names(self):
+        names = ['a b', 'a_b', 'a/b', 'a  b']
+        paths = set(manifest.manifest_path('/tmp', name) for name in names)
+
+        self.assertEqual(len(paths), len(names))
+        self.assertTrue(manifest.manifest_path('/tmp', 'a b', 'snapshot.json.gz').endswith('.snapshot.json.gz'))
+
+
+class BuildManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'plan.manifest.json')
+        self.files = []
+
+        for number in range(5):
+            self.files.append(self.write('file%d' % number, 'x' * number))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as source:
+            source.write(content)
+        return path
+
+    def build(self, files=None, content_hash=False, save=True):
+        new_file, unchanged = manifest.build_manifest(self.files if files is None else files, self.filename,
+                                                      content_hash)
+        if save:
+            manifest.save_manifest(self.filename, new_file)
+        else:
+            manifest.discard_manifest(new_file)
+        return unchanged
+
+    def touch(self, path):
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_unchanged(self):
+        self.assertFalse(self.build())
+        self.assertTrue(self.build())
+
+        # The order the files are found in doesn't matter, nor finding one twice
+        self.assertTrue(self.build(list(reversed(self.files)) + self.files[:1]))
+
+    def test_changes(self):
+        self.build()
+
+        self.assertFalse(self.build(self.files + [self.write('added', 'new')], save=False))
+        self.assertFalse(self.build(self.files[1:], save=False))
+        self.assertFalse(self.build(self.files[:-1], save=False))
+
+        self.touch(self.files[2])
+        self.assertFalse(self.build())
+        self.assertTrue(self.build())
+
+    def test_content_hash(self):
+        self.build(content_hash=True)
+
+        # Rewritten with the same content
+        self.touch(self.files[2])
+        self.assertTrue(self.build(content_hash=True))
+
+        self.write('file2', 'yy')
+        self.touch(self.files[2])
+        self.assertFalse(self.build(content_hash=True))
+
+    def test_sorted_on_disk(self):
+        with mock.patch.object(manifest, 'SORT_RUN_SIZE', 2):
+            self.assertFalse(self.build(list(reversed(self.files))))
+            self.assertTrue(self.build())
+
+        with open(self.filename) as manifest_file:
+            names = [json.loads(line)[0] for line in manifest_file.readlines()[1:]]
+
+        self.assertEqual(names, sorted(self.files))
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(['plan.manifest.json'] +
+                                                                     [os.path.basename(name) for name in self.files]))
+
+    def test_earlier_version(self):
+        files = {}
+        for path in self.files:
+            stat = os.stat(path)
+            files[path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, None]
+
+        with open(self.filename, 'w') as manifest_file:
+            json.dump({'version': 1, 'files': files}, manifest_file)
+
+        self.assertTrue(self.build())
+
+
+if __name__ == '__main__':
+    unittest.main()
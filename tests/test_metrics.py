@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from S3Backup import metrics
+
+
+def finished_metrics(plan_name='plan', status='success'):
+    """
+        Metrics of a run with two phases, and fixed timings
+    """
+    plan_metrics = metrics.PlanMetrics(plan_name)
+
+    with plan_metrics.phase('archive'):
+        plan_metrics.count_files([100, 2048, 0])
+        plan_metrics.add('bytes_compressed', 1024)
+
+    with plan_metrics.phase('upload'):
+        plan_metrics.add('bytes_uploaded', 1024)
+        plan_metrics.add_request('PutObject', 0.25)
+        plan_metrics.add_request('PutObject', 0.5, failed=True)
+
+    plan_metrics.finish(status, updated=True, output_file='plan_2024.zip')
+
+    plan_metrics.started = 1000.0
+    plan_metrics.finished = 1012.5
+    plan_metrics.phases[0].duration = 10.0
+    plan_metrics.phases[1].duration = 2.5
+
+    return plan_metrics
+
+
+class PlanMetricsTest(unittest.TestCase):
+
+    def test_phases(self):
+        plan_metrics = finished_metrics()
+
+        self.assertEqual([(phase.name, phase.status) for phase in plan_metrics.phases],
+                         [('archive', 'ok'), ('upload', 'ok')])
+        self.assertEqual(plan_metrics.phases[0].counters,
+                         {'files': 3, 'bytes_read': 2148, 'bytes_compressed': 1024, 'bytes_uploaded': 0})
+        self.assertEqual(plan_metrics.phases[1].requests, {'PutObject': (2, 0.75, 1)})
+
+    def test_failed_phase(self):
+        plan_metrics = metrics.PlanMetrics('plan')
+
+        with self.assertRaises(ValueError):
+            with plan_metrics.phase('archive'):
+                raise ValueError('disk full')
+
+        self.assertEqual(plan_metrics.phases[0].status, 'failed')
+
+        # Outside a phase there is nothing to count against
+        plan_metrics.add('files')
+        self.assertEqual(plan_metrics.totals()['files'], 0)
+
+    def test_totals(self):
+        totals = finished_metrics().totals()
+
+        self.assertEqual(totals, {'files': 3, 'bytes_read': 2148, 'bytes_compressed': 1024, 'bytes_uploaded': 1024,
+                                  's3_requests': 2, 's3_request_seconds': 0.75, 's3_request_errors': 1})
+
+    def test_write_report(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(directory, 'report.json')
+            metrics.write_report(filename, 1000.0, [finished_metrics()])
+
+            with open(filename) as report_file:
+                report = json.load(report_file)
+
+            self.assertEqual(report['plans'][0]['plan'], 'plan')
+            self.assertEqual(report['plans'][0]['duration_seconds'], 12.5)
+            self.assertEqual(report['plans'][0]['phases'][1]['s3_requests'],
+                             {'PutObject': {'count': 2, 'seconds': 0.75, 'errors': 1}})
+            self.assertEqual(os.listdir(directory), ['report.json'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_format_size(self):
+        self.assertEqual(metrics.format_size(512), '512 B')
+        self.assertEqual(metrics.format_size(1536), '1.5 KB')
+        self.assertEqual(metrics.format_size(3 * 1024 ** 3), '3.0 GB')
+        self.assertEqual(metrics.format_size(2 * 1024 ** 4), '2.0 TB')
+
+    def test_format_table(self):
+        self.assertEqual(metrics.format_table(finished_metrics()).split('\n'), [
+            'Phase    Time   Files  Read    Compressed  Uploaded  S3 requests',
+            'archive  10.0s  3      2.1 KB  1.0 KB',
+            'upload   2.5s                              1.0 KB    2 (0.8s)',
+            'Total    12.5s'
+        ])
+
+    def test_format_summary(self):
+        failed = finished_metrics('other plan', status='failed')
+        failed.updated = False
+
+        self.assertEqual(metrics.format_summary([finished_metrics(), failed]).split('\n'), [
+            'Plan        Status                Time   Files  Read    Uploaded',
+            'plan        success (new backup)  12.5s  3      2.1 KB  1.0 KB',
+            'other plan  failed                12.5s  3      2.1 KB  1.0 KB'
+        ])
+
+    def test_format_prometheus(self):
+        lines = metrics.format_prometheus([finished_metrics('a "quoted" plan')]).split('\n')
+
+        self.assertIn('s3backup_plan_duration_seconds{plan="a \\"quoted\\" plan"} 12.5', lines)
+        self.assertIn('s3backup_phase_files{plan="a \\"quoted\\" plan",phase="archive"} 3', lines)
+        self.assertIn('s3backup_phase_bytes{plan="a \\"quoted\\" plan",phase="archive",kind="read"} 2148', lines)
+        self.assertIn('s3backup_phase_bytes{plan="a \\"quoted\\" plan",phase="upload",kind="uploaded"} 1024', lines)
+        self.assertIn('s3backup_s3_requests{plan="a \\"quoted\\" plan",operation="PutObject"} 2', lines)
+        self.assertIn('s3backup_s3_request_errors{plan="a \\"quoted\\" plan",operation="PutObject"} 1', lines)
+
+        self.assertEqual(lines[:3], ['# HELP s3backup_plan_success Whether the last run of the plan succeeded',
+                                     '# TYPE s3backup_plan_success gauge',
+                                     's3backup_plan_success{plan="a \\"quoted\\" plan"} 1'])
+        self.assertEqual(lines[-1], '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from S3Backup import notify
+from S3Backup import S3BackupTool
+from S3Backup.notify import Notification, Notifier
+from tests.fake_s3 import FakeS3Client, FakeTransferEngine, load_plans
+
+
+class RecordingSink:
+    """
+        Records the notifications sent to it, failing the first few attempts
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.attempts = 0
+        self.sent = []
+
+    def send(self, notification):
+        self.attempts += 1
+
+        if self.attempts <= self.failures:
+            raise Exception('service unavailable')
+
+        self.sent.append(notification)
+
+
+def notification(subject='[S3-Backup] [SUCCESS] - Plan: test'):
+    return Notification(subject, 'body', 'success', [])
+
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.delays = []
+        patcher = mock.patch.object(notify.time, 'sleep', side_effect=self.delays.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def notifier(self, sinks, **settings):
+        return Notifier(sinks, notify.notification_settings(settings))
+
+    def test_delivered(self):
+        sink = RecordingSink()
+        notifier = self.notifier([sink])
+
+        notifier.send(notification('first'))
+        notifier.send(notification('second'))
+
+        self.assertTrue(notifier.flush(10))
+        self.assertEqual([sent.subject for sent in sink.sent], ['first', 'second'])
+        self.assertEqual(self.delays, [])
+
+    def test_retries(self):
+        sink = RecordingSink(failures=2)
+        notifier = self.notifier([sink])
+
+        notifier.send(notification())
+        notifier.flush(10)
+
+        self.assertEqual(sink.attempts, 3)
+        self.assertEqual(len(sink.sent), 1)
+        self.assertEqual(self.delays, [2, 4])
+
+    def test_gives_up(self):
+        failing = RecordingSink(failures=100)
+        working = RecordingSink()
+        notifier = self.notifier([failing, working], Retries=3, RetryDelay=200)
+
+        notifier.send(notification('first'))
+        notifier.send(notification('second'))
+        notifier.flush(10)
+
+        # Each notification is tried Retries more times, with the delay capped, and the sink which works only
+        # gets each one once
+        self.assertEqual(failing.attempts, 8)
+        self.assertEqual(failing.sent, [])
+        self.assertEqual([sent.subject for sent in working.sent], ['first', 'second'])
+        self.assertEqual(self.delays, [200, 300, 300] * 2)
+
+    def test_not_held_up(self):
+        released = threading.Event()
+
+        class SlowSink:
+            def send(self, notification):
+                released.wait(10)
+
+        notifier = self.notifier([SlowSink()])
+
+        # Sending returns straight away, while the sink is still busy
+        notifier.send(notification())
+        self.assertFalse(notifier.flush(0.05))
+
+        released.set()
+        self.assertTrue(notifier.flush(10))
+
+    def test_no_sinks(self):
+        notifier = self.notifier([])
+
+        notifier.send(notification())
+        self.assertTrue(notifier.flush(0))
+
+    def test_settings(self):
+        self.assertFalse(notify.notification_settings(None)['Digest'])
+
+        with self.assertRaisesRegex(Exception, 'Unknown notification setting'):
+            notify.notification_settings({'Digests': True})
+
+
+class NotificationTest(unittest.TestCase):
+    """
+        Runs a plan which succeeds and one which fails, with notifications going to a file
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        self.notifications_file = os.path.join(self.directory, 'notifications.jsonl')
+        os.makedirs(self.source)
+
+        with open(os.path.join(self.source, 'one.txt'), 'w') as output:
+            output.write('first file\n')
+
+        self.working_directory = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def run_plans(self, **settings):
+        plans = [{'Name': 'good', 'Src': os.path.join(self.source, '**'), 'OutputPrefix': 'good'},
+                 {'Name': 'bad', 'Src': os.path.join(self.source, '**'), 'OutputPrefix': 'bad',
+                  'Command': '/bin/false'}]
+        settings['File'] = self.notifications_file
+        load_plans(self.directory, plans, None, NOTIFICATIONS=settings)
+
+        tool = S3BackupTool(os.path.join(self.directory, 'config.json'))
+        tool.CONFIGURATION['TRANSFER_ENGINE'] = FakeTransferEngine(tool.CONFIGURATION, FakeS3Client())
+        tool.run_plans()
+
+        with open(self.notifications_file) as notifications:
+            return [json.loads(line) for line in notifications]
+
+    def test_each_plan(self):
+        sent = sorted(self.run_plans(), key=lambda sent: sent['subject'])
+
+        self.assertEqual([sent['subject'] for sent in sent], ['[S3-Backup] [FAILURE] - Plan: bad',
+                                                             '[S3-Backup] [SUCCESS] - Plan: good'])
+        self.assertEqual([sent['status'] for sent in sent], ['failure', 'success'])
+        self.assertEqual([len(sent['plans']) for sent in sent], [1, 1])
+
+    def test_digest(self):
+        sent = self.run_plans(Digest=True)
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['subject'], '[S3-Backup] [FAILURE] - 2 plans')
+        self.assertEqual(sent[0]['status'], 'failure')
+        self.assertEqual(sorted(plan['plan'] for plan in sent[0]['plans']), ['bad', 'good'])
+
+        self.assertIn('1 succeeded and 1 failed', sent[0]['body'])
+        self.assertIn('New backup for good: good_', sent[0]['body'])
+        self.assertIn('Detailed failure information for bad', sent[0]['body'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from S3Backup.parallel_zip import ParallelZipWriter
+
+
+class ParallelZipWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = []
+
+        for name, size in [('empty.txt', 0), ('small.txt', 1000), ('large.bin', 300 * 1024)]:
+            file_name = os.path.join(self.directory, name)
+            with open(file_name, 'wb') as output:
+                # Compressible, but not trivially
+                output.write((b'%d some text ' % size * (size // 10 + 1))[:size])
+            self.files.append(file_name)
+
+        self.files.append(os.path.join(self.directory, 'stored.bin'))
+        with open(self.files[-1], 'wb') as output:
+            output.write(os.urandom(5000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, allow_zip64, **kwargs):
+        archive = os.path.join(self.directory, 'out.zip')
+
+        with zipfile.ZipFile(archive, 'w', allowZip64=allow_zip64) as zip_file:
+            ParallelZipWriter(zip_file, 2, 1024 * 1024, chunk_size=64 * 1024,
+                              compress_check=lambda file_name: not file_name.endswith('stored.bin'),
+                              **kwargs).write_files(self.files)
+
+        return archive
+
+    def check(self, archive):
+        with zipfile.ZipFile(archive) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+
+            for file_name in self.files:
+                with open(file_name, 'rb') as source:
+                    self.assertEqual(zip_file.read(file_name.lstrip('/')), source.read())
+
+            self.assertEqual(zip_file.getinfo(self.files[-1].lstrip('/')).compress_type, zipfile.ZIP_STORED)
+
+    def test_zip64(self):
+        self.check(self.write(True))
+
+    def test_without_zip64(self):
+        self.check(self.write(False))
+
+    def test_level(self):
+        # A file small enough for one chunk gets the same bytes as zipfile writes at the same level
+        archive = self.write(False, level=1)
+        expected = os.path.join(self.directory, 'expected.zip')
+
+        with zipfile.ZipFile(expected, 'w', allowZip64=False) as zip_file:
+            zip_file.write(self.files[1], compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+        name = self.files[1].lstrip('/')
+
+        with zipfile.ZipFile(archive) as written, zipfile.ZipFile(expected) as reference:
+            self.assertEqual(written.getinfo(name).compress_size, reference.getinfo(name).compress_size)
+            self.assertEqual(written.getinfo(name).CRC, reference.getinfo(name).CRC)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from tests.fake_s3 import FakeS3Client, load_plans
+
+
+class PlanTest(unittest.TestCase):
+    """
+        Runs plans against a FakeS3Client, from a temporary directory (where the archives are staged)
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        os.makedirs(os.path.join(self.source, 'sub'))
+
+        self.write('one.txt', 'first file\n' * 100)
+        self.write('sub/two.txt', 'second file\n' * 100)
+
+        self.s3_client = FakeS3Client()
+
+        self.working_directory = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.source, name)
+        with open(path, 'w') as output:
+            output.write(content)
+        return path
+
+    def touch(self, name):
+        path = os.path.join(self.source, name)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def plan(self, **values):
+        raw_plan = {'Name': 'test plan', 'Src': os.path.join(self.source, '**'), 'OutputPrefix': 'backup'}
+        raw_plan.update(values)
+
+        configuration, plans = load_plans(self.directory, [raw_plan], self.s3_client)
+        return plans[0]
+
+    def run_plan(self, plan):
+        """
+            Run the plan, returning whether it uploaded a new backup and the phases it went through
+        """
+        updated, output_file = plan.run()
+        return updated, [phase.name for phase in plan.metrics.phases]
+
+
+class ManifestTest(PlanTest):
+
+    def test_unchanged_skips_archive(self):
+        plan = self.plan(Manifest=True)
+
+        updated, phases = self.run_plan(plan)
+        self.assertTrue(updated)
+        self.assertIn('archive', phases)
+
+        updated, phases = self.run_plan(plan)
+        self.assertFalse(updated)
+        self.assertIn('manifest_check', phases)
+        self.assertNotIn('archive', phases)
+
+    def test_changes_rebuild(self):
+        plan = self.plan(Manifest=True)
+        self.run_plan(plan)
+
+        self.write('sub/two.txt', 'changed\n')
+        updated, phases = self.run_plan(plan)
+        self.assertTrue(updated)
+
+        self.write('three.txt', 'added\n')
+        self.assertTrue(self.run_plan(plan)[0])
+
+        os.remove(os.path.join(self.source, 'one.txt'))
+        self.assertTrue(self.run_plan(plan)[0])
+
+        self.assertNotIn('archive', self.run_plan(plan)[1])
+
+    def test_touched_file(self):
+        plan = self.plan(Manifest=True)
+        self.run_plan(plan)
+
+        # Without content hashes a file which was only touched can't be told apart from one which changed
+        self.touch('one.txt')
+        self.assertIn('archive', self.run_plan(plan)[1])
+
+    def test_content_hash(self):
+        plan = self.plan(Manifest=True, ManifestContentHash=True)
+        self.run_plan(plan)
+
+        self.touch('one.txt')
+        updated, phases = self.run_plan(plan)
+        self.assertFalse(updated)
+        self.assertNotIn('archive', phases)
+
+    def test_without_previous_hash(self):
+        plan = self.plan(Manifest=True)
+        self.run_plan(plan)
+
+        # The manifest alone doesn't say the last upload completed
+        os.remove(os.path.join(self.directory, 'hashes.txt'))
+        self.assertIn('archive', self.run_plan(plan)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
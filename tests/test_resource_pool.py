@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+from S3Backup.resource_pool import ResourcePool
+
+
+class ResourcePoolTest(unittest.TestCase):
+
+    def blocked(self, pool, cpu_weight, io_weight):
+        """
+            Whether acquiring the weights waits, releasing them straight away if not
+        """
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire(cpu_weight, io_weight)), daemon=True)
+        thread.start()
+        thread.join(0.2)
+
+        if acquired:
+            pool.release(*acquired[0])
+            return False
+
+        return True
+
+    def test_weights(self):
+        pool = ResourcePool(4, 2)
+        pool.acquire(3, 1)
+
+        self.assertFalse(self.blocked(pool, 1, 1))
+        self.assertTrue(self.blocked(pool, 2, 0))
+        self.assertTrue(self.blocked(pool, 0, 2))
+
+    def test_heavier_than_pool(self):
+        pool = ResourcePool(2, 2)
+        self.assertEqual(pool.acquire(5, 1), (2, 1))
+
+    def test_max_plans(self):
+        pool = ResourcePool(8, 8, max_plans=2)
+        pool.acquire(0, 0)
+        weights = pool.acquire(1, 1)
+
+        # Plans weighing nothing still count towards the number running
+        self.assertTrue(self.blocked(pool, 0, 0))
+
+        pool.release(*weights)
+        self.assertFalse(self.blocked(pool, 0, 0))
+
+    def test_release_wakes_waiting(self):
+        pool = ResourcePool(1, 1)
+        weights = pool.acquire(1, 1)
+        started = []
+
+        thread = threading.Thread(target=lambda: started.append(pool.acquire(1, 1)))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(started, [])
+
+        pool.release(*weights)
+        thread.join(5)
+        self.assertEqual(started, [(1, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
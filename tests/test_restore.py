@@ -0,0 +1,121 @@
+import os
+import unittest
+from unittest import mock
+from S3Backup import restore
+from S3Backup.restore import Restore
+from tests.test_plan import PlanTest
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class RestoreTest(PlanTest):
+    """
+        Restores backups made by plans from a FakeS3Client, counting the bytes each restore fetches
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.destination = os.path.join(self.directory, 'restored')
+        # Entries are named by their path, without the leading separator
+        self.prefix = self.source.lstrip(os.sep).replace(os.sep, '/') + '/'
+        self.fetched = 0
+
+        get_object = self.s3_client.get_object
+
+        def counted(**kwargs):
+            response = get_object(**kwargs)
+            self.fetched += response['ContentLength']
+            return response
+
+        patcher = mock.patch.object(self.s3_client, 'get_object', side_effect=counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def backup(self, **values):
+        plan = self.plan(**values)
+        plan.run()
+
+        self.fetched = 0
+        return Restore(self.s3_client, 'bucket', threads=3).latest_backup(plan)
+
+    def restore(self, key, patterns=None):
+        patterns = [self.prefix + pattern for pattern in patterns or []]
+        return Restore(self.s3_client, 'bucket', threads=3).restore(key, self.destination, patterns)
+
+    def assertRestored(self, names):
+        restored = []
+        for directory, directories, files in os.walk(self.destination):
+            restored.extend(os.path.relpath(os.path.join(directory, name), self.destination) for name in files)
+
+        self.assertEqual(sorted(restored), sorted(os.path.join(self.prefix, name) for name in names))
+
+        for name in names:
+            with open(os.path.join(self.source, name), 'rb') as source:
+                with open(os.path.join(self.destination, self.prefix, name), 'rb') as restored_file:
+                    self.assertEqual(restored_file.read(), source.read(), name)
+
+    def test_zip(self):
+        key = self.backup()
+
+        self.assertEqual(self.restore(key), (2, 2300))
+        self.assertRestored(['one.txt', 'sub/two.txt'])
+
+    def test_zip_selected(self):
+        with open(os.path.join(self.source, 'large.bin'), 'wb') as output:
+            output.write(os.urandom(200000))
+
+        key = self.backup()
+        size = len(self.s3_client.objects[key][0])
+
+        # Only the end of the archive and the entry itself are fetched
+        with mock.patch.object(restore, 'TAIL_SIZE', 4096):
+            self.assertEqual(self.restore(key, ['one.txt']), (1, 1100))
+
+        self.assertRestored(['one.txt'])
+        self.assertLess(self.fetched, 4096 + 1100 + restore.HEADER_SLACK * 2)
+        self.assertLess(self.fetched, size // 10)
+
+    def test_large_entry(self):
+        with open(os.path.join(self.source, 'large.bin'), 'wb') as output:
+            output.write(os.urandom(200000))
+
+        key = self.backup()
+
+        # Fetched as several ranges, read in order however they arrive
+        with mock.patch.object(restore, 'RANGE_SIZE', 16384), mock.patch.object(restore, 'TAIL_SIZE', 4096):
+            self.assertEqual(self.restore(key, ['large.bin', 'sub']), (2, 201200))
+
+        self.assertRestored(['large.bin', 'sub/two.txt'])
+        self.assertGreater(self.s3_client.get_object.call_count, 200000 // 16384)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_tar(self):
+        key = self.backup(Compression={'Format': 'tar.zst'})
+        self.assertTrue(key.endswith('.tar.zst'))
+
+        self.assertEqual(self.restore(key, ['sub']), (1, 1200))
+        self.assertRestored(['sub/two.txt'])
+
+    def test_volumes(self):
+        key = self.backup(VolumeMaxEntries=1)
+
+        self.assertEqual(self.restore(key, ['*.txt']), (2, 2300))
+        self.assertRestored(['one.txt', 'sub/two.txt'])
+
+        self.assertEqual(sorted(name for name, size in Restore(self.s3_client, 'bucket').list_entries(key)),
+                         [self.prefix + 'one.txt', self.prefix + 'sub/', self.prefix + 'sub/two.txt'])
+
+    def test_outside_destination(self):
+        for name in ['../escaped', 'sub/../../escaped', '', '/']:
+            with self.assertRaises(Exception):
+                restore.target_path(self.destination, name)
+
+        self.assertEqual(restore.target_path(self.destination, '/sub/./two.txt'),
+                         os.path.join(self.destination, 'sub', 'two.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
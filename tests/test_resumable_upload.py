@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from S3Backup.resumable_upload import ResumableUpload
+from S3Backup.stream_upload import MIN_PART_SIZE
+from tests.fake_s3 import FakeS3Client
+from tests.test_plan import PlanTest
+
+
+class FailingParts:
+    """
+        Wraps upload_part, failing the given part numbers and recording the ones sent
+    """
+
+    def __init__(self, s3_client, failing=()):
+        self.upload_part = s3_client.upload_part
+        self.failing = set(failing)
+        self.sent = []
+
+    def __call__(self, **kwargs):
+        if kwargs['PartNumber'] in self.failing:
+            raise Exception('connection reset')
+
+        self.sent.append(kwargs['PartNumber'])
+        return self.upload_part(**kwargs)
+
+
+class ResumableUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'backup.zip')
+        self.data = os.urandom(MIN_PART_SIZE * 2 + 1000)
+
+        with open(self.filename, 'wb') as output:
+            output.write(self.data)
+
+        self.s3_client = FakeS3Client()
+        self.checkpoints = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, previous_state=None, failing=()):
+        """
+            Run an upload, one part at a time so the parts sent are predictable, returning the parts it sent
+        """
+        upload = ResumableUpload(self.s3_client, 'bucket', 'backup.zip', self.filename, MIN_PART_SIZE,
+                                 max_in_flight=1, checkpoint=self.checkpoints.append, previous_state=previous_state)
+        parts = FailingParts(self.s3_client, failing)
+
+        with mock.patch.object(self.s3_client, 'upload_part', side_effect=parts):
+            upload.run()
+
+        return parts.sent
+
+    def interrupted(self):
+        with self.assertRaisesRegex(Exception, 'connection reset'):
+            self.upload(failing=[3])
+
+        self.assertEqual(self.s3_client.objects, {})
+        return self.checkpoints[-1]
+
+    def test_complete(self):
+        self.assertEqual(self.upload(), [1, 2, 3])
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+        self.assertEqual(self.s3_client.uploads, {})
+
+        # One checkpoint when the upload starts, then one for each part
+        self.assertEqual(len(self.checkpoints), 4)
+        self.assertEqual(sorted(self.checkpoints[-1]['parts']), ['1', '2', '3'])
+
+    def test_resume(self):
+        state = self.interrupted()
+        self.assertEqual(sorted(state['parts']), ['1', '2'])
+
+        self.assertEqual(self.upload(state), [3])
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_checkpoint_behind(self):
+        state = self.interrupted()
+
+        # S3 has parts the checkpoint never recorded
+        state['parts'] = {}
+        self.assertEqual(self.upload(state), [3])
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+
+    def test_changed_file(self):
+        state = self.interrupted()
+
+        self.data = os.urandom(len(self.data))
+        with open(self.filename, 'wb') as output:
+            output.write(self.data)
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        # The old upload is aborted rather than left to be billed
+        self.assertEqual(self.upload(state), [1, 2, 3])
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_upload_gone(self):
+        state = self.interrupted()
+        self.s3_client.abort_multipart_upload(Bucket='bucket', Key='backup.zip', UploadId=state['upload_id'])
+
+        self.assertEqual(self.upload(state), [1, 2, 3])
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+
+
+class PendingUploadTest(PlanTest):
+
+    def test_resumed_by_next_run(self):
+        # Big enough for the archive to be uploaded in parts
+        with open(os.path.join(self.source, 'large.bin'), 'wb') as output:
+            output.write(os.urandom(MIN_PART_SIZE + 1000))
+
+        plan = self.plan(Transfer={'PartSize': 5, 'MaxConcurrency': 1})
+        parts = FailingParts(self.s3_client, [2])
+
+        with mock.patch.object(self.s3_client, 'upload_part', side_effect=parts):
+            with self.assertRaisesRegex(Exception, 'connection reset'):
+                plan.run()
+
+        staged_file = plan.staged_file
+        self.assertTrue(os.path.isfile(staged_file))
+        self.assertEqual(self.s3_client.objects, {})
+
+        # The next run uploads the archive left behind, sending only the part that failed
+        parts = FailingParts(self.s3_client)
+        with mock.patch.object(self.s3_client, 'upload_part', side_effect=parts):
+            updated, phases = self.run_plan(plan)
+
+        self.assertTrue(updated)
+        self.assertNotIn('archive', phases)
+        self.assertEqual(parts.sent, [2])
+        self.assertFalse(os.path.isfile(staged_file))
+        self.assertEqual(self.s3_client.uploads, {})
+
+        with open(os.path.join(self.directory, 'hashes.txt')) as hashes:
+            self.assertIn('test plan', hashes.read())
+
+        # With the backup complete, the run after that is back to normal
+        updated, phases = self.run_plan(plan)
+        self.assertFalse(updated)
+        self.assertIn('archive', phases)
+
+
+if __name__ == '__main__':
+    unittest.main()
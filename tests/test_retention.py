@@ -0,0 +1,82 @@
+import unittest
+from datetime import datetime, timedelta
+from S3Backup.retention import RetentionPolicy, group_backups
+
+
+class GroupBackupsTest(unittest.TestCase):
+
+    def test_group(self):
+        keys = ['plan_2024-01-02_00-00-00.zip',
+                'plan_2024-01-01_00-00-00.vol0002.zip',
+                'plan_2024-01-01_00-00-00.vol0001.zip',
+                'plan_2024-01-01_00-00-00.volumes.json',
+                'plan_2024-01-03_00-00-00',
+                'plan-other_2024-01-01_00-00-00.zip',
+                'plan_2024-13-01_00-00-00.zip',
+                'plan_latest.zip']
+
+        grouped = group_backups(keys, 'plan')
+
+        self.assertEqual(list(grouped.keys()), [datetime(2024, 1, 1), datetime(2024, 1, 2), datetime(2024, 1, 3)])
+        self.assertEqual(grouped[datetime(2024, 1, 1)], ['plan_2024-01-01_00-00-00.vol0001.zip',
+                                                         'plan_2024-01-01_00-00-00.vol0002.zip',
+                                                         'plan_2024-01-01_00-00-00.volumes.json'])
+
+    def test_separator(self):
+        grouped = group_backups(['plan/snapshots/2024-01-01_00-00-00.json.gz'], 'plan/snapshots', separator='/')
+        self.assertEqual(list(grouped.keys()), [datetime(2024, 1, 1)])
+
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        # A backup every six hours for 100 days, up to midday on 10 April 2024
+        self.now = datetime(2024, 4, 10, 12, 0)
+        self.timestamps = [self.now - timedelta(hours=6 * number) for number in range(400)]
+
+    def kept(self, raw_policy, keep_last=0):
+        removed = RetentionPolicy(raw_policy, keep_last).to_remove(self.timestamps, self.now)
+        return sorted(set(self.timestamps) - set(removed), reverse=True)
+
+    def test_keep_last(self):
+        self.assertEqual(self.kept(None, 3), sorted(self.timestamps, reverse=True)[:3])
+
+    def test_keep_nothing(self):
+        removed = RetentionPolicy(None, 0).to_remove(self.timestamps, self.now)
+        self.assertEqual(removed, sorted(self.timestamps))
+
+    def test_keep_within_days(self):
+        kept = self.kept({'KeepWithinDays': 2})
+        self.assertEqual(len(kept), 9)
+        self.assertTrue(all(timestamp >= self.now - timedelta(days=2) for timestamp in kept))
+
+    def test_keep_daily(self):
+        kept = self.kept({'KeepDaily': 5})
+
+        # The newest backup of each of the last five days which have one
+        self.assertEqual(kept, [datetime(2024, 4, 10, 12), datetime(2024, 4, 9, 18), datetime(2024, 4, 8, 18),
+                                datetime(2024, 4, 7, 18), datetime(2024, 4, 6, 18)])
+
+    def test_keep_weekly_and_monthly(self):
+        kept = self.kept({'KeepWeekly': 2, 'KeepMonthly': 3})
+
+        self.assertEqual(kept, [datetime(2024, 4, 10, 12), datetime(2024, 4, 7, 18), datetime(2024, 3, 31, 18),
+                                datetime(2024, 2, 29, 18)])
+
+    def test_rules_combine(self):
+        kept = self.kept({'KeepDaily': 2, 'KeepYearly': 1}, keep_last=3)
+
+        self.assertEqual(kept, [datetime(2024, 4, 10, 12), datetime(2024, 4, 10, 6), datetime(2024, 4, 10, 0),
+                                datetime(2024, 4, 9, 18)])
+
+    def test_removed_oldest_first(self):
+        removed = RetentionPolicy(None, 1).to_remove(self.timestamps, self.now)
+        self.assertEqual(removed, sorted(removed))
+
+    def test_unknown_rule(self):
+        with self.assertRaises(Exception):
+            RetentionPolicy({'KeepForever': 1}, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
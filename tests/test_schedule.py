@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime
+from S3Backup.schedule import CronSchedule
+
+
+class CronScheduleTest(unittest.TestCase):
+
+    def assertNextRun(self, expression, after, expected):
+        self.assertEqual(CronSchedule(expression).next_run(after), expected)
+
+    def test_fields(self):
+        schedule = CronSchedule('0,30 1-3 */10 jan-mar mon')
+
+        self.assertEqual(schedule.minutes, {0, 30})
+        self.assertEqual(schedule.hours, {1, 2, 3})
+        self.assertEqual(schedule.days, {1, 11, 21, 31})
+        self.assertEqual(schedule.months, {1, 2, 3})
+        self.assertEqual(schedule.weekdays, {1})
+
+    def test_steps(self):
+        self.assertEqual(CronSchedule('5/20 * * * *').minutes, {5, 25, 45})
+        self.assertEqual(CronSchedule('10-20/5 * * * *').minutes, {10, 15, 20})
+
+    def test_sunday(self):
+        self.assertEqual(CronSchedule('0 0 * * 7').weekdays, {0, 7})
+        self.assertEqual(CronSchedule('0 0 * * SUN').weekdays, {0})
+
+    def test_aliases(self):
+        self.assertNextRun('@hourly', datetime(2024, 1, 1, 10, 15), datetime(2024, 1, 1, 11, 0))
+        self.assertNextRun('@daily', datetime(2024, 1, 1, 10, 15), datetime(2024, 1, 2, 0, 0))
+        self.assertNextRun('@weekly', datetime(2024, 1, 1, 10, 15), datetime(2024, 1, 7, 0, 0))
+        self.assertNextRun('@monthly', datetime(2024, 1, 31, 10, 15), datetime(2024, 2, 1, 0, 0))
+        self.assertNextRun('@yearly', datetime(2024, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 0))
+
+    def test_next_run(self):
+        # Strictly after, even when the time given matches
+        self.assertNextRun('*/15 * * * *', datetime(2024, 1, 1, 10, 15, 30), datetime(2024, 1, 1, 10, 30))
+        self.assertNextRun('30 2 * * *', datetime(2024, 1, 1, 2, 30), datetime(2024, 1, 2, 2, 30))
+        self.assertNextRun('0 0 29 2 *', datetime(2024, 3, 1), datetime(2028, 2, 29, 0, 0))
+        self.assertNextRun('59 23 31 12 *', datetime(2024, 12, 31, 23, 58), datetime(2024, 12, 31, 23, 59))
+
+    def test_day_of_month_or_week(self):
+        # Restricting both runs on a day matching either, as cron does
+        schedule = CronSchedule('0 0 15 * fri')
+        self.assertEqual(schedule.next_run(datetime(2024, 1, 1)), datetime(2024, 1, 5))
+        self.assertEqual(schedule.next_run(datetime(2024, 1, 13)), datetime(2024, 1, 15))
+
+        # Restricting just one of them only runs on that
+        self.assertNextRun('0 0 * * fri', datetime(2024, 1, 13), datetime(2024, 1, 19))
+
+    def test_invalid(self):
+        for expression in ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *', '* * * * 8',
+                           '5-1 * * * *', '*/0 * * * *', 'x * * * *', '@often']:
+            with self.assertRaises(Exception, msg=expression):
+                CronSchedule(expression)
+
+    def test_never_runs(self):
+        # Rejected when parsed, so a config using it fails to load
+        for expression in ['0 0 31 2 *', '0 0 30 2 *', '0 0 31 apr,jun,sep,nov *']:
+            with self.assertRaisesRegex(Exception, 'never runs', msg=expression):
+                CronSchedule(expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from S3Backup import state_store
+from S3Backup.state_store import SqliteStateStore, TextStateStore
+
+
+class StateStoreTests:
+    """
+        The behaviour both backends share, run against each of them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_values(self):
+        store = self.open()
+        store.update('plan', {state_store.HASH_KEY: 'abc', 'size': 10, 'volumes': ['a', 'b'], 'upload': {'id': 1}})
+
+        self.assertEqual(store.get_value('plan', state_store.HASH_KEY), 'abc')
+        self.assertEqual(store.get_value('plan', 'volumes'), ['a', 'b'])
+        self.assertEqual(store.get('plan'), {'hash': 'abc', 'size': 10, 'volumes': ['a', 'b'], 'upload': {'id': 1}})
+        self.assertEqual(store.get_value('other', 'size', 'missing'), 'missing')
+        self.assertEqual(store.get('other'), {})
+
+    def test_remove(self):
+        store = self.open()
+        store.update('plan', {'one': 1, 'two': 2})
+        store.update('plan', {'one': None})
+
+        self.assertEqual(store.get('plan'), {'two': 2})
+
+    def test_persisted(self):
+        self.open().update('plan', {'hash': 'abc', 'last_run': '2024-01-01_00-00-00'})
+        self.assertEqual(self.open().get('plan'), {'hash': 'abc', 'last_run': '2024-01-01_00-00-00'})
+
+    def test_plan_names(self):
+        names = ['Backup #2', 'a=b', 'c#d=e', '100% done', 'line\nbreak']
+
+        store = self.open()
+        for number, name in enumerate(names):
+            store.update(name, {state_store.HASH_KEY: 'hash%d' % number, 'last_run': name})
+
+        store = self.open()
+        for number, name in enumerate(names):
+            self.assertEqual(store.get(name), {'hash': 'hash%d' % number, 'last_run': name})
+
+    def test_concurrent_updates(self):
+        store = self.open()
+
+        def update(number):
+            for count in range(20):
+                store.update('plan%d' % number, {'count': count})
+
+        threads = [threading.Thread(target=update, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([store.get_value('plan%d' % number, 'count') for number in range(4)], [19] * 4)
+
+
+class TextStateStoreTest(StateStoreTests, unittest.TestCase):
+
+    def open(self):
+        return TextStateStore(self.filename)
+
+    def test_legacy_format(self):
+        with open(self.filename, 'w') as state_file:
+            state_file.write('old-plan=0123abcd\n')
+
+        store = self.open()
+        self.assertEqual(store.get_value('old-plan', state_store.HASH_KEY), '0123abcd')
+
+        store.update('old-plan', {'last_run': '2024-01-01_00-00-00'})
+
+        # The hash stays on a line older versions can read
+        with open(self.filename) as state_file:
+            self.assertIn('old-plan=0123abcd\n', state_file.readlines())
+
+    def test_legacy_name_with_separator(self):
+        # Older versions wrote plan names as they were
+        with open(self.filename, 'w') as state_file:
+            state_file.write('Backup #2=0123abcd\nother=4567cdef\n')
+
+        store = self.open()
+        self.assertEqual(store.get('Backup #2'), {'hash': '0123abcd'})
+        self.assertEqual(store.get('other'), {'hash': '4567cdef'})
+
+    def test_changed_on_disk(self):
+        store = self.open()
+        store.update('plan', {'hash': 'abc'})
+
+        self.open().update('plan', {'hash': 'def'})
+        self.assertEqual(store.get_value('plan', 'hash'), 'def')
+
+
+class SqliteStateStoreTest(StateStoreTests, unittest.TestCase):
+
+    def open(self):
+        return SqliteStateStore(self.filename)
+
+    def test_import_legacy(self):
+        legacy = os.path.join(self.directory, 'hashes.txt')
+        with open(legacy, 'w') as state_file:
+            state_file.write('old-plan=0123abcd\nold-plan#last_run="2024-01-01_00-00-00"\n')
+
+        store = SqliteStateStore(self.filename, legacy)
+        self.assertEqual(store.get('old-plan'), {'hash': '0123abcd', 'last_run': '2024-01-01_00-00-00'})
+
+        # Only imported into an empty database
+        store.update('old-plan', {'hash': 'newer'})
+        self.assertEqual(SqliteStateStore(self.filename, legacy).get_value('old-plan', 'hash'), 'newer')
+
+
+class OpenStoreTest(unittest.TestCase):
+
+    def test_shared(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(directory, 'state')
+            self.assertIs(state_store.open_store('text', filename), state_store.open_store('text', filename))
+
+            with self.assertRaises(Exception):
+                state_store.open_store('yaml', filename)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import unittest
+from unittest import mock
+from S3Backup.stream_upload import MIN_PART_SIZE, MultipartUploadStream
+from tests.fake_s3 import FakeS3Client
+
+
+class MultipartUploadStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_client = FakeS3Client()
+        self.data = os.urandom(MIN_PART_SIZE * 2 + 1000)
+
+    def write(self, stream, size=1024 * 1024):
+        for start in range(0, len(self.data), size):
+            stream.write(self.data[start:start + size])
+
+    def test_complete(self):
+        stream = MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip')
+        self.write(stream)
+        stream.complete()
+
+        self.assertEqual(stream.tell(), len(self.data))
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], self.data)
+        self.assertTrue(self.s3_client.etags['backup.zip'].endswith('-3'))
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_empty(self):
+        stream = MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip')
+        stream.complete()
+
+        self.assertEqual(self.s3_client.objects['backup.zip'][0], b'')
+
+    def test_abort(self):
+        stream = MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip')
+        self.write(stream)
+        stream.abort()
+
+        self.assertEqual(self.s3_client.objects, {})
+        self.assertEqual(self.s3_client.uploads, {})
+
+        with self.assertRaises(ValueError):
+            stream.write(b'more')
+
+    def test_failed_part_aborts(self):
+        upload_part = self.s3_client.upload_part
+
+        def fail_second_part(**kwargs):
+            if kwargs['PartNumber'] == 2:
+                raise Exception('connection reset')
+            return upload_part(**kwargs)
+
+        stream = MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip')
+
+        # The failure surfaces from whichever write or complete() comes after it, and the writer aborts, as a
+        # streaming plan does
+        with mock.patch.object(self.s3_client, 'upload_part', side_effect=fail_second_part):
+            with self.assertRaisesRegex(Exception, 'connection reset'):
+                try:
+                    self.write(stream)
+                    stream.complete()
+                except Exception:
+                    stream.abort()
+                    raise
+
+        # Nothing is left behind to be billed, and no object was created
+        self.assertEqual(self.s3_client.uploads, {})
+        self.assertEqual(self.s3_client.objects, {})
+
+    def test_failed_complete_aborts(self):
+        stream = MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip')
+        self.write(stream)
+
+        with mock.patch.object(self.s3_client, 'complete_multipart_upload', side_effect=Exception('timed out')):
+            with self.assertRaisesRegex(Exception, 'timed out'):
+                stream.complete()
+
+        self.assertEqual(self.s3_client.uploads, {})
+        self.assertEqual(self.s3_client.objects, {})
+
+    def test_part_size(self):
+        with self.assertRaises(Exception):
+            MultipartUploadStream(self.s3_client, 'bucket', 'backup.zip', part_size=MIN_PART_SIZE - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
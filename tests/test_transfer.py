@@ -0,0 +1,161 @@
+import io
+import time
+import unittest
+from unittest import mock
+from S3Backup import transfer
+from S3Backup.transfer import ThrottledReader, TokenBucket, TransferEngine
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+class FakeClock:
+    """
+        Stands in for the time module, with sleep() moving the clock on rather than waiting
+    """
+
+    def __init__(self, hour=12, minute=0):
+        self.now = 1000.0
+        self.slept = 0.0
+        self.hour = hour
+        self.minute = minute
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+    def localtime(self):
+        return time.struct_time((2024, 1, 1, self.hour, self.minute, 0, 0, 1, -1))
+
+
+def configuration(**values):
+    config = {'AWS_KEY': 'key', 'AWS_SECRET': 'secret', 'AWS_BUCKET': 'bucket', 'AWS_REGION': 'us-east-1',
+              'AWS_ENDPOINT_URL': None, 'TRANSFER': None}
+    config.update(values)
+    return config
+
+
+class TransferSettingsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        settings = transfer.transfer_settings()
+
+        self.assertEqual(settings['PartSize'], 8)
+        self.assertEqual(settings['MaxPoolConnections'], settings['MaxConcurrency'])
+
+    def test_overrides(self):
+        # The root settings, then the plan's own
+        settings = transfer.transfer_settings({'MaxConcurrency': 4, 'PartSize': 16}, None, {'PartSize': 32})
+
+        self.assertEqual(settings['PartSize'], 32)
+        self.assertEqual(settings['MaxConcurrency'], 4)
+        self.assertEqual(settings['MaxPoolConnections'], 4)
+
+    def test_unknown(self):
+        with self.assertRaisesRegex(Exception, 'Unknown transfer setting'):
+            transfer.transfer_settings({'PartSizeMB': 16})
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_rate(self):
+        clock = FakeClock()
+
+        with mock.patch.object(transfer, 'time', clock):
+            bucket = TokenBucket(1000)
+
+            # A second's worth goes straight away, the rest at the rate
+            bucket.consume(1000)
+            self.assertEqual(clock.slept, 0)
+
+            bucket.consume(2500)
+            self.assertAlmostEqual(clock.slept, 2.5)
+
+    def test_refills(self):
+        clock = FakeClock()
+
+        with mock.patch.object(transfer, 'time', clock):
+            bucket = TokenBucket(1000)
+            bucket.consume(1000)
+
+            clock.now += 0.5
+            bucket.consume(500)
+            self.assertEqual(clock.slept, 0)
+
+            # Never more than a second's worth builds up
+            clock.now += 60
+            bucket.consume(1500)
+            self.assertAlmostEqual(clock.slept, 0.5)
+
+    def test_hours(self):
+        for hour, hours, active in [(12, '08:00-18:00', True), (19, '08:00-18:00', False),
+                                    (23, '22:00-06:00', True), (3, '22:00-06:00', True), (12, '22:00-06:00', False)]:
+            clock = FakeClock(hour=hour)
+
+            with mock.patch.object(transfer, 'time', clock):
+                bucket = TokenBucket(1000, hours)
+                self.assertEqual(bucket.active(), active, (hour, hours))
+
+                bucket.consume(5000)
+                self.assertEqual(clock.slept > 0, active, (hour, hours))
+
+    def test_throttled_reader(self):
+        clock = FakeClock()
+
+        with mock.patch.object(transfer, 'time', clock):
+            reader = ThrottledReader(io.BytesIO(b'x' * 3000), TokenBucket(1000))
+
+            self.assertEqual(len(reader.read()), 3000)
+            self.assertAlmostEqual(clock.slept, 2.0)
+            self.assertEqual(reader.tell(), 3000)
+
+
+class TransferEngineTest(unittest.TestCase):
+
+    def test_throttle_shared(self):
+        engine = TransferEngine(configuration())
+
+        self.assertIsNone(engine.throttle())
+
+        limited = transfer.transfer_settings({'BandwidthLimit': 512})
+        bucket = engine.throttle(limited)
+
+        # Plans with the same limit share a bucket, so it applies to their traffic together
+        self.assertIs(engine.throttle(transfer.transfer_settings({'BandwidthLimit': 512, 'PartSize': 16})), bucket)
+        self.assertIsNot(engine.throttle(transfer.transfer_settings({'BandwidthLimit': 1024})), bucket)
+        self.assertIsNot(engine.throttle(transfer.transfer_settings({'BandwidthLimit': 512,
+                                                                     'BandwidthLimitHours': '08:00-18:00'})), bucket)
+        self.assertEqual(bucket.rate, 512 * 1024)
+
+    def test_part_size(self):
+        engine = TransferEngine(configuration(TRANSFER={'PartSize': 16}))
+
+        self.assertEqual(engine.part_size(), 16 * 1024 * 1024)
+        self.assertEqual(engine.part_size(transfer.transfer_settings({'PartSize': 5})), 5 * 1024 * 1024)
+
+    @unittest.skipIf(boto3 is None, 'boto3 is not installed')
+    def test_clients_shared(self):
+        engine = TransferEngine(configuration())
+        client = engine.client('s3')
+
+        # One client for each connection pool size, whichever plan asks
+        self.assertIs(engine.client('s3', transfer.transfer_settings({'PartSize': 16})), client)
+        self.assertIsNot(engine.client('s3', transfer.transfer_settings({'MaxPoolConnections': 50})), client)
+        self.assertEqual(client.meta.config.max_pool_connections, 10)
+
+    @unittest.skipIf(boto3 is None, 'boto3 is not installed')
+    def test_endpoint_url(self):
+        engine = TransferEngine(configuration(AWS_ENDPOINT_URL='http://127.0.0.1:9000'))
+        client = engine.client('s3')
+
+        self.assertEqual(client.meta.endpoint_url, 'http://127.0.0.1:9000')
+        self.assertEqual(client.meta.config.s3['addressing_style'], 'path')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from S3Backup import volumes
+
+
+class VolumeUploadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uploaded = []
+        self.copied = []
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, filename, key, hash_value, expected_etag):
+        with self.lock:
+            self.uploaded.append(key)
+
+    def copy(self, source_key, key, hash_value):
+        with self.lock:
+            self.copied.append((source_key, key))
+
+    def uploads(self, previous_hashes):
+        return volumes.VolumeUploads(self.upload, self.copy, self.deleted.extend, previous_hashes,
+                                     lambda: ['old%d' % number for number in range(len(previous_hashes))])
+
+    def add(self, uploads, number, hash_value):
+        filename = os.path.join(self.directory, 'vol%d' % number)
+        with open(filename, 'wb') as output:
+            output.write(b'volume')
+
+        uploads.add(filename, 'new%d' % number, hash_value, 6)
+        return filename
+
+    def test_unchanged_volumes_are_not_kept(self):
+        uploads = self.uploads(['a', 'b', 'c'])
+
+        for number, hash_value in enumerate(['a', 'b']):
+            self.assertFalse(os.path.exists(self.add(uploads, number, hash_value)))
+
+        self.add(uploads, 2, 'changed')
+        uploads.finish()
+
+        self.assertEqual(sorted(self.copied), [('old0', 'new0'), ('old1', 'new1')])
+        self.assertEqual(self.uploaded, ['new2'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_unchanged_backup_sends_nothing(self):
+        uploads = self.uploads(['a', 'b'])
+        self.add(uploads, 0, 'a')
+        self.add(uploads, 1, 'b')
+        uploads.discard()
+
+        self.assertEqual((self.uploaded, self.copied, self.deleted), ([], [], []))
+
+    def test_discard_removes_copies(self):
+        uploads = self.uploads(['a', 'b'])
+        self.add(uploads, 0, 'a')
+        self.add(uploads, 1, 'changed')
+        uploads.finish()
+        uploads.discard()
+
+        self.assertEqual(sorted(self.deleted), ['new0', 'new1'])
+
+
+class SplitVolumesTest(unittest.TestCase):
+
+    def test_max_entries(self):
+        split = [list(volume) for volume in volumes.split_volumes(['/a', '/b', '/c'], max_entries=2)]
+        self.assertEqual(split, [['/a', '/b'], ['/c']])
+
+    def test_empty(self):
+        self.assertEqual([list(volume) for volume in volumes.split_volumes([])], [[]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from S3Backup.walker import Walker
+
+try:
+    import glob2
+except ImportError:
+    glob2 = None
+
+FILES = ['top.txt', '.hidden.txt', 'a/one.txt', 'a/b/two.log', 'a/b/c/three.txt', 'a/b/.six.txt',
+         'a/.dot/four.txt', '.hid/x/five.txt', 'node_modules/lib.js', 'a/node_modules/lib.js']
+
+PATTERNS = ['**', '**/*', '**/*.txt', '*', 'a/*/*.log', '**/b', 'a/**/c/*', 'top.txt', 'nothing/**', '?/b',
+            'a/[bc]/*', '.hid/**']
+
+
+def _hidden(path):
+    return any(part.startswith('.') for part in path.split(os.sep))
+
+
+class WalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        for name in FILES:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as output:
+                output.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def walk(self, patterns, **kwargs):
+        return [os.path.relpath(path, self.directory)
+                for path in Walker([os.path.join(self.directory, pattern) for pattern in patterns], **kwargs)]
+
+    def test_double_star(self):
+        self.assertEqual(sorted(self.walk(['**/*.txt'])), ['a/b/c/three.txt', 'a/one.txt', 'top.txt'])
+        self.assertEqual(sorted(self.walk(['a/**/c'])), ['a/b/c'])
+
+        # A trailing "**" matches everything below the directory, but not the directory itself
+        self.assertEqual(sorted(self.walk(['a/b/**'])), ['a/b/c', 'a/b/c/three.txt', 'a/b/two.log'])
+
+    def test_hidden(self):
+        self.assertNotIn('.hidden.txt', self.walk(['*']))
+        self.assertIn('.hidden.txt', self.walk(['*'], include_hidden=True))
+        self.assertIn('.hidden.txt', self.walk(['.*']))
+
+        # Hidden names are left out at any depth, not just the first
+        self.assertFalse([path for path in self.walk(['**']) if _hidden(path)])
+        self.assertIn('a/.dot/four.txt', self.walk(['**'], include_hidden=True))
+
+    def test_overlapping_patterns(self):
+        # Folded into one walk, with every path produced once and the same paths as walking them separately
+        for patterns in [['**/*.txt', 'a/**', 'top.txt'], ['a/**', '**/b/*'], ['a/b/**', 'a/*']]:
+            paths = self.walk(patterns)
+            self.assertEqual(len(paths), len(set(paths)))
+            self.assertEqual(set(paths), set(path for pattern in patterns for path in self.walk([pattern])))
+
+    def test_sorted(self):
+        paths = self.walk(['**'])
+        self.assertEqual(paths, self.walk(['**']))
+
+        for directory in set(os.path.dirname(path) for path in paths):
+            names = [os.path.basename(path) for path in paths if os.path.dirname(path) == directory]
+            self.assertEqual(names, sorted(names))
+
+    def test_exclude(self):
+        self.assertFalse([path for path in self.walk(['**'], excludes=['node_modules']) if 'node_modules' in path])
+        self.assertEqual(sorted(self.walk(['**/*.txt'], excludes=['*.txt'])), [])
+        self.assertNotIn('a/b/c/three.txt', self.walk(['**'], excludes=['b/**/*.txt']))
+        self.assertIn('a/one.txt', self.walk(['**'], excludes=[os.path.join(self.directory, 'one.txt')]))
+        self.assertNotIn('a/one.txt', self.walk(['**'], excludes=[os.path.join(self.directory, 'a', 'one.txt')]))
+
+    def test_missing_root(self):
+        self.assertEqual(self.walk(['nothing/**']), [])
+
+    @unittest.skipIf(glob2 is None, 'glob2 is not installed')
+    def test_same_as_glob2(self):
+        for pattern in PATTERNS:
+            expected = set(os.path.relpath(path, self.directory)
+                           for path in glob2.glob(os.path.join(self.directory, pattern), include_hidden=True))
+            self.assertEqual(set(self.walk([pattern], include_hidden=True)), expected, pattern)
+
+            # glob2 only leaves out hidden names matched by the first wildcard, rather than at every depth
+            expected = set(os.path.relpath(path, self.directory)
+                           for path in glob2.glob(os.path.join(self.directory, pattern)))
+            self.assertEqual(set(self.walk([pattern])),
+                             set(path for path in expected if not _hidden(path) or
+                                 _hidden(pattern.replace('/', os.sep))), pattern)
+
+
+if __name__ == '__main__':
+    unittest.main()